@@ -0,0 +1,96 @@
+"""
+Helpers shared by the benchmark scripts.
+
+The benchmarks run against a throwaway SQLite database filled with
+synthetic questions, so they need no running Postgres. Run them from the
+backend folder, e.g. `python -m benchmarks.quiz_selection`.
+"""
+
+import os
+import random
+import tempfile
+import time
+
+from flaskr import create_app
+from models import db, Question, Category
+
+# a fixed vocabulary so that searches hit a realistic mix of common and rare words
+WORDS = [
+    "ancient", "river", "capital", "painter", "novel", "planet", "element",
+    "king", "queen", "war", "treaty", "mountain", "ocean", "island", "film",
+    "actor", "singer", "album", "team", "league", "cup", "medal", "record",
+    "invented", "discovered", "largest", "smallest", "first", "last", "city",
+    "country", "desert", "forest", "animal", "bird", "fish", "language",
+    "author", "poem", "symphony", "composer", "temple", "empire", "dynasty",
+    "revolution", "president", "title", "character", "series", "festival",
+]
+
+# plus made-up rarer words so the bank has a realistic spread of vocabulary
+SYLLABLES = ["ba", "ko", "ri", "tan", "mel", "su", "dor", "vi", "len", "qua", "pe", "zor"]
+RARE_WORDS = sorted({
+    a + b + c for a in SYLLABLES for b in SYLLABLES for c in SYLLABLES
+})
+
+
+def make_app(path=None, **config):
+    if path is None:
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+    config.setdefault("SQLALCHEMY_DATABASE_URI", "sqlite:///" + path)
+    # the throwaway database gets its schema when the app is created
+    config.setdefault("DB_MIGRATE_ON_STARTUP", True)
+    return create_app(config), path
+
+
+def make_question(rng, number, categories):
+    words = [rng.choice(WORDS) if rng.random() < 0.7 else rng.choice(RARE_WORDS)
+             for _ in range(rng.randint(5, 10))]
+    # a unique token keeps every question distinct, like real question text
+    words.append("q{}".format(number))
+    return {
+        'question': " ".join(words).capitalize() + "?",
+        'answer': rng.choice(WORDS).capitalize(),
+        'difficulty': rng.randint(1, 5),
+        'category': rng.randint(1, categories)
+    }
+
+
+def seed(app, questions, categories=6, chunk=10000, seed=0):
+    rng = random.Random(seed)
+    with app.app_context():
+        db.session.execute(Category.__table__.insert(), [
+            {'id': number, 'type': "Category {}".format(number)}
+            for number in range(1, categories + 1)
+        ])
+        for start in range(0, questions, chunk):
+            db.session.execute(Question.__table__.insert(), [
+                make_question(rng, number, categories)
+                for number in range(start, min(start + chunk, questions))
+            ])
+        db.session.commit()
+
+
+def timed(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    position = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+    return ordered[position]
+
+
+def summary(samples):
+    # latencies in milliseconds
+    return {
+        'count': len(samples),
+        'mean_ms': round(sum(samples) / len(samples) * 1000, 4),
+        'p50_ms': round(percentile(samples, 50) * 1000, 4),
+        'p95_ms': round(percentile(samples, 95) * 1000, 4),
+        'p99_ms': round(percentile(samples, 99) * 1000, 4),
+    }
@@ -0,0 +1,76 @@
+"""
+Compares two reports of benchmarks.endpoints, e.g. of two commits.
+
+    python -m benchmarks.compare before.json after.json --threshold 20
+
+Prints, as JSON, every route whose p99 latency or throughput got worse by
+more than --threshold percent, or that runs more SQL statements per
+request, and exits with status 1 when there is any.
+"""
+
+import argparse
+import json
+import sys
+
+
+def routes(report):
+    if 'routes' in report:
+        yield "url", report['routes']
+    for size, results in report.get('sizes', {}).items():
+        yield size, results
+
+
+def change(before, after):
+    if not before:
+        return 0.0
+    return round((after - before) / before * 100, 1)
+
+
+def compare(before, after, threshold):
+    previous = dict(routes(before))
+    regressions = []
+    for size, results in routes(after):
+        for name, result in results.items():
+            old = previous.get(size, {}).get(name)
+            if old is None:
+                continue
+            found = {}
+            latency = change(old['p99_ms'], result['p99_ms'])
+            if latency > threshold:
+                found['p99_ms'] = [old['p99_ms'], result['p99_ms'], latency]
+            throughput = change(old['requests_per_second'], result['requests_per_second'])
+            if throughput < -threshold:
+                found['requests_per_second'] = [
+                    old['requests_per_second'], result['requests_per_second'], throughput]
+            if result.get('statements_per_request', 0) > old.get('statements_per_request', 0):
+                found['statements_per_request'] = [
+                    old['statements_per_request'], result['statements_per_request']]
+            if found:
+                regressions.append(dict(size=size, route=name, **found))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("before")
+    parser.add_argument("after")
+    parser.add_argument("--threshold", type=float, default=20,
+                        help="percent change reported as a regression")
+    args = parser.parse_args()
+
+    with open(args.before) as stream:
+        before = json.load(stream)
+    with open(args.after) as stream:
+        after = json.load(stream)
+
+    regressions = compare(before, after, args.threshold)
+    print(json.dumps({
+        'before': before.get('commit'),
+        'after': after.get('commit'),
+        'regressions': regressions
+    }, indent=2))
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+"""
+Benchmark of every route of the API.
+
+For each bank size a SQLite database is seeded with synthetic questions,
+the app is created once, and every route is driven --repeat times through
+the test client with varying arguments (pages, categories, search words).
+For each route the report has the throughput, the p50/p95/p99 latency, the
+number of SQL statements per request and the peak memory allocated while
+the route ran, as JSON so runs can be compared across commits with
+`python -m benchmarks.compare`.
+
+    python -m benchmarks.endpoints --sizes 1000 100000 --output before.json
+
+With --url the same requests are sent to a running server instead (for
+example gunicorn against Postgres, seeded beforehand); statement counts and
+memory are then not measured.
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import random
+import subprocess
+import time
+import tracemalloc
+import urllib.error
+import urllib.request
+
+from sqlalchemy import event
+
+from models import db, Question
+
+from .common import make_app, make_question, seed, summary, WORDS
+
+
+class StatementCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+def routes(rng, categories, ids):
+    """
+    (name, function returning (method, path, body)) of every route; names
+    follow the routes in flaskr/__init__.py.
+    """
+    created = itertools.count()
+    deletable = iter(ids)
+    tokens = []
+
+    def quiz_with_session():
+        if not tokens:
+            return "POST", "/quizzes/sessions", {"quiz_category": {"id": 0}}
+        return "POST", "/quizzes", {"token": rng.choice(tokens)}
+
+    return [
+        ("GET /categories", lambda: ("GET", "/categories", None)),
+        ("GET /questions", lambda: (
+            "GET", "/questions?page={}".format(rng.randint(1, 50)), None)),
+        ("GET /questions?after", lambda: (
+            "GET", "/questions?after={},{}".format(
+                rng.randint(1, categories), rng.choice(ids)), None)),
+        ("GET /categories/<id>/questions", lambda: (
+            "GET", "/categories/{}/questions?page={}".format(
+                rng.randint(1, categories), rng.randint(1, 5)), None)),
+        ("GET /questions/suggest", lambda: (
+            "GET", "/questions/suggest?q={}".format(rng.choice(WORDS)[:4]), None)),
+        ("GET /questions/export", lambda: (
+            "GET", "/questions/export?category={}".format(rng.randint(1, categories)), None)),
+        ("POST /questions search", lambda: (
+            "POST", "/questions", {"searchTerm": " ".join(rng.sample(WORDS, 2))})),
+        ("POST /questions create", lambda: (
+            "POST", "/questions", make_question(rng, "new{}".format(next(created)), categories))),
+        ("POST /questions/bulk", lambda: (
+            "POST", "/questions/bulk", [make_question(rng, "bulk{}".format(next(created)), categories)
+                                        for _ in range(100)])),
+        ("DELETE /questions/<id>", lambda: (
+            "DELETE", "/questions/{}".format(next(deletable)), None)),
+        ("POST /quizzes", lambda: (
+            "POST", "/quizzes", {"previous_questions": rng.sample(ids, 20),
+                                 "quiz_category": {"id": rng.randint(0, categories)}})),
+        ("POST /quizzes/sessions", lambda: (
+            "POST", "/quizzes/sessions", {"quiz_category": {"id": 0}})),
+        ("POST /quizzes with token", quiz_with_session),
+        ("GET /metrics", lambda: ("GET", "/metrics", None)),
+        ("GET /healthz", lambda: ("GET", "/healthz", None)),
+    ], tokens
+
+
+def client_sender(app):
+    client = app.test_client()
+
+    def send(method, path, body):
+        response = client.open(path, method=method, json=body)
+        # read the whole body, streamed responses included
+        data = response.get_data()
+        response.close()
+        return response.status_code, data
+    return send
+
+
+def url_sender(url):
+    def send(method, path, body):
+        data = json.dumps(body).encode() if body is not None else None
+        request = urllib.request.Request(
+            url + path, data=data, method=method,
+            headers={"Content-Type": "application/json"} if data is not None else {})
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, response.read()
+        except urllib.error.HTTPError as error:
+            return error.code, error.read()
+    return send
+
+
+def run_route(send, make_request, repeat, counter, tokens):
+    statuses = {}
+    samples = []
+    statements = counter.count if counter is not None else 0
+
+    def one_request():
+        method, path, body = make_request()
+        requestStart = time.perf_counter()
+        status, data = send(method, path, body)
+        samples.append(time.perf_counter() - requestStart)
+        statuses[status] = statuses.get(status, 0) + 1
+        if path == "/quizzes/sessions" and status == 200:
+            tokens.append(json.loads(data)["token"])
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        one_request()
+    elapsed = time.perf_counter() - start
+
+    result = summary(samples)
+    result['requests_per_second'] = round(repeat / elapsed, 1)
+    result['statuses'] = {str(status): count for status, count in sorted(statuses.items())}
+    if counter is None:
+        return result
+
+    result['statements_per_request'] = round((counter.count - statements) / repeat, 2)
+    # tracing slows every allocation down, so memory is taken on a separate,
+    # shorter run that is left out of the timings
+    tracemalloc.start()
+    try:
+        for _ in range(max(1, repeat // 10)):
+            one_request()
+        result['peak_memory_kb'] = round(tracemalloc.get_traced_memory()[1] / 1024, 1)
+    finally:
+        tracemalloc.stop()
+    return result
+
+
+def bench_size(size, args):
+    rng = random.Random(size)
+    app, path = make_app(SUGGEST_PRELOAD=False)
+    try:
+        seed(app, size, args.categories)
+        with app.app_context():
+            ids = [row.id for row in db.session.query(Question.id)]
+            counter = StatementCounter(db.get_engine(app))
+        ids = rng.sample(ids, len(ids))
+
+        send = client_sender(app)
+        # one request per route first, so the indexes and caches are warm
+        warmup, tokens = routes(random.Random(0), args.categories, ids[args.repeat * 2:])
+        for _, make_request in warmup:
+            send(*make_request())
+
+        table, tokens = routes(rng, args.categories, ids)
+        return {name: run_route(send, make_request, args.repeat, counter, tokens)
+                for name, make_request in table
+                if not args.routes or name in args.routes}
+    finally:
+        os.remove(path)
+
+
+def bench_url(url, args):
+    with urllib.request.urlopen(url + "/questions?page=1") as response:
+        ids = [question["id"] for question in json.loads(response.read())["questions"]]
+    # only the ids on the first page are known, deletes would exhaust them
+    table, tokens = routes(random.Random(0), args.categories, ids * args.repeat)
+    send = url_sender(url)
+    return {name: run_route(send, make_request, args.repeat, None, tokens)
+            for name, make_request in table
+            if name != "DELETE /questions/<id>" and (not args.routes or name in args.routes)}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000])
+    parser.add_argument("--categories", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--routes", nargs="+", help="only run these routes")
+    parser.add_argument("--url", help="benchmark a running server")
+    parser.add_argument("--output", help="write the report to this file")
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'created_at': time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        'repeat': args.repeat,
+        'categories': args.categories,
+    }
+    # keep what the views print out of the report
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        if args.url:
+            report['url'] = args.url
+            report['routes'] = bench_url(args.url.rstrip("/"), args)
+        else:
+            report['sizes'] = {str(size): bench_size(size, args) for size in args.sizes}
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as stream:
+            stream.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
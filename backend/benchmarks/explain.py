@@ -0,0 +1,145 @@
+"""
+Query plans and timings of the hot queries before and after the schema
+migrations of migrations.py.
+
+Seeds the schema db.create_all() used to make (text category, no indexes),
+prints the plan and the latency of each query, migrates the database and
+does the same again.
+
+    python -m benchmarks.explain --questions 100000
+
+--url runs it on another database instead, e.g. a scratch Postgres
+database; it must be empty, and its tables are dropped at the end.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+
+from sqlalchemy import create_engine, text
+
+from models import db
+from migrations import migrate
+
+from .common import make_question, summary, timed
+
+# {id} is the type of an auto-incrementing id on the database
+LEGACY_SCHEMA = [
+    "CREATE TABLE categories (id {id} NOT NULL, type VARCHAR, PRIMARY KEY (id))",
+    "CREATE TABLE questions (id {id} NOT NULL, question VARCHAR, answer VARCHAR, "
+    "category VARCHAR, difficulty INTEGER, PRIMARY KEY (id))",
+]
+
+COLUMNS = "id, question, answer, category, difficulty"
+
+QUERIES = {
+    'category_page': "SELECT " + COLUMNS + " FROM questions WHERE category = :category "
+                     "ORDER BY category, id LIMIT 10 OFFSET 20",
+    'category_count': "SELECT COUNT(id) FROM questions WHERE category = :category",
+    'deep_page': "SELECT " + COLUMNS + " FROM questions ORDER BY category, id "
+                 "LIMIT 10 OFFSET :offset",
+    'keyset_page': "SELECT " + COLUMNS + " FROM questions WHERE category > :category "
+                   "OR (category = :category AND id > :id) ORDER BY category, id LIMIT 10",
+    'difficulty_export': "SELECT " + COLUMNS + " FROM questions WHERE difficulty = :difficulty "
+                         "ORDER BY id",
+    'duplicate_check': "SELECT id FROM questions WHERE question = :question LIMIT 1",
+}
+
+# the duplicate check as read_models.question_matches() runs it on Postgres
+POSTGRES_DUPLICATE_CHECK = ("SELECT id FROM questions WHERE md5(question) = md5(:question) "
+                            "AND question = :question LIMIT 1")
+
+
+def seed_legacy(engine, questions, categories):
+    rng = random.Random(0)
+    idType = "SERIAL" if engine.dialect.name == 'postgresql' else "INTEGER"
+    for statement in LEGACY_SCHEMA:
+        engine.execute(text(statement.format(id=idType)))
+    engine.execute(text("INSERT INTO categories (id, type) VALUES (:id, :type)"), [
+        {'id': number, 'type': "Category {}".format(number)}
+        for number in range(1, categories + 1)])
+    for start in range(0, questions, 10000):
+        rows = [make_question(rng, number, categories)
+                for number in range(start, min(start + 10000, questions))]
+        for row in rows:
+            row['category'] = str(row['category'])
+        engine.execute(text(
+            "INSERT INTO questions (question, answer, difficulty, category) "
+            "VALUES (:question, :answer, :difficulty, :category)"), rows)
+
+
+def plan(engine, query, parameters):
+    if engine.dialect.name == 'sqlite':
+        rows = engine.execute(text("EXPLAIN QUERY PLAN " + query), parameters)
+        return [row[-1] for row in rows]
+    return [row[0] for row in engine.execute(text("EXPLAIN " + query), parameters)]
+
+
+def measure(engine, parameters, repeat):
+    queries = dict(QUERIES)
+    if engine.dialect.name == 'postgresql':
+        queries['duplicate_check'] = POSTGRES_DUPLICATE_CHECK
+    return {
+        name: {
+            'plan': plan(engine, query, parameters),
+            'latency': summary(timed(
+                lambda: engine.execute(text(query), parameters).fetchall(), repeat)),
+        } for name, query in queries.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=100000)
+    parser.add_argument("--categories", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--url", help="an empty database to run on")
+    args = parser.parse_args()
+
+    path = None
+    url = args.url
+    if url is None:
+        fd, path = tempfile.mkstemp(suffix=".db")
+        os.close(fd)
+        url = "sqlite:///" + path
+    engine = create_engine(url)
+
+    parameters = {
+        # a string compares with the text column before and the integer after
+        'category': '3',
+        'offset': args.questions // 2,
+        'id': args.questions // 2,
+        'difficulty': 2,
+        # a new question, as in POST /questions, so the check finds nothing
+        'question': make_question(random.Random(1), args.questions, args.categories)['question'],
+    }
+    try:
+        seed_legacy(engine, args.questions, args.categories)
+        before = measure(engine, parameters, args.repeat)
+        version = migrate(engine, db.metadata)
+        # fresh statistics, so the planner knows about the new indexes
+        engine.execute(text("ANALYZE"))
+        after = measure(engine, parameters, args.repeat)
+    finally:
+        if path is not None:
+            os.remove(path)
+        else:
+            db.metadata.drop_all(engine)
+            engine.execute(text("DROP TABLE IF EXISTS schema_version"))
+        engine.dispose()
+
+    print(json.dumps({
+        'questions': args.questions,
+        'schema_version': version,
+        'queries': {name: {
+            'before': before[name],
+            'after': after[name],
+            'speedup': round(before[name]['latency']['mean_ms'] / after[name]['latency']['mean_ms'], 1)
+        } for name in before}
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
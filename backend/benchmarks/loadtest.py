@@ -0,0 +1,214 @@
+"""
+Load test of the sync (Flask) and async (ASGI) serving modes.
+
+Seeds a SQLite question bank, starts each server in its own process on it,
+and drives it with --concurrency simulated players for --duration seconds,
+each sending a mix of quiz, list and search requests over a keep-alive
+connection. Prints requests per second and latency percentiles per mode.
+
+    python -m benchmarks.loadtest --questions 20000 --concurrency 200
+
+The sync mode runs the threaded Werkzeug server, the async mode uvicorn
+(skipped when it is not installed). --sync-url and --async-url test servers
+that are already running instead, e.g. gunicorn against Postgres.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import urllib.request
+from urllib.parse import urlsplit
+
+from .common import make_app, seed, summary, WORDS
+
+
+def request_mix(rng, categories):
+    # (method, path, body) of the next request of a player; mostly quiz rounds
+    return rng.choices([
+        ("POST", "/quizzes", {"previous_questions": [rng.randrange(1000) for _ in range(5)],
+                              "quiz_category": {"id": rng.randint(0, categories)}}),
+        ("GET", "/questions?page={}".format(rng.randint(1, 20)), None),
+        ("GET", "/categories/{}/questions".format(rng.randint(1, categories)), None),
+        ("GET", "/categories", None),
+        ("POST", "/questions", {"searchTerm": rng.choice(WORDS)}),
+    ], weights=[50, 20, 15, 10, 5])[0]
+
+
+def encode_request(host, method, path, body):
+    data = json.dumps(body).encode() if body is not None else b""
+    head = "{} {} HTTP/1.1\r\nHost: {}\r\nContent-Length: {}\r\n".format(
+        method, path, host, len(data))
+    if body is not None:
+        head += "Content-Type: application/json\r\n"
+    return (head + "\r\n").encode() + data
+
+
+async def read_response(reader):
+    statusLine = await reader.readline()
+    if not statusLine:
+        raise ConnectionError("connection closed")
+    status = int(statusLine.split()[1])
+    keepAlive = statusLine.startswith(b"HTTP/1.1")
+    length = None
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "connection":
+            keepAlive = value.strip().lower() != "close"
+    if length is None:
+        await reader.read()
+        keepAlive = False
+    else:
+        await reader.readexactly(length)
+    return status, keepAlive
+
+
+async def player(url, deadline, categories, seed, latencies, errors):
+    parts = urlsplit(url)
+    rng = random.Random(seed)
+    connection = None
+    while time.monotonic() < deadline:
+        method, path, body = request_mix(rng, categories)
+        start = time.perf_counter()
+        try:
+            if connection is None:
+                connection = await asyncio.open_connection(parts.hostname, parts.port)
+            reader, writer = connection
+            writer.write(encode_request(parts.netloc, method, path, body))
+            await writer.drain()
+            status, keepAlive = await read_response(reader)
+        except (ConnectionError, OSError, asyncio.IncompleteReadError):
+            errors.append("connection")
+            connection = None
+            continue
+        latencies.append(time.perf_counter() - start)
+        # 404 is the answer for pages past the end, not a failure
+        if status >= 500:
+            errors.append(status)
+        if not keepAlive:
+            connection[1].close()
+            connection = None
+    if connection is not None:
+        connection[1].close()
+
+
+async def drive(url, concurrency, duration, categories):
+    latencies, errors = [], []
+    deadline = time.monotonic() + duration
+    start = time.monotonic()
+    await asyncio.gather(*[
+        player(url, deadline, categories, number, latencies, errors)
+        for number in range(concurrency)])
+    elapsed = time.monotonic() - start
+    result = {
+        'requests': len(latencies),
+        'requests_per_second': round(len(latencies) / elapsed, 1),
+        'errors': len(errors),
+    }
+    if latencies:
+        result['latency'] = summary(latencies)
+    return result
+
+
+def wait_until_up(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the server exited with code {}".format(process.returncode))
+        try:
+            urllib.request.urlopen(url + "/healthz", timeout=1).read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError("the server did not start in {} seconds".format(timeout))
+
+
+def server_command(mode, port):
+    if mode == "sync":
+        return [sys.executable, "-m", "benchmarks.loadtest", "--serve", str(port)]
+    return [sys.executable, "-m", "uvicorn", "--factory", "flaskr.asgi:create_asgi_app",
+            "--port", str(port), "--log-level", "warning", "--no-access-log"]
+
+
+def serve_sync(port):
+    from werkzeug.serving import run_simple
+    from flaskr import create_app
+    run_simple("127.0.0.1", port, create_app(), threaded=True)
+
+
+def run_mode(mode, args, path, port):
+    if mode == "async":
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            return {'skipped': "uvicorn is not installed"}
+
+    env = dict(os.environ, DATABASE_URL="sqlite:///" + path, SUGGEST_PRELOAD="false")
+    process = subprocess.Popen(server_command(mode, port), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = "http://127.0.0.1:{}".format(port)
+    try:
+        wait_until_up(url, process)
+        # one short round to load the indexes and caches
+        asyncio.run(drive(url, 4, 1, args.categories))
+        return asyncio.run(drive(url, args.concurrency, args.duration, args.categories))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=20000)
+    parser.add_argument("--categories", type=int, default=6)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--modes", nargs="+", default=["sync", "async"],
+                        choices=["sync", "async"])
+    parser.add_argument("--port", type=int, default=5100)
+    parser.add_argument("--sync-url")
+    parser.add_argument("--async-url")
+    parser.add_argument("--serve", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve_sync(args.serve)
+        return
+
+    urls = {'sync': args.sync_url, 'async': args.async_url}
+    results = {
+        'questions': args.questions,
+        'concurrency': args.concurrency,
+        'duration_s': args.duration,
+        'modes': {},
+    }
+
+    path = None
+    if not all(urls[mode] for mode in args.modes):
+        app, path = make_app(SUGGEST_PRELOAD=False)
+        seed(app, args.questions, args.categories)
+    try:
+        for number, mode in enumerate(args.modes):
+            if urls[mode]:
+                results['modes'][mode] = asyncio.run(drive(
+                    urls[mode], args.concurrency, args.duration, args.categories))
+            else:
+                results['modes'][mode] = run_mode(mode, args, path, args.port + number)
+        print(json.dumps(results, indent=2))
+    finally:
+        if path is not None:
+            os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Compares the old NOT IN query for picking the next quiz question against the
+in-memory quiz index, early in a quiz (round 1) and deep into one (round 500).
+
+It also times getting the next --batch questions through the API with one
+POST /quizzes each against a single POST /quizzes with "count".
+
+    python -m benchmarks.quiz_selection --questions 50000 --rounds 1 500
+"""
+
+import argparse
+import json
+import os
+import random
+
+from models import Question
+from flaskr.quiz import get_quiz_index, next_quiz_question, next_quiz_questions
+
+from .common import make_app, seed, summary, timed
+
+
+def old_path(category, previous):
+    return Question.query.filter(
+        ~Question.id.in_(previous), Question.category == category).first()
+
+
+def new_path(category, previous):
+    return next_quiz_question(category, set(previous))
+
+
+def single_requests(client, category, previous, batch):
+    previous = list(previous)
+    for _ in range(batch):
+        data = client.post("/quizzes", json={
+            'previous_questions': previous, 'quiz_category': {'id': category}}).get_json()
+        previous.append(data['question']['id'])
+
+
+def batch_request(client, category, previous, batch):
+    client.post("/quizzes", json={
+        'previous_questions': previous, 'quiz_category': {'id': category}, 'count': batch})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=20000)
+    parser.add_argument("--categories", type=int, default=6)
+    parser.add_argument("--rounds", type=int, nargs="+", default=[1, 500])
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--batch", type=int, default=20)
+    args = parser.parse_args()
+
+    app, path = make_app()
+    try:
+        seed(app, args.questions, args.categories)
+        results = {'questions': args.questions, 'rounds': {}}
+        with app.app_context():
+            category = 1
+            categoryIds = [row.id for row in Question.query.with_entities(
+                Question.id).filter(Question.category == category).all()]
+            # build the index outside the timed section, like a warm worker
+            get_quiz_index().count()
+
+            for round_number in args.rounds:
+                previous = random.sample(
+                    categoryIds, min(round_number - 1, len(categoryIds) - 1))
+                results['rounds'][round_number] = {
+                    'old_not_in': summary(timed(
+                        lambda: old_path(category, previous), args.repeat)),
+                    'quiz_index': summary(timed(
+                        lambda: new_path(category, previous), args.repeat)),
+                    'quiz_index_batch': summary(timed(
+                        lambda: next_quiz_questions(category, set(previous), args.batch),
+                        args.repeat)),
+                }
+
+        client = app.test_client()
+        for round_number in args.rounds:
+            previous = random.sample(
+                categoryIds, min(round_number - 1, len(categoryIds) - args.batch))
+            results['rounds'][round_number].update({
+                'single_requests': summary(timed(
+                    lambda: single_requests(client, category, previous, args.batch),
+                    max(1, args.repeat // args.batch))),
+                'batch_request': summary(timed(
+                    lambda: batch_request(client, category, previous, args.batch),
+                    max(1, args.repeat // args.batch))),
+            })
+        print(json.dumps(results, indent=2))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
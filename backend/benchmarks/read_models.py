@@ -0,0 +1,74 @@
+"""
+Time and memory of loading questions as ORM instances, the way the read
+endpoints used to, against loading them as QuestionRows with a Core
+select, per 10k rows.
+
+    python -m benchmarks.read_models --questions 100000
+
+Memory is the peak traced by tracemalloc while the rows are loaded and
+held, which includes the session's identity map for the ORM instances.
+"""
+
+import argparse
+import json
+import os
+import tracemalloc
+
+from models import db, Question
+from flaskr.read_models import load_questions, select_questions
+
+from .common import make_app, seed, summary, timed
+
+
+def load_orm():
+    return Question.query.all()
+
+
+def load_rows():
+    return load_questions(select_questions())
+
+
+def peak_memory_kb(load):
+    tracemalloc.start()
+    try:
+        rows = load()
+        peak = tracemalloc.get_traced_memory()[1]
+        del rows
+    finally:
+        tracemalloc.stop()
+        db.session.remove()
+    return peak / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    app, path = make_app(SUGGEST_PRELOAD=False)
+    try:
+        seed(app, args.questions)
+        with app.app_context():
+            per10k = 10000 / args.questions
+            results = {}
+            for name, load in [("orm", load_orm), ("read_models", load_rows)]:
+                def run():
+                    load()
+                    db.session.remove()
+                run()
+                latency = summary(timed(run, args.repeat))
+                results[name] = {
+                    'ms_per_10k': round(latency['mean_ms'] * per10k, 3),
+                    'peak_memory_kb_per_10k': round(peak_memory_kb(load) * per10k, 1),
+                }
+    finally:
+        os.remove(path)
+
+    for key in ('ms_per_10k', 'peak_memory_kb_per_10k'):
+        results['saved_' + key] = round(results['orm'][key] - results['read_models'][key], 3)
+    print(json.dumps({'questions': args.questions, 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
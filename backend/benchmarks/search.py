@@ -0,0 +1,61 @@
+"""
+Compares the old ilike '%term%' search against the search backend at
+several sizes of the question bank.
+
+    python -m benchmarks.search --sizes 10000 100000 1000000
+
+The ilike query is timed the way the endpoint used to run it: every match
+is loaded. The index is timed for one ranked page of 10, like the endpoint
+runs it now, after a warm-up search has built it.
+"""
+
+import argparse
+import json
+import os
+import time
+
+from models import Question
+from flaskr.search import search_questions
+
+from .common import make_app, seed, summary, timed
+
+TERMS = ["ancient", "river capital", "revolution", "q12345", "symph"]
+
+
+def ilike_search(term):
+    return Question.query.filter(Question.question.ilike("%{}%".format(term))).all()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000])
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--backend", default="memory")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        app, path = make_app(SEARCH_BACKEND=args.backend)
+        try:
+            seed(app, size)
+            with app.app_context():
+                start = time.perf_counter()
+                search_questions(TERMS[0])
+                buildSeconds = time.perf_counter() - start
+
+                for term in TERMS:
+                    results.append({
+                        'questions': size,
+                        'term': term,
+                        'index_build_s': round(buildSeconds, 3),
+                        'ilike': summary(timed(lambda: ilike_search(term), args.repeat)),
+                        'index': summary(timed(lambda: search_questions(term), args.repeat)),
+                    })
+        finally:
+            os.remove(path)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+CPU time of loading and encoding a page of questions, per 1k questions:
+ORM objects + Question.format() + json.dumps, the way the endpoints used to
+do it, against QuestionRows + JSON fragments, with an empty and a warm
+fragment cache.
+
+    python -m benchmarks.serialization --questions 20000 --page 1000
+"""
+
+import argparse
+import json
+import os
+import time
+
+from flask import json as flask_json
+
+from models import Question
+from flaskr.read_models import load_questions, select_questions
+from flaskr.serialize import FragmentCache
+
+from .common import make_app, seed
+
+
+def cpu_ms(runner, repeat):
+    # mean CPU milliseconds of runner.load() and of runner.encode()
+    load = encode = 0.0
+    for _ in range(repeat):
+        start = time.process_time()
+        loaded = runner.load()
+        middle = time.process_time()
+        runner.encode(loaded)
+        end = time.process_time()
+        load += middle - start
+        encode += end - middle
+    return load / repeat * 1000, encode / repeat * 1000
+
+
+class OrmFormat:
+    def __init__(self, page):
+        self.page = page
+
+    def load(self):
+        return Question.query.order_by(Question.id).limit(self.page).all()
+
+    def encode(self, questions):
+        return flask_json.dumps({'questions': [question.format() for question in questions]},
+                                separators=(",", ":"))
+
+
+class RowFragments:
+    def __init__(self, page, cache):
+        self.page = page
+        self.cache = cache
+
+    def load(self):
+        return load_questions(select_questions().order_by(Question.id).limit(self.page))
+
+    def encode(self, rows):
+        return flask_json.dumps({'questions': [self.cache.get(row) for row in rows]},
+                                separators=(",", ":"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=20000)
+    parser.add_argument("--page", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=50)
+    args = parser.parse_args()
+
+    app, path = make_app(SUGGEST_PRELOAD=False)
+    try:
+        seed(app, args.questions)
+        with app.test_request_context():
+            runners = {
+                'orm_format': OrmFormat(args.page),
+                'rows_fragments_uncached': RowFragments(args.page, FragmentCache(0)),
+                'rows_fragments_cached': RowFragments(args.page, FragmentCache(args.page)),
+            }
+            # the same bytes either way; this also fills the cache
+            assert len({runner.encode(runner.load()) for runner in runners.values()}) == 1
+
+            per1k = 1000 / args.page
+            results = {}
+            for name, runner in runners.items():
+                load, encode = cpu_ms(runner, args.repeat)
+                results[name] = {
+                    'load_cpu_ms_per_1k': round(load * per1k, 3),
+                    'encode_cpu_ms_per_1k': round(encode * per1k, 3),
+                    'total_cpu_ms_per_1k': round((load + encode) * per1k, 3),
+                }
+    finally:
+        os.remove(path)
+
+    baseline = results['orm_format']['total_cpu_ms_per_1k']
+    for result in results.values():
+        result['saved_cpu_ms_per_1k'] = round(baseline - result['total_cpu_ms_per_1k'], 3)
+    print(json.dumps({'questions': args.questions, 'page': args.page, 'results': results},
+                     indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Bursts of identical concurrent reads with and without coalescing.
+
+Every round starts --concurrency threads at once on the same request, the
+way players all open the first page when a quiz night starts, and counts
+the SQL statements the round ran and how long it took.
+
+    python -m benchmarks.single_flight --questions 20000 --concurrency 50
+
+The response cache is off so every request misses it, as after a change
+of the questions; coalescing is off with SINGLE_FLIGHT_TIMEOUT=0.
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+
+from sqlalchemy import event
+
+from models import db
+
+from .common import make_app, seed, summary
+
+REQUESTS = {
+    'questions_page': ("GET", "/questions?page=1", None),
+    'category_page': ("GET", "/categories/1/questions?page=1", None),
+    'search': ("POST", "/questions", {'searchTerm': "river"}),
+}
+
+
+def burst(app, method, path, body, concurrency):
+    barrier = threading.Barrier(concurrency)
+
+    def send():
+        client = app.test_client()
+        barrier.wait()
+        client.open(path, method=method, json=body)
+
+    threads = [threading.Thread(target=send) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.perf_counter() - start
+
+
+def run(app, concurrency, rounds):
+    statements = [0]
+
+    def count(*args):
+        statements[0] += 1
+
+    with app.app_context():
+        engine = db.get_engine(app)
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        results = {}
+        for name, (method, path, body) in REQUESTS.items():
+            # warm up the caches and indexes first
+            app.test_client().open(path, method=method, json=body)
+            statements[0] = 0
+            samples = [burst(app, method, path, body, concurrency) for _ in range(rounds)]
+            results[name] = dict(
+                summary(samples),
+                statements_per_round=round(statements[0] / rounds, 1))
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    config = dict(SUGGEST_PRELOAD=False, RESPONSE_CACHE_SIZE=0)
+    app, path = make_app(SINGLE_FLIGHT_TIMEOUT=0, **config)
+    try:
+        seed(app, args.questions)
+        coalescedApp, _ = make_app(path, **config)
+        results = {
+            'separate': run(app, args.concurrency, args.rounds),
+            'coalesced': run(coalescedApp, args.concurrency, args.rounds),
+        }
+        results['single_flight'] = coalescedApp.extensions['single_flight'].stats()
+    finally:
+        os.remove(path)
+
+    print(json.dumps({
+        'questions': args.questions,
+        'concurrency': args.concurrency,
+        'results': results
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Latency of the read paths served from the question snapshot against the
+same paths served from the database, plus the time to build the snapshot
+and its size.
+
+    python -m benchmarks.snapshot --questions 100000
+
+Both apps run on the same seeded SQLite database, with the response cache
+off so every request reaches the view.
+"""
+
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+
+from flaskr.snapshot import build_snapshot
+
+from .common import make_app, seed, summary, timed, WORDS
+
+
+def requests(rng, questions, categories):
+    pages = max(1, questions // 10)
+    return {
+        'questions_page': lambda client: client.get(
+            "/questions?page={}".format(rng.randint(1, pages))),
+        'category_page': lambda client: client.get(
+            "/categories/{}/questions?page={}".format(
+                rng.randint(1, categories), rng.randint(1, pages // categories or 1))),
+        'quiz': lambda client: client.post("/quizzes", json={
+            'previous_questions': [], 'quiz_category': {'id': rng.randint(0, categories)}}),
+        'search': lambda client: client.post(
+            "/questions", json={'searchTerm': rng.choice(WORDS)}),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=100000)
+    parser.add_argument("--categories", type=int, default=6)
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    snapshotPath = os.path.join(directory, "questions.snapshot")
+    config = dict(SUGGEST_PRELOAD=False, RESPONSE_CACHE_SIZE=0)
+    app, path = make_app(**config)
+    try:
+        seed(app, args.questions, args.categories)
+        with app.app_context():
+            start = time.perf_counter()
+            build_snapshot(snapshotPath)
+            buildMs = (time.perf_counter() - start) * 1000
+        snapshotBytes = os.path.getsize(snapshotPath)
+        snapshotApp, _ = make_app(path, QUESTION_SNAPSHOT_PATH=snapshotPath, **config)
+
+        results = {}
+        for name, target in [("database", app), ("snapshot", snapshotApp)]:
+            client = target.test_client()
+            results[name] = {}
+            for route, send in requests(random.Random(0), args.questions, args.categories).items():
+                # warm up the caches and indexes first
+                send(client)
+                results[name][route] = summary(timed(lambda: send(client), args.repeat))
+    finally:
+        os.remove(path)
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    results['speedup'] = {
+        route: round(results['database'][route]['mean_ms'] / results['snapshot'][route]['mean_ms'], 1)
+        for route in results['database']}
+    print(json.dumps({
+        'questions': args.questions,
+        'build_ms': round(buildMs, 1),
+        'snapshot_bytes': snapshotBytes,
+        'results': results
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
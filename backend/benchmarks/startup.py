@@ -0,0 +1,122 @@
+"""
+Startup cost of the API: cold start and worker spawn.
+
+Cold start runs a fresh interpreter per sample that imports flaskr and
+calls create_app() on a seeded SQLite database, once bringing the schema
+up to date on startup (DB_MIGRATE_ON_STARTUP true, as under gunicorn.conf.py)
+and once lazily (the default), which opens no connection.
+
+Worker spawn forks workers from an app created in this process, the way
+gunicorn does with preload_app, and times the first requests each worker
+serves (categories, quiz, search, suggestions and the question list),
+once without and once after flaskr.startup.preload_shared_state().
+
+    python -m benchmarks.startup --questions 100000
+
+The worker spawn part needs os.fork, so it does not run on Windows.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+from flaskr.startup import dispose_engines, preload_shared_state
+
+from .common import make_app, seed, summary
+
+COLD_START = """
+import json, sys, time
+start = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+create_app(json.loads(sys.argv[1]))
+created = time.perf_counter()
+print(json.dumps([imported - start, created - imported]))
+"""
+
+# what a new worker serves first; each loads a different part of the state
+FIRST_REQUESTS = [
+    ("GET", "/categories", None),
+    ("POST", "/quizzes", {'previous_questions': [], 'quiz_category': {'id': 0}}),
+    ("POST", "/questions", {'searchTerm': "river"}),
+    ("GET", "/questions/suggest?q=riv", None),
+    ("GET", "/questions?page=2", None),
+]
+
+
+def cold_start(path, repeat, **config):
+    config = dict(config, SQLALCHEMY_DATABASE_URI="sqlite:///" + path, SUGGEST_PRELOAD=False)
+    backend = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    imports, creates = [], []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", COLD_START, json.dumps(config)],
+            cwd=backend, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout
+        imported, created = json.loads(output)
+        imports.append(imported)
+        creates.append(created)
+    return {'import': summary(imports), 'create_app': summary(creates)}
+
+
+def first_requests(app):
+    client = app.test_client()
+    start = time.perf_counter()
+    for method, path, body in FIRST_REQUESTS:
+        client.open(path, method=method, json=body)
+    return time.perf_counter() - start
+
+
+def spawn_workers(app, workers):
+    samples = []
+    for _ in range(workers):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read)
+            try:
+                os.write(write, json.dumps(first_requests(app)).encode())
+            finally:
+                os._exit(0)
+        os.close(write)
+        with os.fdopen(read) as pipe:
+            samples.append(json.loads(pipe.read()))
+        os.waitpid(pid, 0)
+    return summary(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=5)
+    args = parser.parse_args()
+
+    app, path = make_app(SUGGEST_PRELOAD=False)
+    try:
+        seed(app, args.questions)
+        results = {
+            'cold_start': {
+                'migrate_on_startup': cold_start(path, args.repeat, DB_MIGRATE_ON_STARTUP=True),
+                'lazy': cold_start(path, args.repeat),
+            },
+            'worker_first_requests': {},
+        }
+
+        # the app of this process stands in for the gunicorn master
+        dispose_engines(app)
+        results['worker_first_requests']['no_preload'] = spawn_workers(app, args.workers)
+        start = time.perf_counter()
+        preload_shared_state(app)
+        results['preload_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        results['worker_first_requests']['preloaded'] = spawn_workers(app, args.workers)
+    finally:
+        os.remove(path)
+
+    print(json.dumps({'questions': args.questions, 'results': results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
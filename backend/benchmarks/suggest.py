@@ -0,0 +1,60 @@
+"""
+Measures GET /questions/suggest latency and the memory held by the trigram
+index.
+
+    python -m benchmarks.suggest --questions 1000000
+
+Queries are 3 to 12 character slices of real question texts, so every
+query has at least one match, like a user typing part of a question.
+"""
+
+import argparse
+import json
+import os
+import random
+import time
+
+from flaskr.suggest import suggest_questions
+
+from .common import make_app, seed, summary, timed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--questions", type=int, default=100000)
+    parser.add_argument("--queries", type=int, default=2000)
+    args = parser.parse_args()
+
+    app, path = make_app(SUGGEST_PRELOAD=False)
+    try:
+        seed(app, args.questions)
+        with app.app_context():
+            index = app.extensions['suggest']
+            start = time.perf_counter()
+            index.build()
+            buildSeconds = time.perf_counter() - start
+
+            rng = random.Random(1)
+            texts = list(index._texts.values())
+            queries = []
+            for _ in range(args.queries):
+                text = rng.choice(texts)
+                start = rng.randrange(max(1, len(text) - 3))
+                queries.append(text[start:start + rng.randint(3, 12)])
+
+            iterator = iter(queries)
+            samples = timed(lambda: suggest_questions(next(iterator)), len(queries))
+
+            print(json.dumps({
+                'questions': args.questions,
+                'build_s': round(buildSeconds, 3),
+                'memory_mb': round(index.memory_usage() / 1024 / 1024, 1),
+                'stats': index.stats(),
+                'latency': summary(samples),
+            }, indent=2))
+    finally:
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    main()
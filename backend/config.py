@@ -1,5 +1,5 @@
 import os
-from settings import DB_HOST, DB_NAME, DB_PASSWORD, DB_USER
+from settings import DB_HOST, DB_NAME, DB_PASSWORD, DB_USER, DATABASE_URL, DATABASE_REPLICA_URL
 
 
 SECRET_KEY = os.urandom(32)
@@ -24,4 +24,6 @@ DEBUG = True
 # Connect to the database
 
 
-SQLALCHEMY_DATABASE_URI = DB_PATH
+SQLALCHEMY_DATABASE_URI = DATABASE_URL or DB_PATH
+SQLALCHEMY_REPLICA_URIS = [uri.strip() for uri in (DATABASE_REPLICA_URL or '').split(',')
+                           if uri.strip()]
@@ -0,0 +1,293 @@
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import event, exc, orm, text
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import SelectBase
+
+from settings import (
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING,
+    DB_STATEMENT_TIMEOUT
+)
+
+
+"""
+Engine and connection pool settings
+
+engine_options(uri) builds the create_engine() arguments of every engine
+of the app, the primary database and the optional read replica, from the
+DB_POOL_* and DB_STATEMENT_TIMEOUT environment variables (see settings.py).
+Server databases get an InstrumentedQueuePool, so that the pool usage can
+be read on /metrics; SQLite keeps the pool Flask-SQLAlchemy picks for it.
+
+Read replicas are registered as the binds replica_1, replica_2, ... . The
+SELECTs of a request run on a replica when its view is marked read only
+(see flaskr/routing.py); everything else, flushes, bulk statements and
+the reads of views that write, runs on the primary.
+"""
+
+
+class PoolStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.checkins = 0
+        self.connects = 0
+        self.timeouts = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_checkout(self, wait):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+
+    def format(self):
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'connects': self.connects,
+                'timeouts': self.timeouts,
+                'errors': self.errors,
+                'wait_total_ms': round(self.wait_total * 1000, 3),
+                'wait_max_ms': round(self.wait_max * 1000, 3),
+                'wait_avg_ms': round(
+                    self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0
+            }
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool that counts checkouts and new connections and measures how long
+    each checkout waited for a free connection.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            with self.stats._lock:
+                self.stats.timeouts += 1
+            raise
+        except Exception:
+            with self.stats._lock:
+                self.stats.errors += 1
+            raise
+        self.stats.record_checkout(time.perf_counter() - start)
+        return connection
+
+    def _do_return_conn(self, conn):
+        with self.stats._lock:
+            self.stats.checkins += 1
+        super()._do_return_conn(conn)
+
+    def _create_connection(self):
+        with self.stats._lock:
+            self.stats.connects += 1
+        return super()._create_connection()
+
+    def recreate(self):
+        # the pool is recreated after the database went away (failover);
+        # keep counting on the same stats
+        pool = super().recreate()
+        pool.stats = self.stats
+        return pool
+
+
+def engine_options(uri):
+    options = {'pool_pre_ping': DB_POOL_PRE_PING}
+    if uri.startswith("sqlite"):
+        return options
+
+    options.update({
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT,
+        'pool_recycle': DB_POOL_RECYCLE,
+    })
+    if DB_STATEMENT_TIMEOUT and uri.startswith("postgres"):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(DB_STATEMENT_TIMEOUT)
+        }
+    return options
+
+
+class ReplicaRouter:
+    """
+    Hands out the replicas round-robin. A replica that can not be reached
+    is skipped for retry_interval seconds; with no replica up, reads go to
+    the primary.
+    """
+
+    def __init__(self, database, app, binds, retry_interval=30):
+        self.database = database
+        self.app = app
+        self.binds = list(binds)
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._next = itertools.count()
+        self._engines = {}
+        self._down_until = {}
+        self.reads = dict.fromkeys(self.binds, 0)
+        self.failovers = 0
+
+    def engine(self, bind):
+        engine = self._engines.get(bind)
+        if engine is None:
+            engine = self.database.get_engine(self.app, bind=bind)
+
+            # a connection lost in the middle of a query also takes the
+            # replica out of the rotation
+            @event.listens_for(engine, "handle_error")
+            def mark_disconnect(context):
+                if context.is_disconnect:
+                    self.mark_down(bind)
+
+            self._engines[bind] = engine
+        return engine
+
+    def mark_down(self, bind):
+        with self._lock:
+            self._down_until[bind] = time.monotonic() + self.retry_interval
+            self.failovers += 1
+
+    def pick(self):
+        """
+        Returns the engine of the next replica that accepts a connection,
+        or None.
+        """
+        if not self.binds:
+            return None
+        start = next(self._next)
+        now = time.monotonic()
+        for position in range(len(self.binds)):
+            bind = self.binds[(start + position) % len(self.binds)]
+            if self._down_until.get(bind, 0) > now:
+                continue
+            engine = self.engine(bind)
+            try:
+                # checks the replica is reachable; the connection goes back
+                # to the pool and is the one the session gets next
+                engine.connect().close()
+            except exc.DBAPIError:
+                self.mark_down(bind)
+                continue
+            with self._lock:
+                self.reads[bind] += 1
+            return engine
+        return None
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            return {
+                'replicas': {bind: {
+                    'reads': self.reads[bind],
+                    'up': self._down_until.get(bind, 0) <= now
+                } for bind in self.binds},
+                'failovers': self.failovers
+            }
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # the replica used by this session; False once the session has
+        # written, so that it reads its own writes from the primary
+        self._replica = None
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._replica is not False and not self._flushing \
+                and isinstance(clause, SelectBase) and reads_from_replica():
+            if self._replica is None:
+                router = current_app.extensions.get('replicas')
+                self._replica = router.pick() if router is not None else None
+            if self._replica is not None:
+                return self._replica
+        elif not isinstance(clause, SelectBase):
+            self._replica = False
+        return super().get_bind(mapper, clause)
+
+
+def reads_from_replica():
+    return has_app_context() and g.get('read_only', False)
+
+
+@contextmanager
+def use_primary():
+    """
+    Runs the block on the primary, for reads that must see the latest
+    writes even in a read only view.
+    """
+    readOnly = g.get('read_only', False)
+    g.read_only = False
+    try:
+        yield
+    finally:
+        g.read_only = readOnly
+
+
+class Database(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with the engine options of engine_options(), worked
+    out for the URL of each engine, and sessions that send the reads of
+    read only views to the replicas.
+    """
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        options.update(engine_options(str(sa_url)))
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def engines(self, app):
+        engines = {'primary': self.get_engine(app)}
+        for bind in app.config.get("SQLALCHEMY_BINDS") or {}:
+            if bind.startswith("replica_"):
+                engines[bind] = self.get_engine(app, bind=bind)
+        return engines
+
+
+def pool_status(engine):
+    pool = engine.pool
+    status = {'pool': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update({
+            'size': pool.size(),
+            'checked_out': pool.checkedout(),
+            'checked_in': pool.checkedin(),
+            'overflow': max(pool.overflow(), 0),
+            'max_overflow': pool._max_overflow,
+        })
+    stats = getattr(pool, 'stats', None)
+    if stats is not None:
+        status.update(stats.format())
+    return status
+
+
+def check_engine(engine):
+    start = time.perf_counter()
+    try:
+        with engine.connect() as connection:
+            connection.execute(text("SELECT 1"))
+    except Exception as error:
+        return {'ok': False, 'error': type(error).__name__}
+    return {'ok': True, 'latency_ms': round((time.perf_counter() - start) * 1000, 3)}
@@ -1,52 +1,235 @@
-from crypt import methods
-from distutils.log import error
-import json
-import os
-from urllib import response
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+import logging
+from flask import Flask, Response, request, abort, jsonify, current_app, stream_with_context
 from flask_cors import CORS
-import random
-
-from models import setup_db, Question, Category
-
-QUESTIONS_PER_PAGE = 10
-
-
-def formatQuestions(questions):
-    return [question.format() for question in questions]
-
-
-def paginateQuestions(request, allQuestions):
-    page = request.args.get("page", 1, type=int)
-    # print("page: ", page)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
-
-    formatedQuestions = formatQuestions(allQuestions)
-
-    # print("start, end: ", start, end)
-    return formatedQuestions[start:end]
+from sqlalchemy import exc
+
+from models import setup_db, database_path, replica_paths, db, Question, Category
+from engine import check_engine, pool_status
+from migrations import register_migrate_command
+from settings import (
+    ADMISSION_BACKEND,
+    ADMISSION_BURST,
+    ADMISSION_CLIENT_HEADER,
+    ADMISSION_LOW_PRIORITY_CONCURRENCY,
+    ADMISSION_LOW_PRIORITY_COST,
+    ADMISSION_MAX_CONCURRENCY,
+    ADMISSION_QUEUE_TIMEOUT,
+    ADMISSION_RATE,
+    ADMISSION_ROUTE_LIMITS,
+    ADMISSION_TRUSTED_PROXIES,
+    ASGI_DB_BACKEND,
+    ASGI_THREADS,
+    CATEGORIES_CACHE_TTL,
+    CATEGORIES_CACHE_VERSION_FILE,
+    DB_MIGRATE_ON_STARTUP,
+    DB_REPLICA_RETRY,
+    INSTRUMENTATION,
+    INSTRUMENTATION_PROFILE_DIR,
+    INSTRUMENTATION_PROFILE_RATE,
+    INSTRUMENTATION_SLOW_MS,
+    JSON_FRAGMENT_CACHE_SIZE,
+    LOG_FORMAT,
+    LOG_LEVEL,
+    LOG_LEVELS,
+    LOG_PAYLOAD_SAMPLE,
+    LOG_QUEUE_SIZE,
+    QUESTION_SNAPSHOT_PATH,
+    QUESTION_SNAPSHOT_TTL,
+    QUIZ_BATCH_MAX,
+    QUIZ_INDEX_TTL,
+    QUIZ_SESSION_BACKEND,
+    QUIZ_SESSION_TTL,
+    READ_YOUR_WRITES_WINDOW,
+    RESPONSE_CACHE_BACKEND,
+    RESPONSE_CACHE_MAX_AGE,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+    RESPONSE_CACHE_VERSION_FILE,
+    SEARCH_BACKEND,
+    SEARCH_INDEX_TTL,
+    SECRET_KEY,
+    SINGLE_FLIGHT_TIMEOUT,
+    STATS_RECONCILE_INTERVAL,
+    SUGGEST_INDEX_TTL,
+    SUGGEST_PRELOAD
+)
+from .admission import init_admission
+from .batch import delete_questions, read_changes, read_selection, update_questions
+from .bulk import import_questions, read_request, register_import_command, validate
+from .cache import init_categories_cache
+from .export import MIMETYPES as EXPORT_MIMETYPES, export_questions, register_export_command
+from .instrumentation import init_instrumentation
+from .logs import init_logging, log_payload, logging_stats
+from .metrics import register_metrics, collect_metrics
+from .pagination import QUESTIONS_PER_PAGE, paginate_questions, paginate_snapshot
+from .quiz import init_quiz_index, next_quiz_question, next_quiz_questions
+from .quiz_sessions import init_quiz_sessions
+from .read_models import question_exists
+from .response_cache import cached_response, init_response_cache
+from .routing import init_routing, read_only, reads_own_writes
+from .search import init_search, search_questions
+from .snapshot import current_snapshot, init_question_snapshot
+from .stats import init_question_stats
+from .single_flight import coalesced, init_single_flight
+from .serialize import init_serialization, question_fragment, question_fragments
+from .suggest import init_suggest, suggest_questions
+
+
+MAX_SUGGESTIONS = 20
+
+logger = logging.getLogger(__name__)
+
+
+def quiz_category_id(quiz_category):
+    if quiz_category is None:
+        abort(400)
+
+    categoryId = quiz_category.get('id', None)
+    if categoryId is None:
+        abort(400)
+
+    # The frontend sends quiz_category as {'type'='click', 'id'=0}
+    # whenever it wants all questions; 0 is the "all categories" group
+    # of the quiz index.
+    try:
+        return int(categoryId)
+    except (TypeError, ValueError):
+        abort(400)
 
 
 # this function is called a lot of times so it is necessary to make it stand alone
 def generate_categories():
-    all_categories = Category.query.order_by(Category.id).all()
-    # print("All Categories: ", all_categories)
-
-    # The number of categories are few so there is no need to paginate them.
-    categories = {}
-    for category in all_categories:
-        categories[category.id] = category.type
-
-    return categories
+    # served from the per-app cache, see cache.py
+    return current_app.extensions['categories_cache'].get()
+
+
+def current_category(categoryIds, categories):
+    # the category of the first question of a page that has one: questions
+    # whose category was deleted have none and are listed first on every
+    # database, see pagination.QUESTION_ORDER
+    for categoryId in categoryIds:
+        if categoryId is not None:
+            return categories.get(categoryId, None)
+    return None
+
+
+def quiz_batch_size(body):
+    # how many questions a POST /quizzes asks for at once, None for the
+    # single question mode
+    count = body.get("count", None)
+    if count is None:
+        return None
+    try:
+        count = int(count)
+    except (TypeError, ValueError):
+        abort(400)
+    if count < 1:
+        abort(400)
+    return min(count, current_app.config.get("QUIZ_BATCH_MAX", 50))
+
+
+def integer_filter(args, name):
+    # a filter of the query string, None when it is not given; one that is
+    # not a number is a 400 rather than no filter at all
+    value = args.get(name, None)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        abort(400)
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app)
+    app.config.from_mapping(
+        ADMISSION_BACKEND=ADMISSION_BACKEND,
+        ADMISSION_BURST=ADMISSION_BURST,
+        ADMISSION_CLIENT_HEADER=ADMISSION_CLIENT_HEADER,
+        ADMISSION_LOW_PRIORITY_CONCURRENCY=ADMISSION_LOW_PRIORITY_CONCURRENCY,
+        ADMISSION_LOW_PRIORITY_COST=ADMISSION_LOW_PRIORITY_COST,
+        ADMISSION_MAX_CONCURRENCY=ADMISSION_MAX_CONCURRENCY,
+        ADMISSION_QUEUE_TIMEOUT=ADMISSION_QUEUE_TIMEOUT,
+        ADMISSION_RATE=ADMISSION_RATE,
+        ADMISSION_ROUTE_LIMITS=ADMISSION_ROUTE_LIMITS,
+        ADMISSION_TRUSTED_PROXIES=ADMISSION_TRUSTED_PROXIES,
+        ASGI_DB_BACKEND=ASGI_DB_BACKEND,
+        ASGI_THREADS=ASGI_THREADS,
+        CATEGORIES_CACHE_TTL=CATEGORIES_CACHE_TTL,
+        CATEGORIES_CACHE_VERSION_FILE=CATEGORIES_CACHE_VERSION_FILE,
+        QUESTION_SNAPSHOT_PATH=QUESTION_SNAPSHOT_PATH,
+        QUESTION_SNAPSHOT_TTL=QUESTION_SNAPSHOT_TTL,
+        QUIZ_BATCH_MAX=QUIZ_BATCH_MAX,
+        QUIZ_INDEX_TTL=QUIZ_INDEX_TTL,
+        QUIZ_SESSION_BACKEND=QUIZ_SESSION_BACKEND,
+        QUIZ_SESSION_TTL=QUIZ_SESSION_TTL,
+        SEARCH_BACKEND=SEARCH_BACKEND,
+        SEARCH_INDEX_TTL=SEARCH_INDEX_TTL,
+        SECRET_KEY=SECRET_KEY,
+        SINGLE_FLIGHT_TIMEOUT=SINGLE_FLIGHT_TIMEOUT,
+        STATS_RECONCILE_INTERVAL=STATS_RECONCILE_INTERVAL,
+        SUGGEST_INDEX_TTL=SUGGEST_INDEX_TTL,
+        SUGGEST_PRELOAD=SUGGEST_PRELOAD,
+        DB_MIGRATE_ON_STARTUP=DB_MIGRATE_ON_STARTUP,
+        DB_REPLICA_RETRY=DB_REPLICA_RETRY,
+        INSTRUMENTATION=INSTRUMENTATION,
+        INSTRUMENTATION_PROFILE_DIR=INSTRUMENTATION_PROFILE_DIR,
+        INSTRUMENTATION_PROFILE_RATE=INSTRUMENTATION_PROFILE_RATE,
+        INSTRUMENTATION_SLOW_MS=INSTRUMENTATION_SLOW_MS,
+        JSON_FRAGMENT_CACHE_SIZE=JSON_FRAGMENT_CACHE_SIZE,
+        LOG_FORMAT=LOG_FORMAT,
+        LOG_LEVEL=LOG_LEVEL,
+        LOG_LEVELS=LOG_LEVELS,
+        LOG_PAYLOAD_SAMPLE=LOG_PAYLOAD_SAMPLE,
+        LOG_QUEUE_SIZE=LOG_QUEUE_SIZE,
+        READ_YOUR_WRITES_WINDOW=READ_YOUR_WRITES_WINDOW,
+        RESPONSE_CACHE_BACKEND=RESPONSE_CACHE_BACKEND,
+        RESPONSE_CACHE_MAX_AGE=RESPONSE_CACHE_MAX_AGE,
+        RESPONSE_CACHE_SIZE=RESPONSE_CACHE_SIZE,
+        RESPONSE_CACHE_TTL=RESPONSE_CACHE_TTL,
+        RESPONSE_CACHE_VERSION_FILE=RESPONSE_CACHE_VERSION_FILE
+    )
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+
+    init_logging(app)
+    register_metrics(app, 'logging', logging_stats)
+    fragmentCache = init_serialization(app)
+    register_metrics(app, 'json_fragments', fragmentCache.stats)
+    setup_db(app, app.config.get("SQLALCHEMY_DATABASE_URI", database_path),
+             app.config.get("SQLALCHEMY_REPLICA_URIS", replica_paths))
+    replicas = init_routing(app)
+    register_metrics(app, 'replicas', replicas.stats)
+    register_metrics(app, 'database', lambda: {
+        name: pool_status(engine) for name, engine in db.engines(app).items()})
+    categoriesCache = init_categories_cache(app)
+    register_metrics(app, 'categories_cache', categoriesCache.stats)
+    responseCache = init_response_cache(app)
+    register_metrics(app, 'response_cache', responseCache.stats)
+    singleFlight = init_single_flight(app)
+    register_metrics(app, 'single_flight', singleFlight.stats)
+    init_quiz_index(app)
+    questionStats = init_question_stats(app)
+    register_metrics(app, 'question_stats', questionStats.stats)
+    questionSnapshot = init_question_snapshot(app)
+    if questionSnapshot is not None:
+        register_metrics(app, 'question_snapshot', questionSnapshot.stats)
+    quizSessions = init_quiz_sessions(app)
+    init_search(app)
+    suggestIndex = init_suggest(app)
+    register_metrics(app, 'suggest_index', suggestIndex.stats)
+    register_import_command(app)
+    register_export_command(app)
+    register_migrate_command(app)
     CORS(app, resources={r"/api/": {"origins": "http://localhost:3000"}})
+    routeStats = init_instrumentation(app, db.engines(app).values())
+    if routeStats is not None:
+        register_metrics(app, 'routes', routeStats.format)
+    # runs after the instrumentation hooks, so shed requests are timed too
+    admission = init_admission(app)
+    if admission is not None:
+        register_metrics(app, 'admission', admission.stats)
 
     @app.after_request
     def after_request(response):
@@ -55,7 +238,7 @@ def create_app(test_config=None):
         )
 
         response.headers.add(
-            "Access-Control-Allow-Methods", "GET,POST,DELETE"
+            "Access-Control-Allow-Methods", "GET,POST,PATCH,DELETE"
         )
 
         response.headers.add(
@@ -74,6 +257,8 @@ def create_app(test_config=None):
     """
 
     @app.route("/categories", methods=['GET'])
+    @cached_response
+    @read_only
     def get_all_categories():
         categories = generate_categories()
         # print(categories)
@@ -81,6 +266,37 @@ def create_app(test_config=None):
             'success': True,
             'categories': categories
         })
+    @app.route("/stats", methods=['GET'])
+    @read_only
+    def get_stats():
+        totalQuestions, byCategory, byDifficulty = questionStats.counts()
+        categories = generate_categories()
+        return jsonify({
+            'success': True,
+            'totalQuestions': totalQuestions,
+            'categories': {category_id: byCategory.get(category_id, 0)
+                           for category_id in categories},
+            'difficulties': byDifficulty
+        })
+
+    @app.route("/metrics", methods=['GET'])
+    def get_metrics():
+        return jsonify({
+            'success': True,
+            'metrics': collect_metrics(app)
+        })
+
+    @app.route("/healthz", methods=['GET'])
+    def healthz():
+        # a replica that is down is reported but does not fail the check
+        checks = {name: check_engine(engine)
+                  for name, engine in db.engines(app).items()}
+        healthy = checks['primary']['ok']
+        return jsonify({
+            'success': healthy,
+            'database': checks
+        }), 200 if healthy else 503
+
     """
     Create an endpoint to handle GET requests for questions,
     including pagination (every 10 questions).
@@ -94,24 +310,90 @@ def create_app(test_config=None):
     """
 
     @app.route("/questions", methods=["GET"])
+    @cached_response
+    @read_only
     def get_paginated_books():
-        allQuestions = Question.query.order_by(Question.category).all()
-        currentQuestions = paginateQuestions(request, allQuestions)
+        page = paginate_snapshot(current_snapshot(), request)
+        if page is None:
+            page = paginate_questions(request, total=questionStats.total())
+        questions, totalQuestions, nextCursor = page
+        currentQuestions = question_fragments(questions)
 
         if len(currentQuestions) == 0:
             abort(404)
 
         categories = generate_categories()
 
-        # generate the current category
-        currentCategory = categories[currentQuestions[0]['category']]
+        currentCategory = current_category(
+            [question.category for question in questions], categories)
 
         return jsonify({
             'success': True,
             'questions': currentQuestions,
-            'totalQuestions': len(currentQuestions),
+            'totalQuestions': totalQuestions,
             'categories': categories,
-            'currentCategory': currentCategory
+            'currentCategory': currentCategory,
+            'nextCursor': nextCursor
+        })
+
+    @app.route("/questions/bulk", methods=["POST"])
+    def bulk_import_questions():
+        report = import_questions(read_request(request))
+
+        return jsonify({
+            'success': True,
+            **report.format()
+        })
+
+    @app.route("/questions", methods=["DELETE"])
+    def delete_questions_in_batch():
+        ids, where = read_selection(request.get_json(silent=True))
+        deleted = delete_questions(ids, where)
+
+        return jsonify({
+            'success': True,
+            'deleted': deleted
+        })
+
+    @app.route("/questions", methods=["PATCH"])
+    def update_questions_in_batch():
+        body = request.get_json(silent=True)
+        ids, where = read_selection(body)
+        values = read_changes(body, generate_categories())
+        updated = update_questions(ids, where, values)
+
+        return jsonify({
+            'success': True,
+            'updated': updated
+        })
+
+    @app.route("/questions/export", methods=["GET"])
+    @read_only
+    def export_question_bank():
+        format = request.args.get("format", "ndjson")
+        if format not in EXPORT_MIMETYPES:
+            abort(400)
+        category = integer_filter(request.args, "category")
+        difficulty = integer_filter(request.args, "difficulty")
+
+        response = Response(
+            stream_with_context(export_questions(format, category, difficulty)),
+            mimetype=EXPORT_MIMETYPES[format])
+        response.headers['Content-Disposition'] = \
+            'attachment; filename="questions.{}"'.format(
+                'csv' if format == 'csv' else 'jsonl')
+        return response
+
+    @app.route("/questions/suggest", methods=["GET"])
+    def suggest_questions_as_you_type():
+        query = request.args.get("q", "")
+        limit = request.args.get("limit", 10, type=int)
+        if limit < 1 or limit > MAX_SUGGESTIONS:
+            abort(400)
+
+        return jsonify({
+            'success': True,
+            'suggestions': suggest_questions(query, limit)
         })
 
     """
@@ -124,17 +406,22 @@ def create_app(test_config=None):
 
     # get books from a particular id
     @app.route("/categories/<int:category_id>/questions", methods=["GET"])
+    @cached_response
+    @read_only
     def get_paginated_books_by_categories(category_id):
-        # generate the current category
-        currentCategory = Category.query.filter(
-            Category.id == category_id).with_entities(Category.type).one_or_none()
+        # generate the current category from the cached categories
+        currentCategory = generate_categories().get(category_id, None)
 
         if currentCategory is None:
             abort(404)
 
-        allQuestions = Question.query.filter(
-            Question.category == category_id).order_by(Question.category).all()
-        currentQuestions = paginateQuestions(request, allQuestions)
+        page = paginate_snapshot(current_snapshot(), request, category_id)
+        if page is None:
+            page = paginate_questions(
+                request, Question.category == category_id,
+                total=questionStats.total(category_id))
+        questions, totalQuestions, nextCursor = page
+        currentQuestions = question_fragments(questions)
 
         if len(currentQuestions) == 0:
             abort(404)
@@ -143,8 +430,9 @@ def create_app(test_config=None):
         return jsonify({
             'success': True,
             'questions': currentQuestions,
-            'totalQuestions': len(currentQuestions),
-            'currentCategory': currentCategory[0]
+            'totalQuestions': totalQuestions,
+            'currentCategory': currentCategory,
+            'nextCursor': nextCursor
         })
 
     """
@@ -193,24 +481,37 @@ def create_app(test_config=None):
     def add_new_question_and_search():
         try:
             body = request.get_json()
-            print("Body of search:", body)
+            log_payload(logger, "questions request", body)
             search = body.get("searchTerm", None)
-            print('search: ', search)
-            print("testing search: ", search == None)
             if search != None:
-                matchingQuestions = Question.query.filter(
-                    Question.question.ilike("%{}%".format(search))).all()
+                if not isinstance(search, str):
+                    abort(400)
+                page = request.args.get("page", 1, type=int)
+                category = request.args.get("category", None, type=int)
+                if page < 1:
+                    abort(404)
+
+                # the same search of concurrent clients runs once; the data
+                # version keeps a search started before a change from being
+                # shared with the requests that follow it, and clients that
+                # read from the primary only share with each other
+                matchingQuestions, totalQuestions = coalesced(
+                    ('search', responseCache.version(), reads_own_writes(request),
+                     search, category, page),
+                    lambda: search_questions(
+                        search, category,
+                        offset=(page - 1) * QUESTIONS_PER_PAGE,
+                        limit=QUESTIONS_PER_PAGE))
                 if len(matchingQuestions) == 0:
                     abort(404)
 
-                finalQuestions = [question.format()
-                                  for question in matchingQuestions]
-                print("Final Questions: ", finalQuestions)
+                log_payload(logger, "search results", lambda: [
+                    question.id for question in matchingQuestions])
                 return jsonify({
                     'success': True,
-                    'questions': finalQuestions,
-                    'totalQuestions': len(finalQuestions),
-                    'currentCategory': finalQuestions[0]['category']
+                    'questions': question_fragments(matchingQuestions),
+                    'totalQuestions': totalQuestions,
+                    'currentCategory': matchingQuestions[0].category
                 })
 
             else:
@@ -218,7 +519,6 @@ def create_app(test_config=None):
                 # send a 460 error code (looked through the error codes at
                 # developer.mozilla.org and chose one that is not used)
                 new_question = body.get("question", None)
-                print(new_question)
                 if new_question is None:
                     abort(404)
 
@@ -234,24 +534,38 @@ def create_app(test_config=None):
                 if new_category is None:
                     abort(404)
 
-                if Question.query.filter(Question.question == new_question).one_or_none() != None:
+                # the same checks as the bulk import: a category that is
+                # not an existing one, or a difficulty that is not 1 to 5,
+                # is refused before anything is written (SQLite does not
+                # check the foreign key)
+                values, error = validate(body, generate_categories())
+                if values is None:
+                    abort(400)
+
+                if question_exists(values['question']):
                     abort(404)
 
                 newQuestion = Question(
-                    question=new_question,
-                    answer=new_answer,
-                    difficulty=new_difficulty,
-                    category=new_category
+                    question=values['question'],
+                    answer=values['answer'],
+                    difficulty=values['difficulty'],
+                    category=values['category']
                 )
 
                 # print(newQuestion.format())
-                newQuestion.insert()
+                try:
+                    newQuestion.insert()
+                except exc.IntegrityError:
+                    # added by someone else since the check above, or its
+                    # category deleted since
+                    db.session.rollback()
+                    abort(404)
 
                 return jsonify({
                     'success': True,
                 })
         except (RuntimeError, TypeError, NameError) as error:
-            print("Exception Error:", error)
+            logger.warning("could not search or add questions: %r", error)
             abort(404)
     """
     @TODO:
@@ -264,46 +578,100 @@ def create_app(test_config=None):
     one question at a time is displayed, the user is allowed to answer
     and shown whether they were correct or not.
     """
+    @app.route("/quizzes/sessions", methods=['POST'])
+    def start_quiz_session():
+        body = request.get_json()
+        if body is None:
+            abort(400)
+
+        categoryId = quiz_category_id(body.get("quiz_category", None))
+        token = quizSessions.create(categoryId)
+
+        return jsonify({
+            'success': True,
+            'token': token
+        })
+
     @app.route("/quizzes", methods=['POST'])
+    @read_only
     def get_question_for_quiz():
 
         body = request.get_json()
-        previousQuestions = body.get("previous_questions", None)
-        # print("\nprevious questions: ", previousQuestions)
-        if previousQuestions is None:
+        if body is None:
             abort(400)
 
-        quiz_category = body.get("quiz_category", None)
-        # print("\Quiz category: ", quiz_category)
-        if quiz_category is None:
-            abort(400)
+        # quizzes started through /quizzes/sessions only send their token
+        token = body.get("token", None)
+        if token is not None:
+            quizSession = quizSessions.load(token)
+            if quizSession is None:
+                abort(404)
+            categoryId, previousQuestions = quizSession
+            seen = set(previousQuestions)
 
-        print(quiz_category)
+        else:
+            previousQuestions = body.get("previous_questions", None)
+            # print("\nprevious questions: ", previousQuestions)
+            if previousQuestions is None:
+                abort(400)
+
+            quiz_category = body.get("quiz_category", None)
+            # print("\Quiz category: ", quiz_category)
+            log_payload(logger, "quiz request", body)
+            categoryId = quiz_category_id(quiz_category)
+
+            try:
+                seen = set(int(question_id) for question_id in previousQuestions)
+            except (TypeError, ValueError):
+                abort(400)
+
+        count = quiz_batch_size(body)
+        if count is not None:
+            return get_questions_for_quiz(categoryId, previousQuestions, seen, count, token)
+
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            nextQuestion = snapshot.draw(categoryId, seen)
+        else:
+            nextQuestion = next_quiz_question(categoryId, seen)
 
-        categoryId = quiz_category['id']
-        if categoryId is None:
-            abort(400)
+        if nextQuestion == None:
+            return jsonify({
+                'success': False,
+                'message': "End of questions"
+            })
 
-        # The frontend sends quiz_category as {'type'='click', 'id'=0}
-        # whenever it wast all questions so I am using this if-else statement
-        # to cater for that
-        if categoryId == 0:
-            nextQuestion = Question.query.filter(~Question.id.in_(
-                previousQuestions)).first()
+        if token is not None:
+            quizSessions.add_seen(token, nextQuestion.id)
 
+        return jsonify({
+            'success': True,
+            'question': question_fragment(nextQuestion)
+        })
+
+    def get_questions_for_quiz(categoryId, previousQuestions, seen, count, token):
+        # the next count questions at once, so the client can play them
+        # from a local buffer
+        snapshot = current_snapshot()
+        if snapshot is not None:
+            nextQuestions = snapshot.draw_many(categoryId, seen, count)
         else:
-            nextQuestion = Question.query.filter(~Question.id.in_(
-                previousQuestions), Question.category == categoryId).first()
+            nextQuestions = next_quiz_questions(categoryId, seen, count)
 
-        if nextQuestion == None:
+        if not nextQuestions:
             return jsonify({
                 'success': False,
                 'message': "End of questions"
             })
 
+        nextIds = [question.id for question in nextQuestions]
+        if token is not None:
+            quizSessions.add_seen_many(token, nextIds)
+
         return jsonify({
             'success': True,
-            'question': nextQuestion.format()
+            'questions': question_fragments(nextQuestions),
+            'previous_questions': [int(question_id) for question_id in previousQuestions] + nextIds
         })
     """
     Create error handlers for all expected errors
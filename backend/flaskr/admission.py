@@ -0,0 +1,315 @@
+"""
+Admission control: per-client rate limits and per-route concurrency caps.
+
+Every request is admitted, queued or shed before it reaches its view:
+
+- each client, by address or by ADMISSION_CLIENT_HEADER (see client()),
+  has a token bucket of ADMISSION_BURST tokens refilled at ADMISSION_RATE
+  tokens per second; a request takes one token, a low-priority one
+  ADMISSION_LOW_PRIORITY_COST, and a client without enough gets a 429;
+- at most ADMISSION_MAX_CONCURRENCY requests run at once in a worker, at
+  most ADMISSION_LOW_PRIORITY_CONCURRENCY of them low-priority, and at most
+  the limit given in ADMISSION_ROUTE_LIMITS for a route, e.g.
+  "search=4,POST /questions/bulk=1". A request over a cap waits for a slot
+  for up to ADMISSION_QUEUE_TIMEOUT seconds, then gets a 503.
+
+Searches, bulk imports, batch changes and exports are low-priority: they
+are the requests that scan or write many rows, and capping them leaves
+connections for the cheap reads such as GET /categories. A low-priority
+request also lets any waiting normal request go first.
+
+Both responses carry a Retry-After header. GET /healthz and GET /metrics
+are never limited. The buckets are kept by a backend picked with
+ADMISSION_BACKEND: "memory" (per worker) or a "module:ClassName" with the
+same take() method, for limits shared by all workers, e.g. over Redis. The
+concurrency caps are always per worker.
+
+Everything is off until ADMISSION_RATE or one of the caps is set.
+"""
+
+import importlib
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from flask import g, jsonify, request
+
+from .instrumentation import route_name
+
+LOW_PRIORITY_ROUTES = {
+    "POST /questions/bulk",
+    "DELETE /questions",
+    "PATCH /questions",
+    "GET /questions/export",
+}
+
+# never limited: the health checks of a load balancer and the metrics
+# scraper must get through when the API is busiest
+EXEMPT_ROUTES = {
+    "GET /healthz",
+    "GET /metrics",
+}
+
+MESSAGES = {
+    429: "too many requests",
+    503: "service unavailable",
+}
+
+
+class MemoryRateLimitBackend:
+    def __init__(self, size=100000):
+        self.size = size
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst, cost=1):
+        """
+        Takes cost tokens from the bucket of key; returns 0 when they were
+        taken, otherwise the seconds until the bucket will have them.
+        """
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # the least recently seen clients have full buckets by now
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+BACKENDS = {
+    'memory': MemoryRateLimitBackend,
+}
+
+
+def load_backend(name):
+    if name in BACKENDS:
+        return BACKENDS[name]
+    module_name, _, class_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def parse_limits(limits):
+    # "search=4,POST /questions/bulk=1" -> {route: limit}
+    parsed = {}
+    for item in (limits or "").split(","):
+        route, _, limit = item.rpartition("=")
+        if route.strip() and limit.strip():
+            parsed[route.strip()] = int(limit)
+    return parsed
+
+
+class ConcurrencyLimits:
+    def __init__(self, total=0, low_priority=0, routes=None):
+        # 0 is no limit
+        self.total = total
+        self.low_priority = low_priority
+        self.routes = routes or {}
+        self._condition = threading.Condition()
+        self._active = 0
+        self._active_low = 0
+        self._active_routes = Counter()
+        self._waiting = 0
+
+    def enabled(self):
+        return bool(self.total or self.low_priority or self.routes)
+
+    def _fits(self, route, low):
+        if self.total and self._active >= self.total:
+            return False
+        if low and (self._waiting or self.low_priority and self._active_low >= self.low_priority):
+            return False
+        limit = self.routes.get(route)
+        return not limit or self._active_routes[route] < limit
+
+    def acquire(self, route, low, timeout=0):
+        """
+        Takes a slot for a request of route, waiting up to timeout seconds
+        for one; returns whether it got one.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while not self._fits(route, low):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                # normal requests waiting keep the low-priority ones out
+                if not low:
+                    self._waiting += 1
+                try:
+                    self._condition.wait(remaining)
+                finally:
+                    if not low:
+                        self._waiting -= 1
+            self._active += 1
+            self._active_low += low
+            self._active_routes[route] += 1
+            return True
+
+    def release(self, route, low):
+        with self._condition:
+            self._active -= 1
+            self._active_low -= low
+            self._active_routes[route] -= 1
+            self._condition.notify_all()
+
+    def stats(self):
+        return {
+            'active': self._active,
+            'active_low_priority': self._active_low,
+            'waiting': self._waiting,
+            'routes': {route: count for route, count in self._active_routes.items() if count}
+        }
+
+
+class Admission:
+    def __init__(self, backend, rate=0, burst=20, low_priority_cost=5,
+                 limits=None, queue_timeout=1.0, client_header=None, trusted_proxies=1):
+        self.backend = backend
+        self.rate = rate
+        self.burst = burst
+        self.low_priority_cost = low_priority_cost
+        self.limits = limits or ConcurrencyLimits()
+        self.queue_timeout = queue_timeout
+        self.client_header = client_header
+        self.trusted_proxies = trusted_proxies
+        self._lock = threading.Lock()
+        self.admitted = 0
+        self.queued = 0
+        self.rate_limited = 0
+        self.shed = 0
+
+    def enabled(self):
+        return bool(self.rate) or self.limits.enabled()
+
+    def client(self, request):
+        """
+        The address of the connection, or with ADMISSION_CLIENT_HEADER the
+        address the outermost of ADMISSION_TRUSTED_PROXIES proxies appended
+        to that header. Entries left of it were sent by the client and could
+        be anything, so they are never used.
+        """
+        if self.client_header and self.trusted_proxies > 0:
+            forwarded = [address.strip() for address in
+                         request.headers.get(self.client_header, "").split(",")]
+            if len(forwarded) >= self.trusted_proxies and forwarded[-self.trusted_proxies]:
+                return forwarded[-self.trusted_proxies]
+        return request.remote_addr or "-"
+
+    def admit(self, client, route, low, timeout=None):
+        """
+        Returns None when the request may run, after taking a slot that
+        release() gives back, or (status, seconds to retry after) when it
+        is shed.
+        """
+        if self.rate:
+            cost = self.low_priority_cost if low else 1
+            wait = self.backend.take(client, self.rate, self.burst, cost)
+            if wait:
+                self.record('rate_limited')
+                return 429, wait
+
+        timeout = self.queue_timeout if timeout is None else timeout
+        if not self.limits.acquire(route, low):
+            if not timeout or not self.limits.acquire(route, low, timeout):
+                self.record('shed')
+                return 503, max(timeout, 1)
+            self.record('queued')
+        self.record('admitted')
+        return None
+
+    def release(self, route, low):
+        self.limits.release(route, low)
+
+    def record(self, outcome):
+        # outcome is 'admitted', 'queued', 'rate_limited' or 'shed'
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        stats = {
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rate_limited': self.rate_limited,
+            'shed': self.shed,
+        }
+        stats.update(self.limits.stats())
+        if isinstance(self.backend, MemoryRateLimitBackend):
+            stats['clients'] = len(self.backend)
+        return stats
+
+
+def classify(request):
+    """
+    Returns (route, low priority) of a Flask request. A POST /questions with
+    a searchTerm is the route "search".
+    """
+    route = route_name(request)
+    if route == "POST /questions":
+        body = request.get_json(silent=True)
+        if isinstance(body, dict) and body.get("searchTerm") is not None:
+            return "search", True
+    return route, route in LOW_PRIORITY_ROUTES
+
+
+def retry_after(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+def init_admission(app):
+    """
+    Admits the requests of the app when rate limits or concurrency caps are
+    set; returns the Admission, or None.
+    """
+    config = app.config
+    backend = load_backend(config.get("ADMISSION_BACKEND", "memory"))
+    admission = Admission(
+        backend(),
+        rate=config.get("ADMISSION_RATE", 0),
+        burst=config.get("ADMISSION_BURST", 20),
+        low_priority_cost=config.get("ADMISSION_LOW_PRIORITY_COST", 5),
+        limits=ConcurrencyLimits(
+            total=config.get("ADMISSION_MAX_CONCURRENCY", 0),
+            low_priority=config.get("ADMISSION_LOW_PRIORITY_CONCURRENCY", 0),
+            routes=parse_limits(config.get("ADMISSION_ROUTE_LIMITS"))),
+        queue_timeout=config.get("ADMISSION_QUEUE_TIMEOUT", 1.0),
+        client_header=config.get("ADMISSION_CLIENT_HEADER"),
+        trusted_proxies=config.get("ADMISSION_TRUSTED_PROXIES", 1)
+    )
+    if not admission.enabled():
+        return None
+    app.extensions['admission'] = admission
+
+    @app.before_request
+    def admit_request():
+        route, low = classify(request)
+        if route in EXEMPT_ROUTES:
+            return
+        shed = admission.admit(admission.client(request), route, low)
+        if shed is not None:
+            status, seconds = shed
+            response = jsonify({"success": False, "error": status, "message": MESSAGES[status]})
+            response.status_code = status
+            response.headers["Retry-After"] = retry_after(seconds)
+            return response
+        g.admitted = (route, low)
+
+    @app.teardown_request
+    def release_request(error):
+        # runs once a streamed response is sent, and when a view fails
+        admitted = g.pop('admitted', None)
+        if admitted is not None:
+            admission.release(*admitted)
+
+    return admission
@@ -0,0 +1,606 @@
+"""
+ASGI entry point of the API.
+
+    uvicorn --factory flaskr.asgi:create_asgi_app
+
+The read paths that carry the traffic of a quiz, GET /categories,
+GET /questions, GET /categories/<id>/questions, POST /quizzes and the search
+of POST /questions, are answered by async handlers, so thousands of players
+waiting on the database only cost coroutines, not threads. They return the
+same JSON, status codes and error bodies as the Flask views, and share the
+in-memory indexes and caches of the Flask app built by create_app().
+
+Queries go through an async driver when the `databases` package is
+installed (asyncpg for Postgres, aiosqlite for SQLite); otherwise they run
+on a bounded pool of ASGI_THREADS threads over the regular engine. Work that
+still needs the sync engine or takes a lock (loading an index, drawing a
+quiz question, a categories cache miss) runs on that pool too. Totals come
+from the question counts of flaskr/stats.py, as in the Flask views.
+
+The handlers query the primary database. When the app has read replicas
+(DATABASE_REPLICA_URL) or a question snapshot (QUESTION_SNAPSHOT_PATH), the
+reads of questions are handed to the Flask app instead, which serves them
+from there; only GET /categories stays async.
+
+Every other request, writes included, is handed to the Flask app on the
+thread pool, so the whole API is served from this entry point.
+
+The admission control of the Flask app (see flaskr/admission.py) applies
+to the async handlers too, except that a request over a concurrency cap is
+shed at once instead of waiting for a slot.
+"""
+
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import Request
+from sqlalchemy import select
+from sqlalchemy.engine.url import make_url
+from werkzeug.exceptions import BadRequest, HTTPException
+from werkzeug.routing import Map, Rule
+
+from models import db, Question
+
+from . import create_app, current_category, quiz_category_id
+from .admission import retry_after
+from .pagination import QUESTIONS_PER_PAGE, encode_cursor, page_window
+from .routing import reads_own_writes
+from .search import PostgresSearchBackend
+
+try:
+    import databases
+except ImportError:
+    databases = None
+
+ERROR_MESSAGES = {
+    400: "bad request",
+    404: "resource not found",
+    405: "method not allowed",
+    422: "unprocessable",
+    429: "too many requests",
+    500: "server error",
+    503: "service unavailable",
+}
+
+# the headers added by the after_request hook of create_app
+CORS_HEADERS = [
+    (b"access-control-allow-headers", b"Content-Type,Authorization,true"),
+    (b"access-control-allow-methods", b"GET,POST,PATCH,DELETE"),
+    (b"access-control-allow-origin", b"http://localhost:3000"),
+    (b"access-control-allow-credentials", b"true"),
+]
+
+URLS = Map([
+    Rule("/categories", methods=["GET"], endpoint="categories"),
+    Rule("/questions", methods=["GET"], endpoint="questions"),
+    Rule("/questions", methods=["POST"], endpoint="search"),
+    Rule("/categories/<int:category_id>/questions", methods=["GET"], endpoint="category_questions"),
+    Rule("/quizzes", methods=["POST"], endpoint="quiz"),
+])
+
+# the routes of flaskr.admission, except for searches
+ROUTES = {
+    "categories": "GET /categories",
+    "questions": "GET /questions",
+    "category_questions": "GET /categories/<int:category_id>/questions",
+    "quiz": "POST /quizzes",
+}
+
+# endpoints whose responses go through the response cache
+CACHED = {"categories", "questions", "category_questions"}
+
+# returned by a handler to let the Flask app answer the request
+FALLBACK = object()
+
+question_table = Question.__table__
+
+
+class ThreadedDatabase:
+    """
+    Runs the queries on the sync engine in the thread pool.
+    """
+
+    def __init__(self, engine, executor):
+        self.engine = engine
+        self.executor = executor
+
+    async def connect(self):
+        pass
+
+    async def disconnect(self):
+        pass
+
+    async def _run(self, function):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function)
+
+    async def fetch_all(self, query):
+        return await self._run(lambda: self.engine.execute(query).fetchall())
+
+    async def fetch_val(self, query):
+        return await self._run(lambda: self.engine.execute(query).scalar())
+
+
+class AsyncDriverDatabase:
+    """
+    Runs the queries on the async driver of the `databases` package.
+    """
+
+    def __init__(self, url):
+        self.database = databases.Database(url)
+
+    async def connect(self):
+        await self.database.connect()
+
+    async def disconnect(self):
+        await self.database.disconnect()
+
+    async def fetch_all(self, query):
+        return await self.database.fetch_all(query)
+
+    async def fetch_val(self, query):
+        return await self.database.fetch_val(query)
+
+
+def async_database_url(engine):
+    # postgresql+psycopg2://... -> postgresql://..., databases picks the driver
+    url = make_url(str(engine.url))
+    url.drivername = url.drivername.split("+")[0]
+    return str(url)
+
+
+def format_row(row):
+    return {
+        'id': row['id'],
+        'question': row['question'],
+        'answer': row['answer'],
+        'category': row['category'],
+        'difficulty': row['difficulty']
+    }
+
+
+def get_json(request):
+    # request.get_json() without the app context it needs to report errors
+    if not request.is_json:
+        return None
+    try:
+        return json.loads(request.get_data(cache=True).decode("utf-8"))
+    except ValueError:
+        raise BadRequest()
+
+
+def build_environ(scope, body):
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    environ = {
+        'REQUEST_METHOD': scope["method"],
+        'SCRIPT_NAME': scope.get("root_path", "").encode("utf-8").decode("latin-1"),
+        'PATH_INFO': scope["path"].encode("utf-8").decode("latin-1"),
+        'QUERY_STRING': scope.get("query_string", b"").decode("latin-1"),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': "HTTP/" + scope.get("http_version", "1.1"),
+        'REMOTE_ADDR': client[0],
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get("scheme", "http"),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = "HTTP_" + name
+        environ[key] = environ[key] + "," + value if key in environ else value
+    return environ
+
+
+class AsgiApp:
+    def __init__(self, app):
+        self.app = app
+        self.executor = ThreadPoolExecutor(
+            max_workers=app.config.get("ASGI_THREADS", 16), thread_name_prefix="asgi")
+
+        with app.app_context():
+            engine = db.get_engine(app)
+        backend = app.config.get("ASGI_DB_BACKEND", "auto")
+        if backend == "auto":
+            backend = "databases" if databases is not None else "threads"
+        if backend == "databases":
+            self.database = AsyncDriverDatabase(async_database_url(engine))
+        else:
+            self.database = ThreadedDatabase(engine, self.executor)
+        self._connected = False
+        # the snapshot and the read replicas are only read by the Flask app
+        self.flask_reads = (app.extensions.get('question_snapshot') is not None
+                            or bool(app.extensions['replicas'].binds))
+
+        # jsonify() of the Flask app, without an app context per request
+        pretty = app.config["JSONIFY_PRETTYPRINT_REGULAR"] or app.debug
+        self._json = {
+            'cls': app.json_encoder,
+            'sort_keys': app.config["JSON_SORT_KEYS"],
+            'ensure_ascii': app.config["JSON_AS_ASCII"],
+            'indent': 2 if pretty else None,
+            'separators': (", ", ": ") if pretty else (",", ":"),
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self.lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.connect()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.database.disconnect()
+                self.executor.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def connect(self):
+        if not self._connected:
+            await self.database.connect()
+            self._connected = True
+
+    async def run_in_app(self, function, *args):
+        """
+        Runs a sync function that needs the app context on the thread pool.
+        """
+        def run():
+            with self.app.app_context():
+                return function(*args)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, run)
+
+    def render(self, payload, status=200, headers=None):
+        body = (json.dumps(payload, **self._json) + "\n").encode("utf-8")
+        return status, [(b"content-type", b"application/json")] + (headers or []), body
+
+    def render_error(self, code):
+        return self.render({"success": False, "error": code,
+                            "message": ERROR_MESSAGES[code]}, code)
+
+    async def http(self, scope, receive, send):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body", False):
+                break
+
+        environ = build_environ(scope, body)
+        urls = URLS.bind_to_environ(environ)
+        try:
+            endpoint, arguments = urls.match()
+        except HTTPException:
+            endpoint = None
+
+        response = FALLBACK
+        if endpoint is not None:
+            await self.connect()
+            response = await self.dispatch(endpoint, arguments, Request(environ))
+        if response is FALLBACK:
+            # the handler may have read the body of this environ
+            await self.call_flask(build_environ(scope, body), send)
+            return
+
+        status, headers, content = response
+        await send({"type": "http.response.start", "status": status,
+                    "headers": headers + [(b"content-length", str(len(content)).encode())]
+                    + CORS_HEADERS})
+        await send({"type": "http.response.body", "body": content})
+
+    def answers(self, endpoint, request):
+        """
+        Whether the async handler of endpoint answers the request, rather
+        than the Flask app: writes, session and batch quizzes, and every
+        read of the question tables when the Flask app reads them from the
+        snapshot or the replicas, are handed to it.
+        """
+        if endpoint == "categories":
+            return True
+        if self.flask_reads:
+            return False
+        if endpoint not in ("search", "quiz"):
+            return True
+        try:
+            body = get_json(request)
+        except BadRequest:
+            # the handler answers the 400
+            return True
+        if not isinstance(body, dict):
+            return True
+        if endpoint == "search":
+            return body.get("searchTerm", None) is not None
+        return body.get("token", None) is None and "count" not in body
+
+    def admit(self, endpoint, request):
+        """
+        Returns ((route, low priority) of an admitted request or None when
+        admission is off, the 429 or 503 of a shed request or None).
+        Requests over a concurrency cap are shed straight away: waiting for
+        a slot here would hold up the event loop.
+        """
+        admission = self.app.extensions.get('admission')
+        if admission is None:
+            return None, None
+        if endpoint == "search":
+            route, low = "search", True
+        else:
+            route, low = ROUTES[endpoint], False
+
+        shed = admission.admit(admission.client(request), route, low, timeout=0)
+        if shed is None:
+            return (route, low), None
+        status, seconds = shed
+        return None, self.render(
+            {"success": False, "error": status, "message": ERROR_MESSAGES[status]},
+            status, [(b"retry-after", retry_after(seconds).encode())])
+
+    async def dispatch(self, endpoint, arguments, request):
+        if not self.answers(endpoint, request):
+            # admitted by the Flask app
+            return FALLBACK
+        admitted, shed = self.admit(endpoint, request)
+        if shed is not None:
+            return shed
+        if admitted is None:
+            return await self.respond(endpoint, arguments, request)
+        try:
+            return await self.respond(endpoint, arguments, request)
+        finally:
+            self.app.extensions['admission'].release(*admitted)
+
+    async def respond(self, endpoint, arguments, request):
+        handler = getattr(self, endpoint)
+        try:
+            if endpoint not in CACHED or reads_own_writes(request, self.app):
+                return await handler(request, **arguments)
+
+            # the same conditional GET as flaskr.response_cache.cached_response
+            cache = self.app.extensions['response_cache']
+            etag, headers, cached = cache.lookup(request)
+            if cached is not None:
+                return cached.status_code, [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in cached.headers.items()
+                    if name.lower() != "content-length"], cached.get_data()
+
+            # concurrent misses of the same ETag run the handler once, see
+            # flaskr/single_flight.py
+            rendered = []
+
+            async def render():
+                response = await handler(request, **arguments)
+                if response[0] != 200:
+                    rendered.append(response)
+                    return None
+                cache.store(etag, response[2])
+                return response
+
+            singleFlight = self.app.extensions['single_flight']
+            if singleFlight.timeout:
+                response = await singleFlight.do_async(etag, render)
+            else:
+                response = await render()
+            status, headers_, content = response or rendered[0]
+            if status == 200:
+                headers_ = headers_ + [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                       for name, value in headers.items()]
+            return status, headers_, content
+        except HTTPException as error:
+            code = error.code if error.code in ERROR_MESSAGES else 500
+            return self.render_error(code)
+        except Exception:
+            self.app.logger.exception("Exception on %s [%s]", request.path, request.method)
+            return self.render_error(500)
+
+    async def call_flask(self, environ, send):
+        """
+        Serves the request with the Flask app on the thread pool, streaming
+        the body back as the app produces it.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = asyncio.Queue(maxsize=16)
+
+        def put(item):
+            asyncio.run_coroutine_threadsafe(chunks.put(item), loop).result()
+
+        def run():
+            try:
+                def start_response(status, headers, exc_info=None):
+                    put(("start", status, headers))
+
+                result = self.app(environ, start_response)
+                try:
+                    for chunk in result:
+                        if chunk:
+                            put(("body", chunk))
+                finally:
+                    if hasattr(result, "close"):
+                        result.close()
+            finally:
+                put(("end",))
+
+        future = loop.run_in_executor(self.executor, run)
+        while True:
+            item = await chunks.get()
+            if item[0] == "start":
+                _, status, headers = item
+                await send({
+                    "type": "http.response.start",
+                    "status": int(status.split(" ", 1)[0]),
+                    "headers": [(name.lower().encode("latin-1"), value.encode("latin-1"))
+                                for name, value in headers],
+                })
+            elif item[0] == "body":
+                await send({"type": "http.response.body", "body": item[1], "more_body": True})
+            else:
+                await send({"type": "http.response.body", "body": b""})
+                break
+        await future
+
+    async def categories_dict(self):
+        cache = self.app.extensions['categories_cache']
+        categories = cache.peek()
+        if categories is None:
+            categories = await self.run_in_app(cache.get)
+        return categories
+
+    async def page(self, request, category=None):
+        after, offset = page_window(request.args)
+
+        query = select([question_table])
+        if category is not None:
+            query = query.where(question_table.c.category == category)
+        if after is not None:
+            query = query.where(after)
+        query = query.order_by(question_table.c.category.nullsfirst(), question_table.c.id) \
+            .offset(offset).limit(QUESTIONS_PER_PAGE)
+
+        # the counts kept by flaskr/stats.py, like the Flask views
+        stats = self.app.extensions['question_stats']
+        totalQuestions = stats.peek(category)
+        if totalQuestions is None:
+            totalQuestions = await self.run_in_app(stats.total, category)
+        currentQuestions = [format_row(row) for row in await self.database.fetch_all(query)]
+
+        nextCursor = None
+        if len(currentQuestions) == QUESTIONS_PER_PAGE:
+            nextCursor = encode_cursor(currentQuestions[-1]['category'], currentQuestions[-1]['id'])
+        return currentQuestions, totalQuestions, nextCursor
+
+    async def categories(self, request):
+        return self.render({
+            'success': True,
+            'categories': await self.categories_dict()
+        })
+
+    async def questions(self, request):
+        currentQuestions, totalQuestions, nextCursor = await self.page(request)
+        if len(currentQuestions) == 0:
+            return self.render_error(404)
+
+        categories = await self.categories_dict()
+        return self.render({
+            'success': True,
+            'questions': currentQuestions,
+            'totalQuestions': totalQuestions,
+            'categories': categories,
+            'currentCategory': current_category(
+                [question['category'] for question in currentQuestions], categories),
+            'nextCursor': nextCursor
+        })
+
+    async def category_questions(self, request, category_id):
+        category = await self.categories_dict()
+        if category_id not in category:
+            return self.render_error(404)
+
+        currentQuestions, totalQuestions, nextCursor = await self.page(request, category_id)
+        if len(currentQuestions) == 0:
+            return self.render_error(404)
+
+        return self.render({
+            'success': True,
+            'questions': currentQuestions,
+            'totalQuestions': totalQuestions,
+            'currentCategory': category[category_id],
+            'nextCursor': nextCursor
+        })
+
+    async def search(self, request):
+        body = get_json(request)
+        search = body.get("searchTerm", None)
+        if search is None:
+            # adding a question, a write
+            return FALLBACK
+        if not isinstance(search, str):
+            return self.render_error(400)
+
+        page = request.args.get("page", 1, type=int)
+        category = request.args.get("category", None, type=int)
+        if page < 1:
+            return self.render_error(404)
+        offset = (page - 1) * QUESTIONS_PER_PAGE
+
+        backend = self.app.extensions['search']
+        if isinstance(backend, PostgresSearchBackend):
+            count, page = backend.queries(search, category, offset, QUESTIONS_PER_PAGE)
+            totalQuestions = await self.database.fetch_val(count)
+            ids = [row['id'] for row in await self.database.fetch_all(page)]
+        else:
+            # ranking in the in-memory index is CPU work, kept off the event loop
+            ids, totalQuestions = await self.run_in_app(
+                backend.search, search, category, offset, QUESTIONS_PER_PAGE)
+
+        rows = {}
+        if ids:
+            rows = {row['id']: format_row(row) for row in await self.database.fetch_all(
+                select([question_table]).where(question_table.c.id.in_(ids)))}
+        finalQuestions = [rows[question_id] for question_id in ids if question_id in rows]
+        if len(finalQuestions) == 0:
+            return self.render_error(404)
+
+        return self.render({
+            'success': True,
+            'questions': finalQuestions,
+            'totalQuestions': totalQuestions,
+            'currentCategory': finalQuestions[0]['category']
+        })
+
+    async def quiz(self, request):
+        body = get_json(request)
+        if body is None:
+            return self.render_error(400)
+        if body.get("token", None) is not None or "count" in body:
+            # see answers()
+            return FALLBACK
+
+        previousQuestions = body.get("previous_questions", None)
+        if previousQuestions is None:
+            return self.render_error(400)
+        categoryId = quiz_category_id(body.get("quiz_category", None))
+        try:
+            seen = set(int(question_id) for question_id in previousQuestions)
+        except (TypeError, ValueError):
+            return self.render_error(400)
+
+        index = self.app.extensions['quiz_index']
+        while True:
+            # draw() holds the lock of the index, kept off the event loop
+            question_id = await self.run_in_app(index.draw, categoryId, seen)
+            if question_id is None:
+                return self.render({
+                    'success': False,
+                    'message': "End of questions"
+                })
+
+            rows = await self.database.fetch_all(
+                select([question_table]).where(question_table.c.id == question_id))
+            if rows:
+                return self.render({
+                    'success': True,
+                    'question': format_row(rows[0])
+                })
+
+            # deleted by another worker since the index was built
+            index.invalidate()
+            seen = seen | {question_id}
+
+
+def create_asgi_app(test_config=None):
+    return AsgiApp(create_app(test_config))
@@ -0,0 +1,142 @@
+"""
+Batch changes of questions, used by DELETE /questions and PATCH /questions.
+
+A request picks the questions with a list of ids, a filter on category and
+difficulty, or both. The picked questions are read and locked, then changed
+CHUNK_SIZE at a time with one `DELETE ... WHERE id IN (...)` or
+`UPDATE ... WHERE id IN (...)` per chunk, all in one transaction, so a batch
+changes every picked question or none of them. The question change hooks
+are called once per batch, after the commit.
+"""
+
+from flask import abort
+
+from models import db, notify_question_change, Question
+
+from .read_models import load_questions, select_questions
+
+CHUNK_SIZE = 1000
+
+# past this many changed questions the listeners reload from the table
+# instead of being handed every question
+MAX_NOTIFIED_QUESTIONS = 1000
+
+FIELDS = ('category', 'difficulty')
+
+
+def read_integers(values, fields):
+    if not isinstance(values, dict) or set(values) - set(fields):
+        abort(400)
+    try:
+        return {field: int(values[field]) for field in fields if field in values}
+    except (TypeError, ValueError):
+        abort(400)
+
+
+def read_selection(body):
+    """
+    Returns (sorted ids or None, where clauses) of the questions picked by
+    {"ids": [...]} and/or {"filter": {"category": 1, "difficulty": 2}}.
+    Aborts with 400 when the body picks nothing, so that a forgotten filter
+    never changes every question.
+    """
+    if not isinstance(body, dict):
+        abort(400)
+    ids = body.get("ids", None)
+    filter = read_integers(body.get("filter", {}), FIELDS)
+    if ids is None and not filter:
+        abort(400)
+
+    if ids is not None:
+        if not isinstance(ids, list):
+            abort(400)
+        try:
+            ids = sorted(set(int(question_id) for question_id in ids))
+        except (TypeError, ValueError):
+            abort(400)
+
+    where = [getattr(Question, field) == value for field, value in filter.items()]
+    return ids, where
+
+
+def read_changes(body, categories):
+    """
+    Returns the new values of {"set": {"category": 1, "difficulty": 2}};
+    aborts with 422 for an unknown category or a difficulty out of 1 to 5.
+    """
+    values = read_integers(body.get("set", None), FIELDS)
+    if not values:
+        abort(400)
+    if 'difficulty' in values and not 1 <= values['difficulty'] <= 5:
+        abort(422)
+    if 'category' in values and values['category'] not in categories:
+        abort(422)
+    return values
+
+
+def select_chunks(ids, where):
+    """
+    Yields the picked QuestionRows, CHUNK_SIZE at a time. They are locked
+    (SELECT ... FOR UPDATE on Postgres) until the commit, so they are still
+    what the statements change.
+    """
+    if ids is None:
+        rows = load_questions(
+            select_questions(*where).order_by(Question.id).with_for_update())
+        for start in range(0, len(rows), CHUNK_SIZE):
+            yield rows[start:start + CHUNK_SIZE]
+        return
+
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        yield load_questions(
+            select_questions(Question.id.in_(chunk), *where).with_for_update())
+
+
+def change_questions(statement, ids, where):
+    """
+    Runs statement, an UPDATE or DELETE of the questions table, on the
+    picked questions, one chunk at a time in one transaction; returns the
+    QuestionRows it changed, as they were before.
+    """
+    changed = []
+    try:
+        for rows in select_chunks(ids, where):
+            if not rows:
+                continue
+            db.session.execute(statement.where(Question.id.in_([row.id for row in rows])))
+            changed.extend(rows)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return changed
+
+
+def notify_batch(event, questions):
+    if len(questions) > MAX_NOTIFIED_QUESTIONS:
+        notify_question_change('reload', [])
+    elif questions:
+        notify_question_change(event, questions)
+
+
+def delete_questions(ids, where):
+    """
+    Deletes the picked questions; returns how many were deleted.
+    """
+    rows = change_questions(Question.__table__.delete(), ids, where)
+    notify_batch('delete', [row._asdict() for row in rows])
+    return len(rows)
+
+
+def update_questions(ids, where, values):
+    """
+    Sets the category and/or difficulty of the picked questions; returns
+    how many were updated.
+    """
+    rows = change_questions(Question.__table__.update().values(**values), ids, where)
+    # the listeners get each question before and after, so the indexes of
+    # the question text are left alone when only the category or the
+    # difficulty changed
+    notify_batch('update', [(row._asdict(), row._replace(**values)._asdict()) for row in rows])
+    return len(rows)
@@ -0,0 +1,256 @@
+"""
+Bulk import of questions, used by POST /questions/bulk and by the
+`flask import-questions` command.
+
+Rows are read one at a time from a JSON Lines or CSV stream and handled in
+chunks: every row of a chunk is validated, the duplicates are found with a
+single `question IN (...)` query, and the valid rows are written with one
+COPY (Postgres) or executemany (other databases) and committed together.
+A row that fails never stops the import; it is listed in the report with
+its line number and the reason.
+"""
+
+import csv
+import io
+import json
+
+import click
+from flask import abort
+
+from models import db, notify_question_change, Question, Category
+
+from .read_models import question_matches
+
+CHUNK_SIZE = 1000
+
+# rows listed in the report; the counters always cover every row
+MAX_REPORTED_ERRORS = 1000
+
+FIELDS = ('question', 'answer', 'difficulty', 'category')
+
+FORMATS = {
+    'jsonl': 'jsonl',
+    'ndjson': 'jsonl',
+    'json': 'jsonl',
+    'csv': 'csv',
+}
+
+MIMETYPES = {
+    'application/x-ndjson': 'jsonl',
+    'application/jsonl': 'jsonl',
+    'application/x-jsonlines': 'jsonl',
+    'text/csv': 'csv',
+}
+
+
+def read_jsonl(lines):
+    for number, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, None, "invalid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield number, None, "expected a JSON object"
+            continue
+        yield number, row, None
+
+
+def read_list(rows):
+    for number, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            yield number, None, "expected a JSON object"
+            continue
+        yield number, row, None
+
+
+def read_csv(lines):
+    # the header is line 1, so data rows start at line 2
+    for number, row in enumerate(csv.DictReader(lines), start=2):
+        yield number, row, None
+
+
+def read_rows(stream, format):
+    """
+    Yields (line number, row dict or None, parse error or None) from a text stream.
+    """
+    if format == 'csv':
+        return read_csv(stream)
+    return read_jsonl(stream)
+
+
+def validate(row, categories):
+    values = {}
+    for field in FIELDS:
+        if row.get(field) in (None, ''):
+            return None, "missing {}".format(field)
+
+    values['question'] = str(row['question']).strip()
+    values['answer'] = str(row['answer']).strip()
+    if not values['question'] or not values['answer']:
+        return None, "question and answer can not be blank"
+
+    try:
+        values['difficulty'] = int(row['difficulty'])
+        values['category'] = int(row['category'])
+    except (TypeError, ValueError):
+        return None, "difficulty and category must be integers"
+
+    if not 1 <= values['difficulty'] <= 5:
+        return None, "difficulty must be between 1 and 5"
+    if values['category'] not in categories:
+        return None, "unknown category {}".format(values['category'])
+
+    return values, None
+
+
+def insert_rows(rows):
+    connection = db.session.connection()
+    if connection.dialect.name == 'postgresql':
+        # COPY streams the whole chunk in one round-trip
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow([row[field] for field in FIELDS])
+        buffer.seek(0)
+        cursor = connection.connection.cursor()
+        cursor.copy_expert(
+            "COPY questions (question, answer, difficulty, category) "
+            "FROM STDIN WITH (FORMAT csv)", buffer)
+    else:
+        connection.execute(Question.__table__.insert(), rows)
+
+
+def read_request(request):
+    """
+    Rows of a POST /questions/bulk request: a JSON array, or a JSON Lines or
+    CSV body that is read line by line as it arrives.
+    """
+    if request.mimetype == 'application/json':
+        body = request.get_json()
+        if not isinstance(body, list):
+            abort(400)
+        return read_list(body)
+
+    format = FORMATS.get(request.args.get("format", ""), MIMETYPES.get(request.mimetype))
+    if format is None:
+        abort(400)
+    lines = (line.decode("utf-8") for line in request.stream)
+    return read_rows(lines, format)
+
+
+class ImportReport:
+    def __init__(self):
+        self.inserted = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.errors = []
+
+    def _report(self, number, message):
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'row': number, 'error': message})
+
+    def error(self, number, message):
+        self.failed += 1
+        self._report(number, message)
+
+    def duplicate(self, number, message):
+        self.duplicates += 1
+        self._report(number, message)
+
+    def format(self):
+        return {
+            'inserted': self.inserted,
+            'duplicates': self.duplicates,
+            'failed': self.failed,
+            'errors': self.errors
+        }
+
+
+def import_chunk(chunk, categories, seen, report):
+    valid = []
+    for number, row, error in chunk:
+        if error is None:
+            row, error = validate(row, categories)
+        if error is not None:
+            report.error(number, error)
+            continue
+        if row['question'] in seen:
+            report.duplicate(number, "duplicate question in the file")
+            continue
+        seen.add(row['question'])
+        valid.append((number, row))
+
+    if not valid:
+        return
+
+    # one set-based query finds every question of the chunk that already exists
+    existing = set(question for question, in db.session.query(Question.question).filter(
+        question_matches([row['question'] for _, row in valid])))
+
+    rows = []
+    for number, row in valid:
+        if row['question'] in existing:
+            report.duplicate(number, "question already in database")
+        else:
+            rows.append(row)
+
+    if rows:
+        insert_rows(rows)
+        db.session.commit()
+        report.inserted += len(rows)
+
+
+def import_questions(rows, chunk_size=CHUNK_SIZE):
+    """
+    Imports the (line number, row, parse error) tuples of read_rows() and
+    returns an ImportReport.
+    """
+    categories = set(category_id for category_id, in
+                     db.session.query(Category.id))
+    report = ImportReport()
+    seen = set()
+
+    try:
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                import_chunk(chunk, categories, seen, report)
+                chunk = []
+        if chunk:
+            import_chunk(chunk, categories, seen, report)
+    except Exception:
+        db.session.rollback()
+        raise
+    finally:
+        # ids of the new rows are not known, the indexes reload from the table
+        if report.inserted:
+            notify_question_change('reload', [])
+
+    return report
+
+
+def register_import_command(app):
+    @app.cli.command("import-questions")
+    @click.argument("path", type=click.Path(exists=True, dir_okay=False))
+    @click.option("--format", "format", type=click.Choice(sorted(FORMATS)),
+                  help="Defaults to the file extension.")
+    @click.option("--chunk-size", default=CHUNK_SIZE, show_default=True)
+    def import_questions_command(path, format, chunk_size):
+        """Import questions from a .jsonl or .csv file."""
+        if format is None:
+            format = path.rsplit(".", 1)[-1].lower()
+        if format not in FORMATS:
+            raise click.BadParameter("use --format jsonl or --format csv")
+
+        with open(path, newline="", encoding="utf-8") as stream:
+            report = import_questions(
+                read_rows(stream, FORMATS[format]), chunk_size)
+
+        for error in report.errors:
+            click.echo("line {row}: {error}".format(**error), err=True)
+        click.echo("{} inserted, {} duplicates, {} failed".format(
+            report.inserted, report.duplicates, report.failed))
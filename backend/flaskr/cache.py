@@ -0,0 +1,165 @@
+"""
+In-process cache for the categories.
+
+The categories are read on every /categories and /questions request but
+almost never change, so each app keeps one copy in memory. A copy is
+dropped when its TTL runs out, when invalidate() is called, when a commit
+touches the categories table, or, if a shared version file is configured,
+when another worker process bumps that file.
+"""
+
+import os
+import tempfile
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+from models import Category
+
+from .read_models import load_category_rows
+
+
+class SharedVersion:
+    """
+    A version stamp kept in a file so that every worker on the host can tell
+    that the cached data changed. Checking it costs one stat() call.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_mtime_ns)
+
+    def bump(self):
+        # replace the file instead of rewriting it so the inode always changes,
+        # even when two bumps land within the same mtime tick
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory)
+        os.close(fd)
+        os.replace(tmp_path, self.path)
+
+
+class CategoryCache:
+    def __init__(self, loader, ttl=300, shared_version=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.shared_version = shared_version
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._value = None
+        self._version = None
+        self._loaded_at = 0
+
+    def _current_version(self):
+        if self.shared_version is not None:
+            return self.shared_version.get()
+        return None
+
+    def _fresh(self, version):
+        return (self._value is not None and version == self._version
+                and time.monotonic() - self._loaded_at < self.ttl)
+
+    def peek(self):
+        """
+        The cached categories when they are fresh, None instead of loading them.
+        """
+        version = self._current_version()
+        with self._lock:
+            if self._fresh(version):
+                self.hits += 1
+                return self._value
+        return None
+
+    def get(self):
+        version = self._current_version()
+
+        # the lock is held while loading so that concurrent misses in this
+        # process run the query once
+        with self._lock:
+            if self._fresh(version):
+                self.hits += 1
+                return self._value
+
+            self.misses += 1
+            self._value = self.loader()
+            self._version = version
+            self._loaded_at = time.monotonic()
+            return self._value
+
+    def invalidate(self):
+        with self._lock:
+            self._value = None
+            self.invalidations += 1
+        if self.shared_version is not None:
+            self.shared_version.bump()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+            'ttl': self.ttl
+        }
+
+
+def load_categories():
+    all_categories = load_category_rows()
+
+    # The number of categories are few so there is no need to paginate them.
+    categories = {}
+    for category in all_categories:
+        categories[category.id] = category.type
+
+    return categories
+
+
+def init_categories_cache(app):
+    versionFile = app.config.get("CATEGORIES_CACHE_VERSION_FILE")
+    cache = CategoryCache(
+        load_categories,
+        ttl=app.config.get("CATEGORIES_CACHE_TTL", 300),
+        shared_version=SharedVersion(versionFile) if versionFile else None
+    )
+    app.extensions['categories_cache'] = cache
+    return cache
+
+
+def invalidate_categories():
+    if has_app_context():
+        cache = current_app.extensions.get('categories_cache')
+        if cache is not None:
+            cache.invalidate()
+        # the cached responses embed the categories too, see response_cache.py
+        responses = current_app.extensions.get('response_cache')
+        if responses is not None:
+            responses.bump()
+
+
+# drop the cached categories whenever a committed transaction changed them
+@event.listens_for(Session, "before_flush")
+def _track_category_changes(session, flush_context, instances):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Category):
+            session.info['categories_changed'] = True
+            return
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_commit(session):
+    if session.info.pop('categories_changed', False):
+        invalidate_categories()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_after_rollback(session):
+    session.info.pop('categories_changed', None)
@@ -0,0 +1,95 @@
+"""
+Streaming export of the question bank, used by GET /questions/export and
+by the `flask export-questions` command.
+
+Rows are read with yield_per, which on Postgres runs the query on a
+server-side cursor, and written out in batches as they come, so memory
+stays flat whatever the size of the table. The files use the same fields
+as the bulk import, so an export can be loaded into another environment
+with `flask import-questions`.
+"""
+
+import csv
+import io
+
+import click
+
+from models import db, Question
+
+from .serialize import encode_value
+
+BATCH_SIZE = 1000
+
+FIELDS = ('id', 'question', 'answer', 'difficulty', 'category')
+
+MIMETYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def export_rows(category=None, difficulty=None):
+    query = db.session.query(
+        Question.id, Question.question, Question.answer,
+        Question.difficulty, Question.category).order_by(Question.id)
+    if category is not None:
+        query = query.filter(Question.category == category)
+    if difficulty is not None:
+        query = query.filter(Question.difficulty == difficulty)
+    return query.yield_per(BATCH_SIZE)
+
+
+# json.dumps(dict(zip(FIELDS, row))) + "\n", without building the dict
+NDJSON_TEMPLATE = "{" + ", ".join('"{}": %s'.format(field) for field in FIELDS) + "}\n"
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield NDJSON_TEMPLATE % tuple(encode_value(value) for value in row)
+
+
+def csv_lines(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(FIELDS)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # the header when there are no rows
+    yield buffer.getvalue()
+
+
+def export_questions(format, category=None, difficulty=None):
+    """
+    Yields the export in chunks of BATCH_SIZE lines.
+    """
+    rows = export_rows(category, difficulty)
+    lines = csv_lines(rows) if format == 'csv' else ndjson_lines(rows)
+
+    batch = []
+    for line in lines:
+        batch.append(line)
+        if len(batch) == BATCH_SIZE:
+            yield "".join(batch)
+            batch = []
+    if batch:
+        yield "".join(batch)
+
+
+def register_export_command(app):
+    @app.cli.command("export-questions")
+    @click.argument("path", type=click.Path(dir_okay=False, writable=True))
+    @click.option("--format", "format", type=click.Choice(sorted(MIMETYPES)),
+                  help="Defaults to csv for .csv files, ndjson otherwise.")
+    @click.option("--category", type=int)
+    @click.option("--difficulty", type=int)
+    def export_questions_command(path, format, category, difficulty):
+        """Write the questions to a .jsonl or .csv file."""
+        if format is None:
+            format = 'csv' if path.lower().endswith(".csv") else 'ndjson'
+
+        with open(path, "w", newline="", encoding="utf-8") as stream:
+            for chunk in export_questions(format, category, difficulty):
+                stream.write(chunk)
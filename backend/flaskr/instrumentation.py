@@ -0,0 +1,185 @@
+"""
+Per-route timings: SQL statements, database time, JSON encoding time and
+total time of every request.
+
+Turned on with INSTRUMENTATION. Each response then gets a Server-Timing
+header, which the browser developer tools show next to the request, and
+GET /metrics gets the totals of each route under "routes".
+
+cProfile has to be running before the request starts to be of any use, so
+a share of the requests (INSTRUMENTATION_PROFILE_RATE) is profiled, and the
+profile of those that end up slower than INSTRUMENTATION_SLOW_MS is dumped
+into INSTRUMENTATION_PROFILE_DIR, to be read with pstats or snakeviz.
+"""
+
+import cProfile
+import os
+import random
+import threading
+import time
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+
+class RequestTimings:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self.profile = None
+
+    def total(self):
+        return time.perf_counter() - self.start
+
+
+def current_timings():
+    if has_request_context():
+        return g.get('timings', None)
+    return None
+
+
+class RouteStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}
+
+    def record(self, route, timings, total, slow):
+        with self._lock:
+            stats = self._routes.get(route)
+            if stats is None:
+                stats = self._routes[route] = {
+                    'requests': 0, 'queries': 0, 'slow': 0, 'db_time': 0.0,
+                    'serialize_time': 0.0, 'total_time': 0.0, 'max_time': 0.0}
+            stats['requests'] += 1
+            stats['queries'] += timings.queries
+            stats['db_time'] += timings.db_time
+            stats['serialize_time'] += timings.serialize_time
+            stats['total_time'] += total
+            stats['max_time'] = max(stats['max_time'], total)
+            if slow:
+                stats['slow'] += 1
+
+    def format(self):
+        with self._lock:
+            return {route: {
+                'requests': stats['requests'],
+                'slow': stats['slow'],
+                'queries_per_request': round(stats['queries'] / stats['requests'], 2),
+                'avg_db_ms': round(stats['db_time'] / stats['requests'] * 1000, 3),
+                'avg_serialize_ms': round(stats['serialize_time'] / stats['requests'] * 1000, 3),
+                'avg_total_ms': round(stats['total_time'] / stats['requests'] * 1000, 3),
+                'max_total_ms': round(stats['max_time'] * 1000, 3)
+            } for route, stats in self._routes.items()}
+
+
+def instrument_engine(engine):
+    # only statements run while a request is being instrumented are counted
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_timings() is not None:
+            conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        timings = current_timings()
+        starts = conn.info.get('query_start')
+        if timings is not None and starts:
+            timings.queries += 1
+            timings.db_time += time.perf_counter() - starts.pop()
+
+
+def instrumented_encoder(encoder):
+    class InstrumentedJSONEncoder(encoder):
+        def encode(self, o):
+            timings = current_timings()
+            if timings is None:
+                return super().encode(o)
+            start = time.perf_counter()
+            try:
+                return super().encode(o)
+            finally:
+                timings.serialize_time += time.perf_counter() - start
+    return InstrumentedJSONEncoder
+
+
+def server_timing(timings, total):
+    return ", ".join([
+        'db;dur={:.3f};desc="{} queries"'.format(timings.db_time * 1000, timings.queries),
+        'serialize;dur={:.3f}'.format(timings.serialize_time * 1000),
+        'total;dur={:.3f}'.format(total * 1000)
+    ])
+
+
+def route_name(request):
+    rule = request.url_rule.rule if request.url_rule is not None else "<unmatched>"
+    return "{} {}".format(request.method, rule)
+
+
+def dump_profile(profile, directory, route, total):
+    os.makedirs(directory, exist_ok=True)
+    name = "{}-{}-{:.0f}ms.prof".format(
+        time.strftime("%Y%m%d%H%M%S"),
+        route.replace(" ", "_").replace("/", "_").strip("_"),
+        total * 1000)
+    profile.dump_stats(os.path.join(directory, name))
+
+
+def init_instrumentation(app, engines):
+    """
+    Instruments the given engines and the requests of the app when
+    INSTRUMENTATION is on; returns the RouteStats, or None.
+    """
+    if not app.config.get("INSTRUMENTATION", False):
+        return None
+
+    routes = RouteStats()
+    slow = app.config.get("INSTRUMENTATION_SLOW_MS", 500) / 1000
+    profileRate = app.config.get("INSTRUMENTATION_PROFILE_RATE", 0.0)
+    profileDir = app.config.get("INSTRUMENTATION_PROFILE_DIR", None)
+
+    for engine in engines:
+        instrument_engine(engine)
+    app.json_encoder = instrumented_encoder(app.json_encoder)
+
+    @app.before_request
+    def start_timings():
+        g.timings = RequestTimings()
+        # only one profiler can run at a time in a process
+        if profileDir and profileRate and random.random() < profileRate:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                return
+            g.timings.profile = profile
+
+    @app.after_request
+    def record_timings(response):
+        timings = g.pop('timings', None)
+        if timings is None:
+            return response
+        total = timings.total()
+        if timings.profile is not None:
+            timings.profile.disable()
+
+        route = route_name(request)
+        routes.record(route, timings, total, total >= slow)
+        if timings.profile is not None and total >= slow:
+            dump_profile(timings.profile, profileDir, route, total)
+
+        # streamed responses are timed up to the start of the stream
+        response.headers['Server-Timing'] = server_timing(timings, total)
+        return response
+
+    @app.teardown_request
+    def stop_profile(error):
+        # after_request is skipped when an error propagates
+        timings = g.pop('timings', None)
+        if timings is not None and timings.profile is not None:
+            timings.profile.disable()
+
+    app.extensions['route_stats'] = routes
+    return routes
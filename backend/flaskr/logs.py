@@ -0,0 +1,197 @@
+"""
+Logging of the API.
+
+Records are put on a queue by the thread that logs them and written out
+by a single background thread (logging.handlers.QueueListener), so a
+request never waits on stdout or stderr. When the queue is full, records
+are dropped and counted instead of blocking.
+
+Each record carries the id of its request: the X-Request-ID header sent by
+the client or the proxy, or a new one, which is sent back on the response.
+With LOG_FORMAT=json every record is written as one JSON object per line.
+
+LOG_LEVEL sets the level of every logger and LOG_LEVELS overrides it per
+logger, e.g. "flaskr.search=DEBUG,werkzeug=WARNING". Request and result
+payloads are logged at DEBUG through log_payload(), for a sample of the
+requests only (LOG_PAYLOAD_SAMPLE): all the payloads of a sampled request
+and none of the others. When DEBUG is off they are never even built.
+"""
+
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import time
+import uuid
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import g, has_request_context, request
+
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+# attributes every LogRecord has; anything else was passed through extra=
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+_listener = None
+_handler = None
+_payload_sample = 1.0
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = g.get('request_id', '-') if has_request_context() else '-'
+        return True
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created))
+                    + ".{:03d}Z".format(int(record.msecs)),
+            'level': record.levelname,
+            'logger': record.name,
+            'request_id': getattr(record, 'request_id', '-'),
+            'message': record.getMessage(),
+        }
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES and name not in entry:
+                entry[name] = value
+        return json.dumps(entry, default=str)
+
+
+class StderrHandler(logging.StreamHandler):
+    # looks sys.stderr up on every record, so that it follows redirections
+    @property
+    def stream(self):
+        return sys.stderr
+
+    @stream.setter
+    def stream(self, value):
+        pass
+
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, queue):
+        super().__init__(queue)
+        self.dropped = 0
+        self.queued = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+            self.queued += 1
+        except queue.Full:
+            self.dropped += 1
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'dropped': self.dropped,
+            'pending': self.queue.qsize()
+        }
+
+
+def parse_levels(levels):
+    # "flaskr.search=DEBUG,werkzeug=WARNING" -> {name: level}
+    parsed = {}
+    for item in (levels or "").split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def _install_handler(size, output):
+    global _handler, _listener
+    _handler = DroppingQueueHandler(queue.Queue(size))
+    _handler.addFilter(RequestIdFilter())
+    logging.getLogger().addHandler(_handler)
+    _listener = QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+def _restart_after_fork():
+    # the listener thread does not survive fork(), and the queue it read may
+    # have been locked by another thread of the parent and still holds the
+    # parent's records; workers of a preloading server start over with a
+    # queue, a handler and a listener of their own
+    if _handler is not None:
+        logging.getLogger().removeHandler(_handler)
+        _install_handler(_handler.queue.maxsize, _listener.handlers[0])
+
+
+def configure_logging(config):
+    """
+    Installs the queue handler on the root logger, once per process, and
+    applies the levels of the given config every time.
+    """
+    global _payload_sample
+    if _handler is None:
+        output = StderrHandler()
+        if config.get("LOG_FORMAT", "json") == "json":
+            output.setFormatter(JsonFormatter())
+        else:
+            output.setFormatter(logging.Formatter(
+                "%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s"))
+
+        _install_handler(config.get("LOG_QUEUE_SIZE", 10000), output)
+        atexit.register(lambda: _listener.stop())
+        os.register_at_fork(after_in_child=_restart_after_fork)
+
+    _payload_sample = config.get("LOG_PAYLOAD_SAMPLE", 0.01)
+    logging.getLogger().setLevel(config.get("LOG_LEVEL", "INFO").upper())
+    for name, level in parse_levels(config.get("LOG_LEVELS")).items():
+        logging.getLogger(name).setLevel(level)
+    return _handler
+
+
+def logging_stats():
+    # the handler of this process, which a forked worker replaces
+    return _handler.stats()
+
+
+def payload_sampled():
+    # drawn once per request, so a sampled request logs all its payloads;
+    # outside a request every call is drawn
+    if _payload_sample >= 1.0:
+        return True
+    if not has_request_context():
+        return random.random() < _payload_sample
+    sampled = g.get('log_payload', None)
+    if sampled is None:
+        sampled = g.log_payload = random.random() < _payload_sample
+    return sampled
+
+
+def log_payload(logger, message, payload):
+    """
+    Logs payload at DEBUG when the request is in the sample. payload may be
+    a function, called only when the record is actually logged.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    if not payload_sampled():
+        return
+    if callable(payload):
+        payload = payload()
+    logger.debug(message, extra={'payload': payload})
+
+
+def init_logging(app):
+    configure_logging(app.config)
+
+    @app.before_request
+    def assign_request_id():
+        # ids sent by the client are kept short so they can't bloat the logs
+        g.request_id = request.headers.get(REQUEST_ID_HEADER, "")[:64] or uuid.uuid4().hex
+
+    @app.after_request
+    def send_request_id(response):
+        requestId = g.get('request_id', None)
+        if requestId is not None:
+            response.headers[REQUEST_ID_HEADER] = requestId
+        return response
@@ -0,0 +1,17 @@
+"""
+Counters exposed on GET /metrics.
+
+Each subsystem registers a function that returns a JSON-serialisable dict
+of its current numbers; the endpoint calls them all when it is hit.
+"""
+
+
+def register_metrics(app, name, provider):
+    app.extensions.setdefault('metrics', {})[name] = provider
+
+
+def collect_metrics(app):
+    return {
+        name: provider()
+        for name, provider in app.extensions.get('metrics', {}).items()
+    }
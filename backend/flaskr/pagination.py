@@ -0,0 +1,122 @@
+"""
+Pagination for the question lists.
+
+Pages are cut out in SQL with LIMIT/OFFSET (?page=N) or, for deep pages,
+with a keyset cursor (?after=<category>,<id>) so the database never has to
+walk past the rows that were already shown. Questions are always ordered by
+(category, id), questions without a category first on every database, so
+both modes return the same sequence.
+"""
+
+from flask import abort
+from sqlalchemy import and_, func, or_, select
+
+from models import db, Question
+
+from .read_models import load_questions, select_questions
+
+QUESTIONS_PER_PAGE = 10
+
+# the category of a cursor on a question without one
+NO_CATEGORY = "null"
+
+# Postgres puts NULLs last by default and SQLite first
+QUESTION_ORDER = (Question.category.nullsfirst(), Question.id)
+
+
+def parse_cursor(cursor):
+    # a cursor is the "<category>,<id>" of the last question on the
+    # previous page; returns (category or None, id)
+    try:
+        category, question_id = cursor.split(",")
+        if category == NO_CATEGORY:
+            return None, int(question_id)
+        return int(category), int(question_id)
+    except ValueError:
+        abort(400)
+
+
+def encode_cursor(category, question_id):
+    return "{},{}".format(NO_CATEGORY if category is None else category, question_id)
+
+
+def count_questions(where):
+    # count the matching questions without pulling any rows back
+    query = select([func.count(Question.id)])
+    if where:
+        query = query.where(and_(*where))
+    return db.session.execute(query).scalar()
+
+
+def page_window(args):
+    """
+    Returns (filter of the keyset cursor or None, offset) of the page asked
+    for by the request arguments.
+    """
+    cursor = args.get("after", None)
+    if cursor is not None:
+        category, question_id = parse_cursor(cursor)
+        if category is None:
+            # every question with a category comes after those without
+            return or_(
+                Question.category.isnot(None),
+                and_(Question.category.is_(None), Question.id > question_id)), 0
+        return or_(
+            Question.category > category,
+            and_(Question.category == category, Question.id > question_id)), 0
+
+    page = args.get("page", 1, type=int)
+    if page < 1:
+        abort(404)
+    return None, (page - 1) * QUESTIONS_PER_PAGE
+
+
+def paginate_questions(request, *where, total=None):
+    """
+    Returns (QuestionRows on the requested page, total number of questions
+    matching the where clauses, cursor for the next page or None); the
+    total is counted in SQL unless it is given.
+    """
+    totalQuestions = total if total is not None else count_questions(where)
+
+    after, offset = page_window(request.args)
+    conditions = list(where)
+    if after is not None:
+        conditions.append(after)
+    query = select_questions(*conditions).order_by(*QUESTION_ORDER)
+    if offset:
+        query = query.offset(offset)
+
+    questions = load_questions(query.limit(QUESTIONS_PER_PAGE))
+
+    nextCursor = None
+    if len(questions) == QUESTIONS_PER_PAGE:
+        nextCursor = encode_cursor(questions[-1].category, questions[-1].id)
+
+    return questions, totalQuestions, nextCursor
+
+
+def paginate_snapshot(snapshot, request, category=None):
+    """
+    paginate_questions() answered from a snapshot, see snapshot.py: returns
+    (SnapshotFragments on the requested page, total, cursor for the next
+    page or None), or None without a snapshot.
+    """
+    if snapshot is None:
+        return None
+
+    cursor = request.args.get("after", None)
+    if cursor is not None:
+        afterCategory, afterId = parse_cursor(cursor)
+        questions = snapshot.page_after(afterCategory, afterId, QUESTIONS_PER_PAGE, category)
+    else:
+        page = request.args.get("page", 1, type=int)
+        if page < 1:
+            abort(404)
+        questions = snapshot.page((page - 1) * QUESTIONS_PER_PAGE, QUESTIONS_PER_PAGE, category)
+
+    nextCursor = None
+    if len(questions) == QUESTIONS_PER_PAGE:
+        nextCursor = encode_cursor(questions[-1].category, questions[-1].id)
+
+    return questions, snapshot.total(category), nextCursor
@@ -0,0 +1,225 @@
+"""
+Random question selection for the quiz.
+
+Every app keeps the ids of all questions, grouped by category, in memory.
+Each group is a list plus a {id: position} map, so ids can be added,
+removed and picked at random in constant time. Picking the next question
+never runs a NOT IN query: random ids are drawn from the group until one is
+found that the player has not seen yet.
+
+The index is built on first use, kept in sync with Question.insert() and
+Question.delete() through the question change hooks, and rebuilt from the
+database every QUIZ_INDEX_TTL seconds to pick up changes made by other
+worker processes.
+"""
+
+import random
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import select
+
+from models import db, on_question_change, Question
+
+from .read_models import load_question, load_questions_by_id
+
+# the frontend sends id 0 when the player chose "ALL"
+ALL_CATEGORIES = 0
+
+# random picks tried before falling back to scanning the category
+MAX_DRAWS = 16
+
+
+class QuestionIdIndex:
+    def __init__(self, loader, ttl=300):
+        self.loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._ids = {}
+        self._positions = {}
+        self._loaded_at = None
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl:
+            self._ids = {ALL_CATEGORIES: []}
+            self._positions = {ALL_CATEGORIES: {}}
+            for question_id, category in self.loader():
+                self._add(question_id, category)
+            self._loaded_at = time.monotonic()
+
+    def _keys(self, category):
+        # questions whose category was deleted only show up under "ALL"
+        if category is None:
+            return (ALL_CATEGORIES,)
+        return (ALL_CATEGORIES, int(category))
+
+    def _add(self, question_id, category):
+        for key in self._keys(category):
+            positions = self._positions.setdefault(key, {})
+            if question_id in positions:
+                continue
+            ids = self._ids.setdefault(key, [])
+            positions[question_id] = len(ids)
+            ids.append(question_id)
+
+    def _remove(self, question_id, category):
+        for key in self._keys(category):
+            positions = self._positions.get(key, {})
+            position = positions.pop(question_id, None)
+            if position is None:
+                continue
+            # move the last id into the freed slot so removal stays O(1)
+            ids = self._ids[key]
+            last = ids.pop()
+            if last != question_id:
+                ids[position] = last
+                positions[last] = position
+
+    def add(self, question_id, category):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._add(question_id, category)
+
+    def remove(self, question_id, category):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._remove(question_id, category)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def fresh(self):
+        """
+        True when draw() will not have to load the ids first.
+        """
+        loadedAt = self._loaded_at
+        return loadedAt is not None and time.monotonic() - loadedAt < self.ttl
+
+    def count(self, category=ALL_CATEGORIES):
+        with self._lock:
+            self._ensure_loaded()
+            return len(self._ids.get(category, []))
+
+    def draw(self, category, seen):
+        """
+        Returns a random id from the category that is not in seen,
+        or None when the player has seen every question of the category.
+        """
+        ids = self.draw_many(category, seen, 1)
+        return ids[0] if ids else None
+
+    def draw_many(self, category, seen, count):
+        """
+        Returns count different random ids from the category that are not
+        in seen, fewer when the category runs out.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return sample_unseen(self._ids.get(category, []), seen, count)
+
+
+def sample_unseen(items, seen, count, key=None):
+    """
+    Up to count different random items whose key (the item itself by
+    default) is not in seen.
+    """
+    key = key or (lambda item: item)
+    picked = []
+    pickedKeys = set()
+    if not items:
+        return picked
+
+    for _ in range(MAX_DRAWS * count):
+        if len(picked) == count:
+            return picked
+        item = items[random.randrange(len(items))]
+        itemKey = key(item)
+        if itemKey not in seen and itemKey not in pickedKeys:
+            picked.append(item)
+            pickedKeys.add(itemKey)
+
+    # almost everything has been seen, so scanning is cheap enough
+    unseen = [item for item in items if key(item) not in seen and key(item) not in pickedKeys]
+    picked.extend(random.sample(unseen, min(count - len(picked), len(unseen))))
+    return picked
+
+
+def load_question_ids():
+    return db.session.execute(select([Question.id, Question.category])).fetchall()
+
+
+def init_quiz_index(app):
+    index = QuestionIdIndex(
+        load_question_ids,
+        ttl=app.config.get("QUIZ_INDEX_TTL", 300)
+    )
+    app.extensions['quiz_index'] = index
+    return index
+
+
+def get_quiz_index():
+    return current_app.extensions['quiz_index']
+
+
+def next_quiz_question(category, seen):
+    """
+    Returns the QuestionRow of the next question of the quiz, or None at
+    the end of the quiz.
+    """
+    index = get_quiz_index()
+    while True:
+        question_id = index.draw(category, seen)
+        if question_id is None:
+            return None
+
+        question = load_question(question_id)
+        if question is not None:
+            return question
+
+        # deleted by another worker since the index was built
+        index.invalidate()
+        seen = seen | {question_id}
+
+
+def next_quiz_questions(category, seen, count):
+    """
+    Returns the QuestionRows of the next count questions of the quiz, all
+    different, with one query; fewer near the end of the quiz.
+    """
+    index = get_quiz_index()
+    questions = []
+    while len(questions) < count:
+        ids = index.draw_many(category, seen, count - len(questions))
+        if not ids:
+            break
+
+        byId = load_questions_by_id(ids)
+        questions.extend(byId[question_id] for question_id in ids if question_id in byId)
+        if len(byId) < len(ids):
+            # deleted by another worker since the index was built
+            index.invalidate()
+        seen = seen | set(ids)
+    return questions
+
+
+@on_question_change
+def _sync_quiz_index(event, questions):
+    if not has_app_context():
+        return
+    index = current_app.extensions.get('quiz_index')
+    if index is None:
+        return
+    if event == 'reload':
+        index.invalidate()
+    for question in questions:
+        if event == 'insert':
+            index.add(question['id'], question['category'])
+        elif event == 'delete':
+            index.remove(question['id'], question['category'])
+        elif event == 'update':
+            before, after = question
+            if before['category'] != after['category']:
+                index.remove(before['id'], before['category'])
+                index.add(after['id'], after['category'])
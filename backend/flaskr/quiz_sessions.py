@@ -0,0 +1,194 @@
+"""
+Server-side quiz sessions.
+
+POST /quizzes/sessions starts a quiz and returns a token; every following
+POST /quizzes only sends that token instead of the whole previous_questions
+array. The ids of the questions already played are kept by a session store
+and returned as a packed array of int64, 8 bytes per question.
+
+Two stores ship with the app, picked with QUIZ_SESSION_BACKEND:
+
+    memory      sessions live in the worker process (default)
+    database    sessions live in the quiz_sessions table, so every worker
+                sees them, and each question they ask is a row of
+                quiz_session_seen: a round only inserts its own questions,
+                so concurrent rounds of a session never overwrite each other
+
+Any other value is read as "module:ClassName" and that class is used, so a
+shared store (Redis, memcached, ...) can be plugged in without touching the
+routes. Sessions expire QUIZ_SESSION_TTL seconds after their last use.
+"""
+
+import importlib
+import secrets
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+from engine import use_primary
+from models import db, QuizSession, QuizSessionSeen
+
+
+def new_token():
+    return secrets.token_urlsafe(16)
+
+
+class SessionStore:
+    """
+    Interface of a quiz session store.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+
+    def create(self, category):
+        """Starts a session and returns its token."""
+        raise NotImplementedError
+
+    def load(self, token):
+        """Returns (category, array of seen ids) or None if unknown or expired."""
+        raise NotImplementedError
+
+    def add_seen(self, token, question_id):
+        raise NotImplementedError
+
+    def add_seen_many(self, token, question_ids):
+        # stores that can should record them all at once
+        for question_id in question_ids:
+            self.add_seen(token, question_id)
+
+    def discard(self, token):
+        raise NotImplementedError
+
+
+class MemorySessionStore(SessionStore):
+    def __init__(self, ttl=3600):
+        super().__init__(ttl)
+        self._lock = threading.Lock()
+        # token -> [category, seen, expires_at], oldest use first
+        self._sessions = OrderedDict()
+
+    def _evict_expired(self, now):
+        # the dict is ordered by last use, so expired sessions sit at the front
+        while self._sessions:
+            token, session = next(iter(self._sessions.items()))
+            if session[2] > now:
+                break
+            del self._sessions[token]
+
+    def _touch(self, token, now):
+        session = self._sessions.get(token)
+        if session is None or session[2] <= now:
+            return None
+        session[2] = now + self.ttl
+        self._sessions.move_to_end(token)
+        return session
+
+    def create(self, category):
+        token = new_token()
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            self._sessions[token] = [category, array('q'), now + self.ttl]
+        return token
+
+    def load(self, token):
+        with self._lock:
+            session = self._touch(token, time.time())
+            if session is None:
+                return None
+            return session[0], array('q', session[1])
+
+    def add_seen(self, token, question_id):
+        with self._lock:
+            session = self._touch(token, time.time())
+            if session is not None:
+                session[1].append(question_id)
+
+    def add_seen_many(self, token, question_ids):
+        with self._lock:
+            session = self._touch(token, time.time())
+            if session is not None:
+                session[1].extend(question_ids)
+
+    def discard(self, token):
+        with self._lock:
+            self._sessions.pop(token, None)
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+class DatabaseSessionStore(SessionStore):
+    def create(self, category):
+        token = new_token()
+        now = time.time()
+        expired = db.session.query(QuizSession.token).filter(QuizSession.expires_at <= now)
+        QuizSessionSeen.query.filter(QuizSessionSeen.token.in_(expired.subquery())).delete(
+            synchronize_session=False)
+        QuizSession.query.filter(QuizSession.expires_at <= now).delete()
+        db.session.add(QuizSession(
+            token=token,
+            category=category,
+            expires_at=now + self.ttl
+        ))
+        db.session.commit()
+        return token
+
+    def _get(self, token):
+        # the session was changed by the previous request, a replica may
+        # not have it yet
+        with use_primary():
+            session = QuizSession.query.get(token)
+        if session is None or session.expires_at <= time.time():
+            return None
+        return session
+
+    def load(self, token):
+        session = self._get(token)
+        if session is None:
+            return None
+        with use_primary():
+            rows = db.session.query(QuizSessionSeen.question_id).filter(
+                QuizSessionSeen.token == token).order_by(QuizSessionSeen.id).all()
+        return session.category, array('q', [row.question_id for row in rows])
+
+    def add_seen(self, token, question_id):
+        self.add_seen_many(token, [question_id])
+
+    def add_seen_many(self, token, question_ids):
+        now = time.time()
+        # one statement extends the session, whatever other rounds do
+        touched = QuizSession.query.filter(
+            QuizSession.token == token, QuizSession.expires_at > now).update(
+            {QuizSession.expires_at: now + self.ttl}, synchronize_session=False)
+        if touched and question_ids:
+            db.session.execute(QuizSessionSeen.__table__.insert(), [
+                {'token': token, 'question_id': question_id} for question_id in question_ids])
+        db.session.commit()
+
+    def discard(self, token):
+        QuizSessionSeen.query.filter(QuizSessionSeen.token == token).delete()
+        QuizSession.query.filter(QuizSession.token == token).delete()
+        db.session.commit()
+
+
+BACKENDS = {
+    'memory': MemorySessionStore,
+    'database': DatabaseSessionStore,
+}
+
+
+def load_backend(name):
+    if name in BACKENDS:
+        return BACKENDS[name]
+    module_name, _, class_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+def init_quiz_sessions(app):
+    backend = load_backend(app.config.get("QUIZ_SESSION_BACKEND", "memory"))
+    store = backend(ttl=app.config.get("QUIZ_SESSION_TTL", 3600))
+    app.extensions['quiz_sessions'] = store
+    return store
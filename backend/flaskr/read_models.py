@@ -0,0 +1,67 @@
+"""
+Read models of the questions and categories.
+
+The read endpoints (the question lists, category pages, search and the
+quiz) only ever turn what they load into JSON, so instead of ORM instances,
+with their identity map entries and change tracking, they get named tuples
+loaded with Core selects. The selects still go through db.session, so
+reads of read only views keep going to the replicas. The ORM models are
+used by the write paths only.
+"""
+
+import hashlib
+from collections import namedtuple
+
+from sqlalchemy import and_, func, select
+
+from models import db, Category, Question
+
+# the fields of Question.format(), in sorted order, which is the order of
+# the JSON fragments of flaskr/serialize.py
+QuestionRow = namedtuple('QuestionRow', ['answer', 'category', 'difficulty', 'id', 'question'])
+QUESTION_COLUMNS = tuple(getattr(Question, field) for field in QuestionRow._fields)
+
+CategoryRow = namedtuple('CategoryRow', ['id', 'type'])
+
+
+def select_questions(*where):
+    query = select(QUESTION_COLUMNS)
+    if where:
+        query = query.where(and_(*where))
+    return query
+
+
+def load_questions(query):
+    return [QuestionRow._make(row) for row in db.session.execute(query)]
+
+
+def load_question(question_id):
+    rows = load_questions(select_questions(Question.id == question_id))
+    return rows[0] if rows else None
+
+
+def load_questions_by_id(ids):
+    return {row.id: row for row in load_questions(select_questions(Question.id.in_(ids)))}
+
+
+def question_matches(texts):
+    """
+    Where clause of the questions whose text is one of texts. On Postgres
+    it also compares md5(question), which is what the unique index of the
+    text is on, see migrations.py.
+    """
+    match = Question.question.in_(texts)
+    if db.engine.dialect.name == 'postgresql':
+        digests = [hashlib.md5(str(text).encode("utf-8")).hexdigest() for text in texts]
+        match = and_(func.md5(Question.question).in_(digests), match)
+    return match
+
+
+def question_exists(text):
+    query = select([Question.id]).where(question_matches([text])).limit(1)
+    return db.session.execute(query).first() is not None
+
+
+def load_category_rows():
+    query = select([Category.id, Category.type]).order_by(Category.id)
+    return [CategoryRow._make(row) for row in db.session.execute(query)]
@@ -0,0 +1,213 @@
+"""
+Response cache with conditional GET for the list endpoints.
+
+The ETag of a response is worked out from the route, the query arguments
+and a data version, without reading the database: the version is bumped by
+every question change and every category commit, so an unchanged ETag
+means an unchanged body. A request whose If-None-Match holds the current
+ETag gets a 304 straight away; otherwise the body is served from the cache
+when it has it, and rendered and stored when it does not, once for all the
+concurrent requests of the same ETag.
+
+The version is kept per worker, unless RESPONSE_CACHE_VERSION_FILE names a
+file shared by the workers of the host (see cache.SharedVersion). It also
+moves on every RESPONSE_CACHE_TTL seconds, which bounds how long a worker
+can serve a body made stale by another worker without a shared file.
+
+Bodies are kept by a backend picked with RESPONSE_CACHE_BACKEND: "memory"
+(an LRU of RESPONSE_CACHE_SIZE bodies per worker) or a "module:ClassName"
+with the same get/set methods, for a cache shared by the workers.
+"""
+
+import hashlib
+import importlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, current_app, has_app_context, request
+
+from models import on_question_change
+
+from .cache import SharedVersion
+from .routing import reads_own_writes
+from .single_flight import coalesced
+
+
+class MemoryResponseBackend:
+    def __init__(self, size=1024):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            body, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return body
+
+    def set(self, key, body, ttl):
+        with self._lock:
+            self._entries[key] = (body, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+BACKENDS = {
+    'memory': MemoryResponseBackend,
+}
+
+
+def load_backend(name):
+    if name in BACKENDS:
+        return BACKENDS[name]
+    module_name, _, class_name = name.partition(":")
+    return getattr(importlib.import_module(module_name), class_name)
+
+
+class ResponseCache:
+    def __init__(self, backend, ttl=60, max_age=0, shared_version=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_age = max_age
+        self.shared_version = shared_version
+        self._lock = threading.Lock()
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.bumps = 0
+
+    def version(self):
+        if self.shared_version is not None:
+            version = self.shared_version.get()
+        else:
+            version = self._version
+        return "{}:{}".format(version, int(time.time() // self.ttl))
+
+    def bump(self):
+        with self._lock:
+            self._version += 1
+            self.bumps += 1
+        if self.shared_version is not None:
+            self.shared_version.bump()
+
+    def etag(self, request):
+        args = sorted(request.args.items(multi=True))
+        key = "{}|{}|{}".format(self.version(), request.path, args)
+        return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+    def lookup(self, request):
+        """
+        Returns (etag, headers, response or None): a 304 when the client has
+        the current body, the cached body, or None when it must be rendered.
+        """
+        etag = self.etag(request)
+        headers = {'ETag': '"{}"'.format(etag), 'Cache-Control': self.cache_control()}
+
+        if etag in request.if_none_match:
+            self.record('not_modified')
+            return etag, headers, Response(status=304, headers=headers)
+
+        body = self.backend.get(etag)
+        if body is not None:
+            self.record('hits')
+            return etag, headers, Response(body, mimetype='application/json', headers=headers)
+
+        self.record('misses')
+        return etag, headers, None
+
+    def store(self, etag, body):
+        self.backend.set(etag, body, self.ttl)
+
+    def cache_control(self):
+        return "max-age={}".format(self.max_age) if self.max_age else "no-cache"
+
+    def record(self, outcome):
+        # outcome is 'hits', 'misses' or 'not_modified'
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        requests = self.hits + self.misses + self.not_modified
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+            'hit_ratio': round((self.hits + self.not_modified) / requests, 4) if requests else 0.0,
+            'bumps': self.bumps,
+            'ttl': self.ttl
+        }
+        if isinstance(self.backend, MemoryResponseBackend):
+            stats['entries'] = len(self.backend)
+        return stats
+
+
+def init_response_cache(app):
+    backend = load_backend(app.config.get("RESPONSE_CACHE_BACKEND", "memory"))
+    versionFile = app.config.get("RESPONSE_CACHE_VERSION_FILE")
+    cache = ResponseCache(
+        backend(size=app.config.get("RESPONSE_CACHE_SIZE", 1024)),
+        ttl=app.config.get("RESPONSE_CACHE_TTL", 60),
+        max_age=app.config.get("RESPONSE_CACHE_MAX_AGE", 0),
+        shared_version=SharedVersion(versionFile) if versionFile else None
+    )
+    app.extensions['response_cache'] = cache
+    return cache
+
+
+def cached_response(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # a client that just wrote reads from the primary, not from a body
+        # rendered from a replica
+        if reads_own_writes(request):
+            return view(*args, **kwargs)
+
+        cache = current_app.extensions['response_cache']
+        etag, headers, cached = cache.lookup(request)
+        if cached is not None:
+            return cached
+
+        # concurrent misses of the same ETag render the body once, see
+        # flaskr/single_flight.py; the body is shared, not the response,
+        # which the after_request hooks of each request change
+        rendered = []
+
+        def render():
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                rendered.append(response)
+                return None
+            body = response.get_data()
+            cache.store(etag, body)
+            return body
+
+        body = coalesced(etag, render)
+        if body is None:
+            return rendered[0]
+        return Response(body, mimetype='application/json', headers=headers)
+    return wrapper
+
+
+def invalidate_responses():
+    if has_app_context():
+        cache = current_app.extensions.get('response_cache')
+        if cache is not None:
+            cache.bump()
+
+
+@on_question_change
+def _bump_response_version(event, questions):
+    invalidate_responses()
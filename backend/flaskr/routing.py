@@ -0,0 +1,74 @@
+"""
+Read/write routing of the database queries, see engine.py.
+
+Views decorated with read_only run their SELECTs on the read replicas.
+As a replica lags a little behind the primary, a client that just changed
+questions could read its own change back as missing; with
+READ_YOUR_WRITES_WINDOW set, a write sets a cookie that keeps that
+client's reads on the primary for the given number of seconds.
+
+The cookie holds the time of the write signed with SECRET_KEY, so a client
+can neither make one up nor stretch its window to send all its reads to
+the primary. Without SECRET_KEY a random key is made when the app is
+created: the workers gunicorn forks from its master share it, but workers
+of other hosts or started later ignore the cookie and read from the
+replicas.
+"""
+
+import os
+from functools import wraps
+
+from flask import current_app, g, has_request_context, request
+from itsdangerous import BadSignature, TimestampSigner
+
+from models import on_question_change
+
+COOKIE = 'read_primary_until'
+
+
+def reads_own_writes(request, app=None):
+    """
+    True while the client is in its read-your-writes window; app is the
+    Flask app when there is no app context.
+    """
+    app = app or current_app
+    signer = app.extensions.get('read_your_writes')
+    if signer is None or COOKIE not in request.cookies:
+        return False
+    try:
+        signer.unsign(request.cookies[COOKIE], max_age=app.config["READ_YOUR_WRITES_WINDOW"])
+    except BadSignature:
+        # forged, or written before the window
+        return False
+    return True
+
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = not reads_own_writes(request)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def init_routing(app):
+    window = app.config.get("READ_YOUR_WRITES_WINDOW", 0)
+    if not window:
+        return app.extensions['replicas']
+    signer = TimestampSigner(app.secret_key or os.urandom(32), salt=COOKIE)
+    app.extensions['read_your_writes'] = signer
+
+    @app.after_request
+    def remember_write(response):
+        if g.get('wrote', False):
+            response.set_cookie(COOKIE, signer.sign("primary").decode("ascii"),
+                                max_age=window, httponly=True)
+        return response
+
+    return app.extensions['replicas']
+
+
+@on_question_change
+def _remember_write(event, questions):
+    if has_request_context():
+        g.wrote = True
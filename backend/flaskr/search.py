@@ -0,0 +1,280 @@
+"""
+Full-text search over the question text.
+
+A search term is split into words; a question matches when it contains
+every word, the last word also matching as a prefix so results show up
+while the user is still typing. Matches are ranked by how rare the matched
+words are and how short the question is, then paginated. A term without
+words, such as an empty one, matches every question, in id order.
+
+Two backends answer the searches, picked with SEARCH_BACKEND:
+
+    postgres    to_tsvector/to_tsquery served by a GIN index on questions,
+                created by migrations.py
+    memory      an inverted index (word -> ids of the questions containing
+                it) kept in the worker, for SQLite and test setups
+    auto        postgres when the database is Postgres, memory otherwise
+
+The memory index is built on first use, kept in sync with Question.insert()
+and Question.delete() through the question change hooks, and rebuilt every
+SEARCH_INDEX_TTL seconds to pick up changes made by other workers.
+"""
+
+import bisect
+import heapq
+import math
+import re
+import threading
+import time
+
+from flask import current_app, has_app_context
+from sqlalchemy import and_, func, literal_column, select
+
+from models import db, on_question_change, Question
+
+from .read_models import load_questions_by_id
+from .snapshot import current_snapshot
+
+WORD = re.compile(r"\w+")
+
+# the text search configuration used by the GIN index (see
+# migrations.search_index), kept as a literal so that the planner can match
+# the indexed expression
+TS_CONFIG = literal_column("'english'::regconfig")
+
+
+def tokenize(text):
+    return WORD.findall(text.lower()) if text else []
+
+
+class InvertedIndex:
+    def __init__(self, loader, ttl=300):
+        self.loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._postings = {}
+        self._words = []
+        self._docs = {}
+        self._loaded_at = None
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.ttl:
+            self._postings = {}
+            self._docs = {}
+            for question_id, question, category in self.loader():
+                self._add(question_id, question, category)
+            self._words = sorted(self._postings)
+            self._loaded_at = time.monotonic()
+
+    def _add(self, question_id, question, category, keep_sorted=False):
+        words = tokenize(question)
+        self._docs[question_id] = (category, len(words))
+        for word in set(words):
+            posting = self._postings.get(word)
+            if posting is None:
+                posting = self._postings[word] = set()
+                if keep_sorted:
+                    bisect.insort(self._words, word)
+            posting.add(question_id)
+
+    def _remove(self, question_id, question):
+        if self._docs.pop(question_id, None) is None:
+            return
+        for word in set(tokenize(question)):
+            posting = self._postings.get(word)
+            if posting is None:
+                continue
+            posting.discard(question_id)
+            if not posting:
+                del self._postings[word]
+                position = bisect.bisect_left(self._words, word)
+                if position < len(self._words) and self._words[position] == word:
+                    del self._words[position]
+
+    def add(self, question_id, question, category):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._add(question_id, question, category, keep_sorted=True)
+
+    def remove(self, question_id, question):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._remove(question_id, question)
+
+    def set_category(self, question_id, category):
+        with self._lock:
+            if self._loaded_at is not None and question_id in self._docs:
+                self._docs[question_id] = (category, self._docs[question_id][1])
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def load(self):
+        with self._lock:
+            self._ensure_loaded()
+
+    def _prefix_matches(self, prefix):
+        matches = set()
+        position = bisect.bisect_left(self._words, prefix)
+        while position < len(self._words) and self._words[position].startswith(prefix):
+            matches |= self._postings[self._words[position]]
+            position += 1
+        return matches
+
+    def search(self, term, category=None, offset=0, limit=10):
+        """
+        Returns (ids of the requested page ranked best first, total matches).
+        """
+        words = tokenize(term)
+
+        with self._lock:
+            self._ensure_loaded()
+
+            if words:
+                # intersect from the rarest word so the candidate set stays small
+                postings = [self._postings.get(word, set()) for word in words[:-1]]
+                postings.append(self._prefix_matches(words[-1]))
+                postings.sort(key=len)
+                matches = set(postings[0])
+                for posting in postings[1:]:
+                    if not matches:
+                        break
+                    matches &= posting
+            else:
+                matches = set(self._docs)
+
+            if category is not None:
+                matches = {question_id for question_id in matches
+                           if self._docs[question_id][0] is not None
+                           and int(self._docs[question_id][0]) == category}
+
+            if not words:
+                return sorted(matches)[offset:offset + limit], len(matches)
+
+            # rare words weigh more, a whole-word match of the last word beats
+            # a prefix match, and short questions beat long ones
+            total = len(self._docs)
+            weights = [math.log(1 + total / (1 + len(self._postings.get(word, ()))))
+                       for word in words]
+            exact = self._postings.get(words[-1], set())
+
+            def rank(question_id):
+                score = sum(weights)
+                if question_id not in exact:
+                    score -= weights[-1] / 2
+                length = self._docs[question_id][1]
+                return (-score / (1 + math.log(1 + length)), question_id)
+
+            ranked = heapq.nsmallest(offset + limit, matches, key=rank)
+            return ranked[offset:], len(matches)
+
+
+class MemorySearchBackend:
+    def __init__(self, ttl=300):
+        self.index = InvertedIndex(load_search_documents, ttl=ttl)
+
+    def search(self, term, category=None, offset=0, limit=10):
+        return self.index.search(term, category, offset, limit)
+
+
+class PostgresSearchBackend:
+    def __init__(self, ttl=None):
+        # nothing to keep in sync, Postgres maintains the index
+        pass
+
+    def queries(self, term, category=None, offset=0, limit=10):
+        """
+        Returns the (count, page of ids) selects of a search.
+        """
+        words = tokenize(term)
+        if not words:
+            count = select([func.count(Question.id)])
+            page = select([Question.id])
+            if category is not None:
+                count = count.where(Question.category == category)
+                page = page.where(Question.category == category)
+            return count, page.order_by(Question.id).offset(offset).limit(limit)
+
+        # the words come from \w+ so they are safe to join into a tsquery
+        words[-1] = words[-1] + ":*"
+        tsquery = func.to_tsquery(TS_CONFIG, " & ".join(words))
+        vector = func.to_tsvector(TS_CONFIG, Question.question)
+
+        match = vector.op("@@")(tsquery)
+        if category is not None:
+            match = and_(match, Question.category == category)
+
+        count = select([func.count(Question.id)]).where(match)
+        page = select([Question.id]).where(match) \
+            .order_by(func.ts_rank(vector, tsquery).desc(), Question.id) \
+            .offset(offset).limit(limit)
+        return count, page
+
+    def search(self, term, category=None, offset=0, limit=10):
+        count, page = self.queries(term, category, offset, limit)
+        total = db.session.execute(count).scalar()
+        rows = db.session.execute(page).fetchall()
+        return [row.id for row in rows], total
+
+
+BACKENDS = {
+    'memory': MemorySearchBackend,
+    'postgres': PostgresSearchBackend,
+}
+
+
+def load_search_documents():
+    return db.session.execute(
+        select([Question.id, Question.question, Question.category])).fetchall()
+
+
+def init_search(app):
+    name = app.config.get("SEARCH_BACKEND", "auto")
+    if name == "auto":
+        uri = app.config["SQLALCHEMY_DATABASE_URI"]
+        name = "postgres" if uri.startswith("postgres") else "memory"
+    backend = BACKENDS[name](ttl=app.config.get("SEARCH_INDEX_TTL", 300))
+    app.extensions['search'] = backend
+    return backend
+
+
+def search_questions(term, category=None, offset=0, limit=10):
+    """
+    Returns (QuestionRows, or SnapshotFragments when there is a snapshot,
+    of the requested page in rank order, total matches).
+    """
+    ids, total = current_app.extensions['search'].search(term, category, offset, limit)
+    if not ids:
+        return [], total
+
+    snapshot = current_snapshot()
+    byId = snapshot.questions_by_id(ids) if snapshot is not None else {}
+    # questions added by another worker since the snapshot was built
+    missing = [question_id for question_id in ids if question_id not in byId]
+    if missing:
+        byId.update(load_questions_by_id(missing))
+    return [byId[question_id] for question_id in ids if question_id in byId], total
+
+
+@on_question_change
+def _sync_search_index(event, questions):
+    if not has_app_context():
+        return
+    backend = current_app.extensions.get('search')
+    if not isinstance(backend, MemorySearchBackend):
+        return
+    if event == 'reload':
+        backend.index.invalidate()
+    for question in questions:
+        if event == 'insert':
+            backend.index.add(question['id'], question['question'], question['category'])
+        elif event == 'delete':
+            backend.index.remove(question['id'], question['question'])
+        elif event == 'update':
+            before, after = question
+            if before['question'] != after['question']:
+                backend.index.remove(before['id'], before['question'])
+                backend.index.add(after['id'], after['question'], after['category'])
+            elif before['category'] != after['category']:
+                backend.index.set_category(after['id'], after['category'])
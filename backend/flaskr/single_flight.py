@@ -0,0 +1,149 @@
+"""
+Coalescing of identical concurrent reads.
+
+When many clients ask for the same page at the same moment, the start of a
+quiz night, each of them misses the response cache and renders the same
+body from the same queries. A SingleFlight lets the first of them, the
+leader, run the work for a key while the others, the followers, wait for
+its result and share it: one database execution and one serialized body
+for all of them.
+
+A follower waits at most the timeout of the key (SINGLE_FLIGHT_TIMEOUT
+seconds unless the caller passes another) and then runs the work itself,
+so a stuck leader only delays it. It also runs the work itself when the
+leader fails or has nothing to share (the work returned None); errors are
+never shared, so a follower does not get a 500 caused by another request.
+
+The keys must cover everything the result depends on. The list endpoints
+use the ETag of the response cache, which is made of the data version, the
+route and the sorted query arguments, so a change made while a leader runs
+gives the requests that follow it a new key.
+
+Coalescing is per process: it saves the work of concurrent requests on
+the threads of a worker (gunicorn gthread workers, the ASGI thread pool)
+or the coroutines of the ASGI app, not across workers.
+"""
+
+import asyncio
+import threading
+
+from flask import current_app
+
+
+class InFlight:
+    __slots__ = ('done', 'result', 'followers')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.followers = 0
+
+
+class SingleFlight:
+    def __init__(self, timeout=5.0):
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._calls = {}
+        # coroutines of the ASGI app, which all run on one event loop
+        self._futures = {}
+        self.executions = 0
+        self.shared = 0
+        self.timeouts = 0
+        self.retries = 0
+
+    def do(self, key, function, timeout=None):
+        """
+        Returns function(), run once for all the threads calling do() with
+        the same key at the same time.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = InFlight()
+            else:
+                call.followers += 1
+
+        if leader:
+            try:
+                call.result = function()
+                return call.result
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                    self.executions += 1
+                call.done.set()
+
+        if not call.done.wait(self.timeout if timeout is None else timeout):
+            self.record('timeouts')
+            return function()
+        if call.result is None:
+            self.record('retries')
+            return function()
+        self.record('shared')
+        return call.result
+
+    async def do_async(self, key, function, timeout=None):
+        """
+        The same as do() for coroutines: returns await function(), awaited
+        once for all the coroutines calling do_async() with the same key at
+        the same time.
+        """
+        future = self._futures.get(key)
+        if future is not None:
+            try:
+                result = await asyncio.wait_for(
+                    asyncio.shield(future), self.timeout if timeout is None else timeout)
+            except asyncio.TimeoutError:
+                self.record('timeouts')
+                return await function()
+            if result is None:
+                self.record('retries')
+                return await function()
+            self.record('shared')
+            return result
+
+        future = self._futures[key] = asyncio.get_running_loop().create_future()
+        result = None
+        try:
+            result = await function()
+            return result
+        finally:
+            del self._futures[key]
+            self.record('executions')
+            future.set_result(result)
+
+    def record(self, outcome):
+        # outcome is 'executions', 'shared', 'timeouts' or 'retries'
+        with self._lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+
+    def stats(self):
+        calls = self.executions + self.shared
+        return {
+            'executions': self.executions,
+            # every shared result is a database execution saved
+            'saved': self.shared,
+            'saved_ratio': round(self.shared / calls, 4) if calls else 0.0,
+            'timeouts': self.timeouts,
+            'retries': self.retries,
+            'in_flight': len(self._calls) + len(self._futures),
+            'timeout': self.timeout
+        }
+
+
+def init_single_flight(app):
+    singleFlight = SingleFlight(timeout=app.config.get("SINGLE_FLIGHT_TIMEOUT", 5.0))
+    app.extensions['single_flight'] = singleFlight
+    return singleFlight
+
+
+def coalesced(key, function, timeout=None):
+    """
+    Runs function() through the app's SingleFlight, or directly when
+    coalescing is off (SINGLE_FLIGHT_TIMEOUT is 0).
+    """
+    singleFlight = current_app.extensions.get('single_flight')
+    if singleFlight is None or not singleFlight.timeout:
+        return function()
+    return singleFlight.do(key, function, timeout)
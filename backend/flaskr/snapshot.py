@@ -0,0 +1,447 @@
+"""
+Memory-mapped snapshot of the question bank, shared by the worker processes.
+
+A snapshot is one binary file, QUESTION_SNAPSHOT_PATH, holding every
+question already encoded as its JSON fragment (see serialize.py), in the
+(category, id) order of the question lists, with an id index and a
+category index at offsets given in its header. Every worker maps the same
+file, so the operating system keeps a single copy of it in the page cache
+for all of them, and the question lists, the category pages, the quiz and
+the search results are cut out of it without a query and without encoding
+anything.
+
+Layout, little-endian:
+
+    header       HEADER: magic, format version, data version (the time the
+                 questions were read, in ns), number of questions, number
+                 of categories and the offsets of the sections below
+    fragments    the JSON fragments, ASCII only
+    records      per question, in list order: RECORD, i.e. id, category
+                 (NO_CATEGORY for none), offset and length of its fragment
+    id index     per question, by ascending id: ID_ENTRY, i.e. id and the
+                 position of its record
+    categories   per category, in list order: CATEGORY, i.e. id, position
+                 of its first record and number of records
+
+Questions changed through Question.insert(), Question.delete(), the bulk
+import or the batch endpoints rebuild the snapshot in a background thread:
+the new file is written next to the old one and renamed over it, so
+readers see the old or the new snapshot, never a part of one. Every worker
+notices a new file with one stat() per read, and a worker that wrote reads
+from the database until its own rebuild is in. Builds of all the workers
+on the host take turns on a lock file, and a build is skipped when the
+file was built from a read that started after the change that asked for
+it. The snapshot is also rebuilt every QUESTION_SNAPSHOT_TTL seconds, to
+pick up changes made outside of the app.
+"""
+
+import json
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+from flask import current_app, has_app_context
+
+from engine import use_primary
+from models import db, on_question_change, Question
+
+from .pagination import QUESTION_ORDER
+from .quiz import ALL_CATEGORIES, sample_unseen
+from .read_models import QuestionRow, select_questions
+from .serialize import Fragment, QUESTION_TEMPLATE, encode_value
+
+try:
+    import fcntl
+except ImportError:
+    # no lock file on Windows; concurrent builds then both write a full file
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"TRIVSNAP"
+# 2: questions without a category first, on every database
+FORMAT_VERSION = 2
+
+HEADER = struct.Struct("<8sIQIIQQQ")
+RECORD = struct.Struct("<IiQI")
+ID_ENTRY = struct.Struct("<II")
+CATEGORY = struct.Struct("<iII")
+
+# the category of questions whose category was deleted
+NO_CATEGORY = -1
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class SnapshotFragment(Fragment):
+    """
+    A question read from a snapshot: its JSON, id and category. The dict of
+    the question is only decoded for encoders that can not splice the JSON.
+    """
+    __slots__ = ('id', 'category')
+
+    def __init__(self, question_id, category, encoded):
+        self.row = None
+        self.json = encoded
+        self.id = question_id
+        self.category = category
+
+    def format(self):
+        return json.loads(self.json)
+
+
+class Snapshot:
+    def __init__(self, path):
+        with open(path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.identity = (stat.st_ino, stat.st_mtime_ns)
+        self.size = stat.st_size
+        self._view = memoryview(self.buffer)
+
+        try:
+            magic, formatVersion, self.version, self.count, categoryCount, \
+                self._records, self._ids, categoriesAt = HEADER.unpack_from(self.buffer)
+        except struct.error:
+            raise SnapshotError("{} is truncated".format(path))
+        if magic != MAGIC or formatVersion != FORMAT_VERSION:
+            raise SnapshotError("{} is not a version {} snapshot".format(path, FORMAT_VERSION))
+
+        # {category: (position of the first record, number of records)}, in
+        # list order
+        self.categories = {}
+        for number in range(categoryCount):
+            category, first, count = CATEGORY.unpack_from(
+                self.buffer, categoriesAt + number * CATEGORY.size)
+            self.categories[None if category == NO_CATEGORY else category] = (first, count)
+
+    def _record(self, position):
+        return RECORD.unpack_from(self.buffer, self._records + position * RECORD.size)
+
+    def fragment(self, position):
+        question_id, category, offset, length = self._record(position)
+        return SnapshotFragment(
+            question_id, None if category == NO_CATEGORY else category,
+            str(self._view[offset:offset + length], "ascii"))
+
+    def position(self, question_id):
+        # binary search of the id index
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            entryId, position = ID_ENTRY.unpack_from(self.buffer, self._ids + middle * ID_ENTRY.size)
+            if entryId < question_id:
+                low = middle + 1
+            elif entryId > question_id:
+                high = middle
+            else:
+                return position
+        return None
+
+    def span(self, category=None):
+        """
+        (position of the first record, number of records) of a category, or
+        of every question.
+        """
+        if category is None or category == ALL_CATEGORIES:
+            return 0, self.count
+        return self.categories.get(category, (0, 0))
+
+    def total(self, category=None):
+        return self.span(category)[1]
+
+    def page(self, offset, limit, category=None):
+        first, count = self.span(category)
+        end = first + count
+        return [self.fragment(position)
+                for position in range(min(first + offset, end), min(first + offset + limit, end))]
+
+    def _first_above(self, first, count, question_id):
+        # records of a category are ordered by id
+        low, high = first, first + count
+        while low < high:
+            middle = (low + high) // 2
+            if self._record(middle)[0] <= question_id:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def page_after(self, after_category, after_id, limit, category=None):
+        """
+        The page after a keyset cursor, as pagination.page_window() filters
+        it: questions of a higher category, or of after_category with a
+        higher id. Questions without a category, after_category None, come
+        before all the others.
+        """
+        fragments = []
+        for current, (first, count) in self.categories.items():
+            if current is None and after_category is not None:
+                continue
+            if current is not None and after_category is not None and current < after_category:
+                continue
+            if category is not None and current != category:
+                continue
+            start = first
+            if current == after_category:
+                start = self._first_above(first, count, after_id)
+            for position in range(start, first + count):
+                if len(fragments) == limit:
+                    return fragments
+                fragments.append(self.fragment(position))
+        return fragments
+
+    def draw(self, category, seen):
+        """
+        A random question of the category (ALL_CATEGORIES for any) whose id
+        is not in seen, or None when the player has seen them all.
+        """
+        questions = self.draw_many(category, seen, 1)
+        return questions[0] if questions else None
+
+    def draw_many(self, category, seen, count):
+        """
+        count different random questions of the category whose ids are not
+        in seen, fewer when the category runs out.
+        """
+        first, total = self.span(category)
+        positions = sample_unseen(range(first, first + total), seen, count,
+                                  key=lambda position: self._record(position)[0])
+        return [self.fragment(position) for position in positions]
+
+    def questions_by_id(self, ids):
+        """
+        {id: SnapshotFragment} of the ids that are in the snapshot.
+        """
+        questions = {}
+        for question_id in ids:
+            position = self.position(question_id)
+            if position is not None:
+                questions[question_id] = self.fragment(position)
+        return questions
+
+
+def read_version(path):
+    try:
+        with open(path, "rb") as file:
+            magic, formatVersion, version = HEADER.unpack(file.read(HEADER.size))[:3]
+    except (OSError, struct.error):
+        return None
+    if magic != MAGIC or formatVersion != FORMAT_VERSION:
+        return None
+    return version
+
+
+def write_snapshot(file, version, rows):
+    """
+    Writes the QuestionRows, in list order, as a snapshot.
+    """
+    file.write(b"\0" * HEADER.size)
+    offset = HEADER.size
+    records = bytearray()
+    ids = []
+    categories = []
+    for position, row in enumerate(rows):
+        encoded = (QUESTION_TEMPLATE % tuple(encode_value(value) for value in row)).encode("ascii")
+        file.write(encoded)
+        category = NO_CATEGORY if row.category is None else row.category
+        records += RECORD.pack(row.id, category, offset, len(encoded))
+        offset += len(encoded)
+        ids.append(row.id)
+        if categories and categories[-1][0] == category:
+            categories[-1][2] += 1
+        else:
+            categories.append([category, position, 1])
+
+    recordsAt = offset
+    file.write(records)
+    idsAt = recordsAt + len(records)
+    for position in sorted(range(len(ids)), key=ids.__getitem__):
+        file.write(ID_ENTRY.pack(ids[position], position))
+    categoriesAt = idsAt + len(ids) * ID_ENTRY.size
+    for category, first, count in categories:
+        file.write(CATEGORY.pack(category, first, count))
+
+    file.seek(0)
+    file.write(HEADER.pack(MAGIC, FORMAT_VERSION, version, len(ids), len(categories),
+                           recordsAt, idsAt, categoriesAt))
+
+
+def build_snapshot(path, requested=0):
+    """
+    Writes a new snapshot of the questions table to path, unless the one
+    there was built from a read that started after requested (ns); returns
+    whether it wrote one.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    with open(path + ".lock", "a") as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        current = read_version(path)
+        if current is not None and current > requested:
+            return False
+
+        version = time.time_ns()
+        fd, tmpPath = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as file, use_primary():
+                query = select_questions().order_by(*QUESTION_ORDER)
+                rows = (QuestionRow._make(row) for row in db.session.execute(query))
+                write_snapshot(file, version, rows)
+            os.replace(tmpPath, path)
+        except BaseException:
+            os.remove(tmpPath)
+            raise
+    return True
+
+
+class SnapshotStore:
+    """
+    The snapshot a worker serves from, and its rebuilds.
+    """
+
+    def __init__(self, path, app, ttl=300):
+        self.path = path
+        self.app = app
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._snapshot = None
+        # changes made by this worker, and how many of them the file has
+        self._writes = 0
+        self._covered = 0
+        self._requested = 0
+        self._rebuilding = False
+        self.builds = 0
+        self.skipped_builds = 0
+        self.swaps = 0
+        self.fallbacks = 0
+        self.errors = 0
+
+    def _build(self, requested):
+        if build_snapshot(self.path, requested):
+            self.builds += 1
+        else:
+            self.skipped_builds += 1
+
+    def _open(self, identity):
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is not None and snapshot.identity == identity:
+                return snapshot
+            # the last reference to the old map closes it, so pages still
+            # being read from it stay valid
+            self._snapshot = Snapshot(self.path)
+            self.swaps += 1
+            return self._snapshot
+
+    def current(self):
+        """
+        The snapshot to read from, or None when reads should go to the
+        database.
+        """
+        if self._covered != self._writes:
+            self.fallbacks += 1
+            return None
+
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._build(0)
+            stat = os.stat(self.path)
+
+        try:
+            snapshot = self._open((stat.st_ino, stat.st_mtime_ns))
+        except SnapshotError as error:
+            logger.warning("not reading the question snapshot: %s", error)
+            self.errors += 1
+            self.fallbacks += 1
+            self.rebuild_in_background(time.time_ns())
+            return None
+
+        if time.time_ns() - snapshot.version >= self.ttl * 10 ** 9:
+            self.rebuild_in_background(snapshot.version + 1)
+        return snapshot
+
+    def changed(self):
+        with self._lock:
+            self._writes += 1
+        self.rebuild_in_background(time.time_ns())
+
+    def rebuild_in_background(self, requested):
+        with self._lock:
+            self._requested = max(self._requested, requested)
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+        threading.Thread(target=self._rebuild, daemon=True).start()
+
+    def _rebuild(self):
+        with self.app.app_context():
+            while True:
+                with self._lock:
+                    writes, requested = self._writes, self._requested
+                try:
+                    self._build(requested)
+                except Exception:
+                    logger.exception("could not rebuild the question snapshot")
+                    self.errors += 1
+                    with self._lock:
+                        self._rebuilding = False
+                    return
+                finally:
+                    db.session.remove()
+
+                with self._lock:
+                    self._covered = writes
+                    if self._writes == writes and self._requested == requested:
+                        self._rebuilding = False
+                        return
+
+    def stats(self):
+        snapshot = self._snapshot
+        return {
+            'questions': snapshot.count if snapshot is not None else None,
+            'bytes': snapshot.size if snapshot is not None else None,
+            'version': snapshot.version if snapshot is not None else None,
+            'builds': self.builds,
+            'skipped_builds': self.skipped_builds,
+            'swaps': self.swaps,
+            'fallbacks': self.fallbacks,
+            'errors': self.errors,
+            'ttl': self.ttl
+        }
+
+
+def init_question_snapshot(app):
+    """
+    Returns the SnapshotStore of the app, or None when QUESTION_SNAPSHOT_PATH
+    is not set.
+    """
+    path = app.config.get("QUESTION_SNAPSHOT_PATH")
+    if not path:
+        return None
+    store = SnapshotStore(path, app, ttl=app.config.get("QUESTION_SNAPSHOT_TTL", 300))
+    app.extensions['question_snapshot'] = store
+    return store
+
+
+def current_snapshot():
+    store = current_app.extensions.get('question_snapshot')
+    if store is None:
+        return None
+    return store.current()
+
+
+@on_question_change
+def _rebuild_question_snapshot(event, questions):
+    if not has_app_context():
+        return
+    store = current_app.extensions.get('question_snapshot')
+    if store is not None:
+        store.changed()
@@ -0,0 +1,52 @@
+"""
+Startup of prefork servers.
+
+With gunicorn's preload_app (see gunicorn.conf.py) the app is created once
+in the master process and the workers are forked from it. Loading the
+read-only state there, the categories and the in-memory indexes, lets
+every worker start with it already built, in memory pages shared with the
+master until they are changed, instead of each worker loading it from the
+database on its first requests.
+
+The connections opened while loading are closed before forking: a
+connection inherited by several processes would be used by all of them at
+once.
+"""
+
+import logging
+import time
+
+from models import db
+
+from .search import MemorySearchBackend
+
+logger = logging.getLogger(__name__)
+
+
+def dispose_engines(app):
+    for engine in db.engines(app).values():
+        engine.dispose()
+
+
+def preload_shared_state(app):
+    """
+    Loads the categories, the quiz and search indexes, the question counts,
+    the suggestion index and the question snapshot, then closes every
+    database connection.
+    """
+    start = time.perf_counter()
+    with app.app_context():
+        app.extensions['categories_cache'].get()
+        app.extensions['quiz_index'].count()
+        app.extensions['question_stats'].total()
+        app.extensions['suggest'].build(force=False)
+        search = app.extensions['search']
+        if isinstance(search, MemorySearchBackend):
+            search.index.load()
+        snapshots = app.extensions.get('question_snapshot')
+        if snapshots is not None:
+            # the workers inherit the map
+            snapshots.current()
+        db.session.remove()
+    dispose_engines(app)
+    logger.info("preloaded the shared state in %.0f ms", (time.perf_counter() - start) * 1000)
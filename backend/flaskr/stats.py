@@ -0,0 +1,154 @@
+"""
+Question counts per category and per difficulty.
+
+The counts are loaded with one GROUP BY query on first use, then kept up
+to date by the question change hooks, one increment or decrement per
+question inserted or deleted, so the paginated endpoints get their totals
+without a COUNT(*) over the table. They are reloaded from the table every
+STATS_RECONCILE_INTERVAL seconds, which corrects them for changes made by
+other worker processes, and after bulk changes.
+"""
+
+import threading
+import time
+from collections import Counter
+
+from flask import current_app, has_app_context
+from sqlalchemy import func, select
+
+from models import db, on_question_change, Question
+
+
+def count_key(value):
+    # categories and difficulties sent as strings count with the integers
+    return int(value) if value is not None else None
+
+
+class QuestionStats:
+    def __init__(self, loader, ttl=300):
+        self.loader = loader
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._categories = Counter()
+        self._difficulties = Counter()
+        self._total = 0
+        self._loaded_at = None
+        self.reconciles = 0
+        self.drift = 0
+
+    def _ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl:
+            return
+        categories, difficulties, total = Counter(), Counter(), 0
+        for category, difficulty, count in self.loader():
+            if category is not None:
+                categories[count_key(category)] += count
+            difficulties[count_key(difficulty)] += count
+            total += count
+        if self._loaded_at is not None:
+            # how far the counts had drifted from the table, e.g. because
+            # of changes made by other workers
+            self.drift += abs(total - self._total)
+            self.reconciles += 1
+        self._categories, self._difficulties, self._total = categories, difficulties, total
+        self._loaded_at = time.monotonic()
+
+    def _apply(self, question, step):
+        if question['category'] is not None:
+            self._categories[count_key(question['category'])] += step
+        self._difficulties[count_key(question['difficulty'])] += step
+        self._total += step
+
+    def add(self, question):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._apply(question, 1)
+
+    def remove(self, question):
+        with self._lock:
+            if self._loaded_at is not None:
+                self._apply(question, -1)
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded_at = None
+
+    def fresh(self):
+        """
+        True when total() will not have to load the counts first.
+        """
+        loadedAt = self._loaded_at
+        return loadedAt is not None and time.monotonic() - loadedAt < self.ttl
+
+    def peek(self, category=None):
+        """
+        total() when the counts are fresh, None instead of loading them.
+        Takes no lock, for the event loop of flaskr/asgi.py.
+        """
+        if not self.fresh():
+            return None
+        if category is None:
+            return self._total
+        return self._categories.get(count_key(category), 0)
+
+    def total(self, category=None):
+        """
+        Number of questions, of the given category or of all of them.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if category is None:
+                return self._total
+            return self._categories.get(count_key(category), 0)
+
+    def counts(self):
+        """
+        Returns (total, {category: count}, {difficulty: count}).
+        """
+        with self._lock:
+            self._ensure_loaded()
+            return self._total, dict(self._categories), dict(self._difficulties)
+
+    def stats(self):
+        return {
+            'loaded': self._loaded_at is not None,
+            'reconciles': self.reconciles,
+            'drift': self.drift,
+            'ttl': self.ttl
+        }
+
+
+def load_counts():
+    query = select([Question.category, Question.difficulty, func.count(Question.id)]) \
+        .group_by(Question.category, Question.difficulty)
+    return db.session.execute(query).fetchall()
+
+
+def init_question_stats(app):
+    stats = QuestionStats(load_counts, ttl=app.config.get("STATS_RECONCILE_INTERVAL", 300))
+    app.extensions['question_stats'] = stats
+    return stats
+
+
+def get_question_stats():
+    return current_app.extensions['question_stats']
+
+
+@on_question_change
+def _sync_question_stats(event, questions):
+    if not has_app_context():
+        return
+    stats = current_app.extensions.get('question_stats')
+    if stats is None:
+        return
+    if event == 'reload':
+        stats.invalidate()
+    for question in questions:
+        if event == 'insert':
+            stats.add(question)
+        elif event == 'delete':
+            stats.remove(question)
+        elif event == 'update':
+            before, after = question
+            stats.remove(before)
+            stats.add(after)
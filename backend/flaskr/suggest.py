@@ -0,0 +1,238 @@
+"""
+Search-as-you-type suggestions for GET /questions/suggest?q=.
+
+Every question is broken into the overlapping three-letter pieces of its
+lowercased text ("who discovered" -> "who", "ho ", "o d", " di", ...). The
+index maps each trigram to a sorted array of the ids of the questions that
+contain it. A query only has to look at the questions in the shortest
+array of its trigrams, check them against the other arrays with a binary
+search and confirm the substring on the text, stopping as soon as it has
+enough suggestions or has looked at MAX_CANDIDATES questions.
+
+Arrays of 32-bit ids keep the index compact; deleted ids are skipped at
+query time and dropped on the next rebuild. The index is built in the
+background when the app starts, kept in sync with Question.insert() and
+Question.delete() through the question change hooks, and rebuilt every
+SUGGEST_INDEX_TTL seconds to pick up changes made by other workers.
+"""
+
+import bisect
+import sys
+import threading
+import time
+from array import array
+
+from flask import current_app, has_app_context
+from sqlalchemy import select
+
+from models import db, on_question_change, Question
+
+# shorter queries match too many questions to be useful suggestions
+MIN_QUERY_LENGTH = 3
+
+# questions looked at per query at most; keeps the latency flat for queries
+# made only of very common trigrams, at the cost of missing a few matches
+MAX_CANDIDATES = 1000
+
+
+def normalize(text):
+    return " ".join(text.lower().split()) if text else ""
+
+
+def trigrams(text):
+    return {text[position:position + 3] for position in range(len(text) - 2)}
+
+
+class TrigramIndex:
+    def __init__(self, loader, ttl=300, app=None):
+        self.loader = loader
+        self.ttl = ttl
+        self.app = app
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._postings = {}
+        self._texts = {}
+        self._deleted = set()
+        # changes seen while a build is running, None when no build is
+        self._pending = None
+        self._loaded_at = None
+
+    def build(self, force=True):
+        # build outside the query lock and swap, so queries keep being
+        # answered from the old index during a rebuild
+        with self._build_lock:
+            if not force and self._loaded_at is not None:
+                return
+            with self._lock:
+                self._pending = []
+
+            postings = {}
+            texts = {}
+            for question_id, question in self.loader():
+                texts[question_id] = question
+                for trigram in trigrams(normalize(question)):
+                    posting = postings.get(trigram)
+                    if posting is None:
+                        posting = postings[trigram] = array('I')
+                    posting.append(question_id)
+
+            with self._lock:
+                deleted = set()
+                # replay the changes committed while the table was being read
+                for event, question_id, question in self._pending:
+                    if event == 'insert' and question_id not in texts:
+                        add_to_index(postings, texts, question_id, question)
+                    elif event == 'delete' and texts.pop(question_id, None) is not None:
+                        deleted.add(question_id)
+                self._pending = None
+
+                self._postings = postings
+                self._texts = texts
+                self._deleted = deleted
+                self._loaded_at = time.monotonic()
+
+    def build_in_background(self, force=True):
+        def run():
+            with self.app.app_context():
+                self.build(force)
+        threading.Thread(target=run, daemon=True).start()
+
+    def _ensure_loaded(self):
+        if self._loaded_at is None:
+            # the startup build may still be running, wait for it
+            self.build(force=False)
+        elif time.monotonic() - self._loaded_at >= self.ttl and self.app is not None:
+            with self._lock:
+                # only the first query past the TTL starts the rebuild
+                self._loaded_at = time.monotonic()
+            self.build_in_background()
+
+    def add(self, question_id, question):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(('insert', question_id, question))
+            if self._loaded_at is not None:
+                self._deleted.discard(question_id)
+                add_to_index(self._postings, self._texts, question_id, question)
+
+    def remove(self, question_id):
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append(('delete', question_id, None))
+            if self._loaded_at is not None and self._texts.pop(question_id, None) is not None:
+                self._deleted.add(question_id)
+
+    def suggest(self, query, limit=10):
+        query = normalize(query)
+        if len(query) < MIN_QUERY_LENGTH:
+            return []
+
+        self._ensure_loaded()
+        with self._lock:
+            postings = []
+            for trigram in trigrams(query):
+                posting = self._postings.get(trigram)
+                if posting is None:
+                    return []
+                postings.append(posting)
+            postings.sort(key=len)
+
+            suggestions = []
+            others = postings[1:]
+            for scanned, question_id in enumerate(postings[0]):
+                if scanned == MAX_CANDIDATES:
+                    break
+                if question_id in self._deleted:
+                    continue
+                for posting in others:
+                    position = bisect.bisect_left(posting, question_id)
+                    if position == len(posting) or posting[position] != question_id:
+                        break
+                else:
+                    question = self._texts[question_id]
+                    if query in normalize(question):
+                        suggestions.append({'id': question_id, 'question': question})
+                        if len(suggestions) == limit:
+                            break
+            return suggestions
+
+    def memory_usage(self):
+        """
+        Approximate bytes held by the index: arrays, their dict and the texts.
+        """
+        with self._lock:
+            size = sys.getsizeof(self._postings) + sys.getsizeof(self._texts)
+            size += sum(sys.getsizeof(trigram) + sys.getsizeof(posting)
+                        for trigram, posting in self._postings.items())
+            size += sum(sys.getsizeof(text) for text in self._texts.values())
+            return size
+
+    def stats(self):
+        with self._lock:
+            return {
+                'questions': len(self._texts),
+                'trigrams': len(self._postings),
+                'deleted': len(self._deleted),
+                'loaded': self._loaded_at is not None
+            }
+
+
+def add_to_index(postings, texts, question_id, question):
+    texts[question_id] = question
+    for trigram in trigrams(normalize(question)):
+        posting = postings.get(trigram)
+        if posting is None:
+            posting = postings[trigram] = array('I')
+        # new ids are nearly always the largest, keeping arrays sorted
+        if posting and posting[-1] >= question_id:
+            position = bisect.bisect_left(posting, question_id)
+            # a question added back, or edited, is already in its postings
+            if posting[position] != question_id:
+                posting.insert(position, question_id)
+        else:
+            posting.append(question_id)
+
+
+def load_suggest_documents():
+    return db.session.execute(
+        select([Question.id, Question.question]).order_by(Question.id)).fetchall()
+
+
+def init_suggest(app):
+    index = TrigramIndex(
+        load_suggest_documents,
+        ttl=app.config.get("SUGGEST_INDEX_TTL", 300),
+        app=app
+    )
+    app.extensions['suggest'] = index
+
+    if app.config.get("SUGGEST_PRELOAD", False):
+        index.build_in_background(force=False)
+
+    return index
+
+
+def suggest_questions(query, limit=10):
+    return current_app.extensions['suggest'].suggest(query, limit)
+
+
+@on_question_change
+def _sync_suggest_index(event, questions):
+    if not has_app_context():
+        return
+    index = current_app.extensions.get('suggest')
+    if index is None:
+        return
+    if event == 'reload':
+        # keep answering from the old index until the new one is ready
+        index.build_in_background()
+    for question in questions:
+        if event == 'insert':
+            index.add(question['id'], question['question'])
+        elif event == 'delete':
+            index.remove(question['id'])
+        elif event == 'update':
+            before, after = question
+            if before['question'] != after['question']:
+                index.remove(before['id'])
+                index.add(after['id'], after['question'])
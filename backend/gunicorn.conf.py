@@ -0,0 +1,26 @@
+"""
+gunicorn settings, used with `gunicorn -c gunicorn.conf.py` from the
+backend folder.
+
+The app is created once in the master (preload_app), so the schema is
+brought up to date once instead of once per worker, and the shared
+read-only state is loaded there before the workers are forked, see
+flaskr/startup.py.
+"""
+
+import os
+
+# read by settings.py when preload_app creates the app; the suggestion
+# index is built by on_starting, not by a background thread of the master
+os.environ.setdefault("DB_MIGRATE_ON_STARTUP", "true")
+
+wsgi_app = "wsgi:app"
+bind = os.getenv("GUNICORN_BIND", "127.0.0.1:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", 4))
+preload_app = True
+
+
+def on_starting(server):
+    # preload_app has already created the app when this hook runs
+    from flaskr.startup import preload_shared_state
+    preload_shared_state(server.app.wsgi())
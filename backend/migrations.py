@@ -0,0 +1,220 @@
+import logging
+import time
+from array import array
+
+import click
+from flask import current_app
+from sqlalchemy import Column, Float, Integer, MetaData, String, Table, func, inspect, select, text
+
+"""
+Schema migrations
+
+The version of the schema is kept in the schema_version table, one row per
+migration applied. migrate() creates the tables that do not exist yet from
+the models, then runs the migrations newer than the recorded version, in
+order, and records them, all in one transaction. Migrations check what is
+already there before changing it, so they also bring databases created by
+db.create_all() or loaded from trivia.psql, which have no schema_version,
+up to date.
+
+To change the schema, change the model and append a migration to
+MIGRATIONS that does the same to existing databases.
+"""
+
+logger = logging.getLogger(__name__)
+
+version_metadata = MetaData()
+
+schema_version = Table(
+    'schema_version', version_metadata,
+    Column('version', Integer, primary_key=True),
+    Column('description', String),
+    Column('applied_at', Float)
+)
+
+# any number, as long as no other code takes the same advisory lock
+MIGRATION_LOCK = 74381
+
+
+class MigrationError(Exception):
+    pass
+
+
+def integer_category(connection):
+    inspector = inspect(connection)
+    columns = {column['name']: column for column in inspector.get_columns('questions')}
+    isInteger = isinstance(columns['category']['type'], Integer)
+    hasForeignKey = any(foreignKey['constrained_columns'] == ['category']
+                        for foreignKey in inspector.get_foreign_keys('questions'))
+    if isInteger and hasForeignKey:
+        return
+
+    # questions of categories that no longer exist would break the key
+    connection.execute(text(
+        "UPDATE questions SET category = NULL WHERE category IS NOT NULL "
+        "AND CAST(category AS INTEGER) NOT IN (SELECT id FROM categories)"))
+
+    if connection.dialect.name == 'postgresql':
+        if not isInteger:
+            connection.execute(text(
+                "ALTER TABLE questions ALTER COLUMN category TYPE INTEGER "
+                "USING category::integer"))
+        if not hasForeignKey:
+            connection.execute(text(
+                "ALTER TABLE questions ADD CONSTRAINT questions_category_fkey "
+                "FOREIGN KEY (category) REFERENCES categories (id) "
+                "ON UPDATE CASCADE ON DELETE SET NULL"))
+        return
+
+    # SQLite can not change a column, the table is copied instead
+    connection.execute(text("ALTER TABLE questions RENAME TO questions_old"))
+    connection.execute(text(
+        "CREATE TABLE questions ("
+        "id INTEGER NOT NULL PRIMARY KEY, question VARCHAR, answer VARCHAR, "
+        "category INTEGER REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL, "
+        "difficulty INTEGER)"))
+    connection.execute(text(
+        "INSERT INTO questions (id, question, answer, category, difficulty) "
+        "SELECT id, question, answer, CAST(category AS INTEGER), difficulty FROM questions_old"))
+    connection.execute(text("DROP TABLE questions_old"))
+
+
+def hot_query_indexes(connection):
+    # the pages of a category and the quiz filter, and the export filter
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_category_id ON questions (category, id)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_difficulty ON questions (difficulty)"))
+
+    duplicates = connection.execute(text(
+        "SELECT COUNT(*) FROM (SELECT question FROM questions "
+        "GROUP BY question HAVING COUNT(*) > 1) AS duplicates")).scalar()
+    if duplicates:
+        raise MigrationError(
+            "{} questions are in the table more than once, remove the copies "
+            "before migrating".format(duplicates))
+
+    # the duplicate check of POST /questions and of the bulk import; on
+    # Postgres the index is on md5(question) so long questions stay cheap to
+    # index, see read_models.question_matches()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_questions_question_md5 "
+            "ON questions (md5(question))"))
+    else:
+        connection.execute(text(
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_questions_question ON questions (question)"))
+
+
+def search_index(connection):
+    # the full-text search of flaskr/search.py; the expression, with the
+    # configuration as a literal, must be the one the searches use
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_questions_question_tsv "
+            "ON questions USING GIN (to_tsvector('english'::regconfig, question))"))
+
+
+def quiz_session_seen(connection):
+    # the questions asked in a quiz session become rows of their own, so a
+    # round appends its questions instead of rewriting the whole list
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS quiz_session_seen ("
+            "id SERIAL PRIMARY KEY, token VARCHAR(64), question_id INTEGER)"))
+    else:
+        connection.execute(text(
+            "CREATE TABLE IF NOT EXISTS quiz_session_seen ("
+            "id INTEGER NOT NULL PRIMARY KEY, token VARCHAR(64), question_id INTEGER)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_quiz_session_seen_token ON quiz_session_seen (token)"))
+
+    inspector = inspect(connection)
+    if 'quiz_sessions' not in inspector.get_table_names():
+        return
+    if 'seen' not in {column['name'] for column in inspector.get_columns('quiz_sessions')}:
+        return
+    # the sessions in play keep what they have asked
+    for token, seen in connection.execute(text(
+            "SELECT token, seen FROM quiz_sessions WHERE seen IS NOT NULL")).fetchall():
+        questionIds = array('q')
+        questionIds.frombytes(seen)
+        if questionIds:
+            connection.execute(text(
+                "INSERT INTO quiz_session_seen (token, question_id) VALUES (:token, :question_id)"),
+                [{'token': token, 'question_id': questionId} for questionId in questionIds])
+    # SQLite keeps the column, which nothing reads any more
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("ALTER TABLE quiz_sessions DROP COLUMN seen"))
+
+
+def nulls_first_category_index(connection):
+    # the lists put questions without a category first, see
+    # flaskr/pagination.py; Postgres keeps NULLs last in an index unless told
+    # otherwise and could not read the pages in index order. SQLite already
+    # keeps them first.
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text("DROP INDEX IF EXISTS ix_questions_category_id"))
+        connection.execute(text(
+            "CREATE INDEX ix_questions_category_id ON questions (category NULLS FIRST, id)"))
+
+
+# (version, description, migration), in order; never change or remove one
+# that has been released, add a new one
+MIGRATIONS = [
+    (1, "integer category with a foreign key to categories", integer_category),
+    (2, "indexes on (category, id), difficulty and the question text", hot_query_indexes),
+    (3, "full-text search index on the question text (Postgres only)", search_index),
+    (4, "one row per question asked in a quiz session", quiz_session_seen),
+    (5, "questions without a category first in the (category, id) index (Postgres only)",
+     nulls_first_category_index),
+]
+
+
+def current_version(connection):
+    version_metadata.create_all(connection)
+    return connection.execute(select([func.max(schema_version.c.version)])).scalar() or 0
+
+
+def migrate(engine, metadata):
+    """
+    Brings the schema of the database up to date; returns its version.
+    """
+    with engine.begin() as connection:
+        if connection.dialect.name == 'postgresql':
+            # workers starting together take turns; the others find it done
+            connection.execute(text("SELECT pg_advisory_xact_lock({})".format(MIGRATION_LOCK)))
+
+        version = current_version(connection)
+        if version == 0:
+            metadata.create_all(connection)
+
+        for number, description, migration in MIGRATIONS:
+            if number <= version:
+                continue
+            migration(connection)
+            connection.execute(schema_version.insert().values(
+                version=number, description=description, applied_at=time.time()))
+            logger.info("migrated the schema to version %s: %s", number, description)
+            version = number
+    return version
+
+
+def migrate_current_app():
+    database = current_app.extensions['sqlalchemy'].db
+    version = migrate(database.get_engine(current_app), database.metadata)
+    click.echo("schema version {}".format(version))
+
+
+def register_migrate_command(app):
+    @app.cli.command("migrate")
+    def migrate_command():
+        """Bring the database schema up to date."""
+        migrate_current_app()
+
+    # the same as migrate, under the name deploy scripts look for; run it
+    # once per deploy when DB_MIGRATE_ON_STARTUP is false
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create the tables and bring the database schema up to date."""
+        migrate_current_app()
@@ -1,29 +1,67 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
-from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import Column, String, Integer, Float, ForeignKey, Index, create_engine
 import json
-from config import SQLALCHEMY_DATABASE_URI
+from config import SQLALCHEMY_DATABASE_URI, SQLALCHEMY_REPLICA_URIS
+from engine import Database, ReplicaRouter
+from migrations import migrate
 
 database_name = 'trivia'
 database_password = 'postgres'
 database_user = 'postgres'
 database_host = 'localhost:5432'
 database_path = SQLALCHEMY_DATABASE_URI
+replica_paths = SQLALCHEMY_REPLICA_URIS
 
-db = SQLAlchemy()
+db = Database()
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service and, when
+    DB_MIGRATE_ON_STARTUP is true, brings the schema up to date, see
+    migrations.py; replica_paths are read replicas, registered as the binds
+    replica_1, replica_2, ...
 """
 
 
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=database_path, replica_paths=replica_paths):
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    binds = {'replica_{}'.format(number): path
+             for number, path in enumerate(replica_paths or [], start=1)}
+    if binds:
+        app.config["SQLALCHEMY_BINDS"] = binds
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
-    db.create_all()
+    # the replicas get their schema from the primary
+    if app.config.get("DB_MIGRATE_ON_STARTUP", False):
+        migrate(db.get_engine(app), db.metadata)
+    app.extensions['replicas'] = ReplicaRouter(
+        db, app, list(binds), app.config.get("DB_REPLICA_RETRY", 30))
+
+
+"""
+Question change hooks
+
+Functions registered with on_question_change(listener) are called as
+listener(event, questions) once a change to the questions table has been
+committed. event is 'insert' or 'delete' and questions is a list of
+formatted questions, 'update' and questions is a list of (before, after)
+pairs of formatted questions, or 'reload' with an empty list when many rows
+changed at once and the listener should reload from the table. They keep
+the in-memory indexes in sync with the table.
+"""
+
+question_listeners = []
+
+
+def on_question_change(listener):
+    question_listeners.append(listener)
+    return listener
+
+
+def notify_question_change(event, questions):
+    for listener in question_listeners:
+        listener(event, questions)
 
 
 """
@@ -34,11 +72,18 @@ Question
 
 class Question(db.Model):
     __tablename__ = 'questions'
+    # plus a unique index on the question text, added by migrations.py as it
+    # differs between databases; on Postgres the (category, id) index is
+    # remade with NULLS FIRST by migrations.py, to match the list order
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_difficulty', 'difficulty'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id', onupdate='CASCADE', ondelete='SET NULL'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -49,14 +94,20 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        # flush first so the new id is known before the commit expires it
+        db.session.flush()
+        question = self.format()
         db.session.commit()
+        notify_question_change('insert', [question])
 
     def update(self):
         db.session.commit()
 
     def delete(self):
+        question = self.format()
         db.session.delete(self)
         db.session.commit()
+        notify_question_change('delete', [question])
 
     def format(self):
         return {
@@ -88,3 +139,28 @@ class Category(db.Model):
             'id': self.id,
             'type': self.type
         }
+
+
+"""
+QuizSession, QuizSessionSeen
+    a quiz played through /quizzes/sessions and the questions it has asked,
+    one row each, used by the database backend of flaskr/quiz_sessions.py
+
+"""
+
+
+class QuizSession(db.Model):
+    __tablename__ = 'quiz_sessions'
+
+    token = Column(String(64), primary_key=True)
+    category = Column(Integer)
+    expires_at = Column(Float, index=True)
+
+
+class QuizSessionSeen(db.Model):
+    __tablename__ = 'quiz_session_seen'
+
+    # in the order the questions were asked
+    id = Column(Integer, primary_key=True)
+    token = Column(String(64), index=True)
+    question_id = Column(Integer)
@@ -6,3 +6,137 @@ DB_HOST = os.getenv('DB_HOST', '127.0.0.1:5432')
 DB_USER = os.getenv('DB_USER', 'postgres')
 DB_PASSWORD = os.getenv('DB_PASSWORD', 'postgres')
 DB_NAME = os.getenv('DB_NAME', 'trivia')
+
+# categories are cached in memory per app, see flaskr/cache.py
+CATEGORIES_CACHE_TTL = int(os.getenv('CATEGORIES_CACHE_TTL', 300))
+# optional file shared by all workers on the host; touching it makes every
+# worker drop its cached categories
+CATEGORIES_CACHE_VERSION_FILE = os.getenv('CATEGORIES_CACHE_VERSION_FILE', None)
+
+# the quiz keeps the question ids in memory, see flaskr/quiz.py; the index
+# is rebuilt after this many seconds to pick up other workers' changes
+QUIZ_INDEX_TTL = int(os.getenv('QUIZ_INDEX_TTL', 300))
+# most questions one POST /quizzes with "count" returns
+QUIZ_BATCH_MAX = int(os.getenv('QUIZ_BATCH_MAX', 50))
+
+# quiz sessions, see flaskr/quiz_sessions.py: "memory", "database" or a
+# "module:ClassName" store, and the idle time after which a session expires
+QUIZ_SESSION_BACKEND = os.getenv('QUIZ_SESSION_BACKEND', 'memory')
+QUIZ_SESSION_TTL = int(os.getenv('QUIZ_SESSION_TTL', 3600))
+
+# search, see flaskr/search.py: "auto", "postgres" or "memory", and how
+# often the in-memory index is rebuilt to pick up other workers' changes
+SEARCH_BACKEND = os.getenv('SEARCH_BACKEND', 'auto')
+SEARCH_INDEX_TTL = int(os.getenv('SEARCH_INDEX_TTL', 300))
+
+# search-as-you-type suggestions, see flaskr/suggest.py; the index is built
+# on the first suggestion, or in a background thread started by create_app
+# when SUGGEST_PRELOAD is true (gunicorn builds it in the master instead)
+SUGGEST_INDEX_TTL = int(os.getenv('SUGGEST_INDEX_TTL', 300))
+SUGGEST_PRELOAD = os.getenv('SUGGEST_PRELOAD', 'false').lower() == 'true'
+
+# database engine, see engine.py; DATABASE_URL replaces the DB_* settings
+# above and DATABASE_REPLICA_URL is an optional, comma separated list of
+# read replicas
+DATABASE_URL = os.getenv('DATABASE_URL', None)
+DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL', None)
+# seconds a replica that could not be reached is left out of the rotation
+DB_REPLICA_RETRY = int(os.getenv('DB_REPLICA_RETRY', 30))
+# seconds after a write during which the same client reads from the
+# primary, see flaskr/routing.py; 0 disables it
+READ_YOUR_WRITES_WINDOW = int(os.getenv('READ_YOUR_WRITES_WINDOW', 0))
+# signs the read-your-writes cookie; set the same key on every host
+SECRET_KEY = os.getenv('SECRET_KEY', None)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+# seconds after which a connection is replaced, and whether connections are
+# tested before use; both avoid handing out connections dropped by a failover
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# milliseconds, 0 disables the timeout (Postgres only)
+DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+# whether create_app brings the schema up to date, see migrations.py; by
+# default creating the app opens no connection and the schema is set up
+# once per deploy with `flask init-db` (gunicorn.conf.py turns it on, the
+# master migrates once before forking)
+DB_MIGRATE_ON_STARTUP = os.getenv('DB_MIGRATE_ON_STARTUP', 'false').lower() == 'true'
+
+# responses of the list endpoints, see flaskr/response_cache.py: "memory"
+# or a "module:ClassName" backend, the number of bodies kept in memory,
+# how long a body is kept and the max-age sent to clients (0 sends
+# no-cache, clients revalidate with If-None-Match)
+RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', 1024))
+RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', 60))
+RESPONSE_CACHE_MAX_AGE = int(os.getenv('RESPONSE_CACHE_MAX_AGE', 0))
+# optional file shared by all workers on the host, so that a change made in
+# one worker changes the ETags of all of them
+RESPONSE_CACHE_VERSION_FILE = os.getenv('RESPONSE_CACHE_VERSION_FILE', None)
+# concurrent identical reads share one execution, see
+# flaskr/single_flight.py; seconds a request waits for the one in flight
+# before running its own, 0 disables coalescing
+SINGLE_FLIGHT_TIMEOUT = float(os.getenv('SINGLE_FLIGHT_TIMEOUT', 5))
+
+# admission control, see flaskr/admission.py; everything is off until a
+# rate or a cap is set. Per client: ADMISSION_RATE requests per second with
+# bursts of ADMISSION_BURST, a search or bulk request counting as
+# ADMISSION_LOW_PRIORITY_COST; the client is the address of the connection
+# unless ADMISSION_CLIENT_HEADER names a header such as X-Forwarded-For, of
+# which the address appended by the outermost of ADMISSION_TRUSTED_PROXIES
+# proxies is used.
+# Per worker: requests running at once, in all, low-priority and per route
+# ("search=4,POST /questions/bulk=1"), and the seconds a request over a
+# cap waits for a slot before a 503. "memory" keeps the rate limits per
+# worker, a "module:ClassName" backend can share them
+ADMISSION_BACKEND = os.getenv('ADMISSION_BACKEND', 'memory')
+ADMISSION_RATE = float(os.getenv('ADMISSION_RATE', 0))
+ADMISSION_BURST = int(os.getenv('ADMISSION_BURST', 20))
+ADMISSION_LOW_PRIORITY_COST = int(os.getenv('ADMISSION_LOW_PRIORITY_COST', 5))
+ADMISSION_CLIENT_HEADER = os.getenv('ADMISSION_CLIENT_HEADER', None)
+ADMISSION_TRUSTED_PROXIES = int(os.getenv('ADMISSION_TRUSTED_PROXIES', 1))
+ADMISSION_MAX_CONCURRENCY = int(os.getenv('ADMISSION_MAX_CONCURRENCY', 0))
+ADMISSION_LOW_PRIORITY_CONCURRENCY = int(os.getenv('ADMISSION_LOW_PRIORITY_CONCURRENCY', 0))
+ADMISSION_ROUTE_LIMITS = os.getenv('ADMISSION_ROUTE_LIMITS', None)
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 1))
+
+# ASGI entry point, see flaskr/asgi.py: "auto" uses the async driver of the
+# `databases` package when it is installed, "threads" the thread pool, and
+# the size of the pool that runs sync work and the requests handed to Flask
+ASGI_DB_BACKEND = os.getenv('ASGI_DB_BACKEND', 'auto')
+ASGI_THREADS = int(os.getenv('ASGI_THREADS', 16))
+
+# per-route timings, see flaskr/instrumentation.py: off by default; requests
+# slower than INSTRUMENTATION_SLOW_MS are counted as slow, and the share of
+# requests that is profiled, with the profiles of the slow ones written to
+# INSTRUMENTATION_PROFILE_DIR
+INSTRUMENTATION = os.getenv('INSTRUMENTATION', 'false').lower() == 'true'
+INSTRUMENTATION_SLOW_MS = int(os.getenv('INSTRUMENTATION_SLOW_MS', 500))
+INSTRUMENTATION_PROFILE_RATE = float(os.getenv('INSTRUMENTATION_PROFILE_RATE', 0.01))
+INSTRUMENTATION_PROFILE_DIR = os.getenv('INSTRUMENTATION_PROFILE_DIR', None)
+
+# logging, see flaskr/logs.py: the level of all loggers, per logger
+# overrides such as "flaskr.search=DEBUG,werkzeug=WARNING", "json" or "text"
+# lines, the records held for the writer thread before new ones are dropped,
+# and the share of requests whose payloads are logged at DEBUG
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')
+LOG_LEVELS = os.getenv('LOG_LEVELS', None)
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_PAYLOAD_SAMPLE = float(os.getenv('LOG_PAYLOAD_SAMPLE', 0.01))
+
+# questions encoded to JSON are kept per id, see flaskr/serialize.py; 0
+# encodes them on every request
+JSON_FRAGMENT_CACHE_SIZE = int(os.getenv('JSON_FRAGMENT_CACHE_SIZE', 10000))
+
+# question counts per category and difficulty, see flaskr/stats.py; they
+# are kept up to date by this worker's changes and reloaded from the table
+# after this many seconds to pick up other workers' changes
+STATS_RECONCILE_INTERVAL = int(os.getenv('STATS_RECONCILE_INTERVAL', 300))
+
+# memory-mapped snapshot of the questions shared by the workers of a host,
+# see flaskr/snapshot.py; off unless a path is given, whose directory must
+# be writable by every worker; rebuilt after changes and every
+# QUESTION_SNAPSHOT_TTL seconds
+QUESTION_SNAPSHOT_PATH = os.getenv('QUESTION_SNAPSHOT_PATH', None)
+QUESTION_SNAPSHOT_TTL = int(os.getenv('QUESTION_SNAPSHOT_TTL', 300))
@@ -1,10 +1,30 @@
+import asyncio
 import os
+from array import array
 import unittest
 import json
+import logging
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.dialects import postgresql
 
 from flaskr import create_app
-from models import setup_db, Question, Category
+from flaskr import logs
+from flaskr.asgi import AsgiApp, create_asgi_app
+from flaskr.pagination import QUESTION_ORDER
+from flaskr.read_models import select_questions
+from flaskr.serialize import FragmentJSONEncoder
+from flaskr.single_flight import SingleFlight
+from flaskr.snapshot import current_snapshot
+from flaskr.startup import preload_shared_state
+from models import setup_db, db, Question, Category
+from engine import InstrumentedQueuePool
+from migrations import MigrationError, migrate
 
 from config import SQLALCHEMY_DATABASE_URI
 
@@ -60,6 +80,208 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], False)
         self.assertEqual(data["message"], "resource not found")
 
+    def test_categories_served_from_cache(self):
+        self.client().get("/categories")
+        self.client().get("/questions")
+        res = self.client().get("/metrics")
+        data = json.loads(res.data)
+
+        # the second lookup must not go back to the database
+        stats = data['metrics']['categories_cache']
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['hits'], 1)
+
+    def test_categories_cache_dropped_after_category_commit(self):
+        with self.app.app_context():
+            cache = self.app.extensions['categories_cache']
+            cache.get()
+
+            category = Category(type='Cache test')
+            db.session.add(category)
+            db.session.commit()
+            self.assertIn('Cache test', cache.get().values())
+
+            db.session.delete(category)
+            db.session.commit()
+            self.assertNotIn('Cache test', cache.get().values())
+            self.assertEqual(cache.invalidations, 2)
+
+    def test_304_sent_with_current_etag_without_database_access(self):
+        res = self.client().get("/categories")
+        etag = res.headers["ETag"]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers["Cache-Control"], "no-cache")
+
+        statements = []
+        with self.app.app_context():
+            engine = db.get_engine(self.app)
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(engine, "before_cursor_execute", record)
+        self.addCleanup(event.remove, engine, "before_cursor_execute", record)
+        res = self.client().get("/categories", headers={"If-None-Match": etag})
+
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res.headers["ETag"], etag)
+        self.assertEqual(statements, [])
+
+        stats = json.loads(self.client().get("/metrics").data)["metrics"]["response_cache"]
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["not_modified"], 1)
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_etag_changes_after_question_insert(self):
+        etag = self.client().get("/questions").headers["ETag"]
+        self.assertEqual(self.client().get("/questions").headers["ETag"], etag)
+        self.assertNotEqual(self.client().get("/questions?page=2").headers["ETag"], etag)
+
+        with self.app.app_context():
+            question = Question(question="ETag test", answer="Yes", category=1, difficulty=1)
+            question.insert()
+            res = self.client().get("/questions", headers={"If-None-Match": etag})
+            question.delete()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res.headers["ETag"], etag)
+
+    def test_concurrent_identical_reads_share_one_execution(self):
+        app = create_app({'RESPONSE_CACHE_SIZE': 0, 'SUGGEST_PRELOAD': False})
+        singleFlight = app.extensions['single_flight']
+        with app.app_context():
+            engine = db.get_engine(app)
+
+        # the first request holds its queries until the others are waiting on it
+        release = threading.Event()
+        threads = []
+        def hold(conn, cursor, statement, *args):
+            release.wait(5)
+        event.listen(engine, "before_cursor_execute", hold)
+        self.addCleanup(event.remove, engine, "before_cursor_execute", hold)
+
+        responses = []
+        def get():
+            responses.append(app.test_client().get("/questions?page=1"))
+        for _ in range(8):
+            threads.append(threading.Thread(target=get))
+            threads[-1].start()
+        deadline = time.monotonic() + 5
+        while time.monotonic() < deadline and not any(
+                call.followers == 7 for call in list(singleFlight._calls.values())):
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual([res.status_code for res in responses], [200] * 8)
+        self.assertEqual(len(set(res.data for res in responses)), 1)
+        stats = json.loads(app.test_client().get("/metrics").data)["metrics"]["single_flight"]
+        self.assertEqual(stats["executions"], 1)
+        self.assertEqual(stats["saved"], 7)
+
+    def test_single_flight_followers_run_alone_after_timeout_or_failure(self):
+        singleFlight = SingleFlight(timeout=0.05)
+        started, release = threading.Event(), threading.Event()
+        def slow():
+            started.set()
+            release.wait(5)
+            raise ValueError("leader failed")
+        def leader():
+            with self.assertRaises(ValueError):
+                singleFlight.do("key", slow)
+        thread = threading.Thread(target=leader)
+        thread.start()
+        started.wait(5)
+
+        # the leader is still running: the follower gives up waiting
+        self.assertEqual(singleFlight.do("key", lambda: "own"), "own")
+        # with a longer timeout it waits, and runs alone when the leader fails
+        follower = threading.Thread(target=lambda: results.append(
+            singleFlight.do("key", lambda: "retried", timeout=5)))
+        results = []
+        follower.start()
+        time.sleep(0.05)
+        release.set()
+        thread.join()
+        follower.join()
+
+        self.assertEqual(results, ["retried"])
+        self.assertEqual(singleFlight.timeouts, 1)
+        self.assertEqual(singleFlight.retries, 1)
+        self.assertEqual(singleFlight.shared, 0)
+
+    # ====================================================================================
+    # Tests for /healthz and the connection pool
+    # ====================================================================================
+    def test_healthz(self):
+        res = self.client().get("/healthz")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["database"]["primary"]["ok"], True)
+
+        res = self.client().get("/metrics")
+        data = json.loads(res.data)
+        self.assertIn("primary", data["metrics"]["database"])
+
+    def test_pool_counts_checkouts_and_timeouts(self):
+        pool = InstrumentedQueuePool(
+            lambda: sqlite3.connect(":memory:"), pool_size=1, max_overflow=0, timeout=0.01)
+        connection = pool.connect()
+        with self.assertRaises(exc.TimeoutError):
+            pool.connect()
+        connection.close()
+        pool.connect().close()
+
+        stats = pool.stats.format()
+        self.assertEqual(stats["checkouts"], 2)
+        self.assertEqual(stats["checkins"], 2)
+        self.assertEqual(stats["connects"], 1)
+        self.assertEqual(stats["timeouts"], 1)
+        self.assertIs(pool.recreate().stats, pool.stats)
+
+    # ====================================================================================
+    # Tests for /stats
+    # ====================================================================================
+    def test_stats_match_the_table(self):
+        res = self.client().get("/stats")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["totalQuestions"], Question.query.count())
+        self.assertEqual(data["categories"]["2"],
+                         Question.query.filter(Question.category == 2).count())
+        self.assertEqual(sum(data["difficulties"].values()), data["totalQuestions"])
+
+    def test_stats_follow_inserts_and_deletes(self):
+        before = json.loads(self.client().get("/stats").data)
+
+        res = self.client().post('/questions', json={
+            'question': 'Test question counted in the stats',
+            'answer': 'Counted',
+            'difficulty': '4',
+            'category': '2'
+        })
+        self.assertEqual(res.status_code, 200)
+        question_id = Question.query.filter(
+            Question.question == 'Test question counted in the stats').one().id
+
+        data = json.loads(self.client().get("/stats").data)
+        self.assertEqual(data["totalQuestions"], before["totalQuestions"] + 1)
+        self.assertEqual(data["categories"]["2"], before["categories"]["2"] + 1)
+        self.assertEqual(data["difficulties"]["4"], before["difficulties"].get("4", 0) + 1)
+        page = json.loads(self.client().get("/questions").data)
+        self.assertEqual(page["totalQuestions"], Question.query.count())
+        page = json.loads(self.client().get("/categories/2/questions").data)
+        self.assertEqual(page["totalQuestions"], data["categories"]["2"])
+
+        self.client().delete('/questions/{}'.format(question_id))
+        data = json.loads(self.client().get("/stats").data)
+        self.assertEqual(data["totalQuestions"], before["totalQuestions"])
+        self.assertEqual(data["categories"]["2"], before["categories"]["2"])
+
     # ====================================================================================
     # Tests for /questions?page=${integer}
     # ====================================================================================
@@ -77,8 +299,70 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['categories'])
         self.assertTrue(data['currentCategory'])
 
-        # confirm that total number of questions are valid
-        self.assertEqual(len(data['questions']), data['totalQuestions'])
+        # confirm that totalQuestions counts every question, not just this page
+        self.assertEqual(data['totalQuestions'], Question.query.count())
+        self.assertLessEqual(len(data['questions']), 10)
+
+    def test_get_questions_after_cursor(self):
+        res = self.client().get("/questions")
+        firstPage = json.loads(res.data)
+
+        res = self.client().get(
+            "/questions?after={}".format(firstPage['nextCursor']))
+        data = json.loads(res.data)
+
+        # the keyset cursor continues exactly where page 1 stopped
+        res = self.client().get("/questions?page=2")
+        secondPage = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data['questions'], secondPage['questions'])
+        self.assertEqual(data['totalQuestions'], firstPage['totalQuestions'])
+
+    def test_400_sent_with_malformed_cursor(self):
+        res = self.client().get("/questions?after=notacursor")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+        res = self.client().get("/questions?after=abc,1")
+        self.assertEqual(res.status_code, 400)
+
+    def test_cursors_walk_questions_without_category(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config = {'SQLALCHEMY_DATABASE_URI': "sqlite:///" + os.path.join(directory, "walk.db"),
+                  'DB_MIGRATE_ON_STARTUP': True}
+        app = create_app(config)
+        with app.app_context():
+            db.session.add(Category("Science"))
+            db.session.commit()
+            for number in range(25):
+                # 15 questions whose category was deleted
+                db.session.add(Question("Walk {}?".format(number), "Yes",
+                                        1 if number % 2 and number > 3 else None, 1))
+            db.session.commit()
+        snapshotApp = create_app(dict(config, QUESTION_SNAPSHOT_PATH=os.path.join(directory, "snapshot")))
+        self.wait_for_snapshot(snapshotApp)
+
+        self.assertEqual(json.loads(app.test_client().get("/questions").data)["nextCursor"], "null,15")
+        for name, get in [
+                ("flask", lambda path: json.loads(app.test_client().get(path).data)),
+                ("snapshot", lambda path: json.loads(snapshotApp.test_client().get(path).data)),
+                ("asgi", lambda path: self.asgi_request(AsgiApp(app), "GET", path)[1])]:
+            walked, page, path = [], 1, "/questions"
+            while True:
+                data = get(path)
+                self.assertEqual(data, get("/questions?page={}".format(page)), name)
+                walked += data["questions"]
+                if data["nextCursor"] is None:
+                    break
+                path, page = "/questions?after=" + data["nextCursor"], page + 1
+
+            self.assertEqual([question["category"] for question in walked], [None] * 15 + [1] * 10, name)
+            self.assertEqual(len({question["id"] for question in walked}), 25, name)
 
     # requesting beyond valid page number
 
@@ -106,8 +390,9 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['questions'])
         self.assertEqual(data['currentCategory'], 'Art')
 
-        # confirm that total number of questions are valid
-        self.assertEqual(len(data['questions']), data['totalQuestions'])
+        # confirm that totalQuestions counts every question in the category
+        self.assertEqual(data['totalQuestions'], Question.query.filter(
+            Question.category == 2).count())
 
     # requesting beyond valid category id
     def test_404_sent_requesting_beyond_valid_categories(self):
@@ -162,6 +447,185 @@ class TriviaTestCase(unittest.TestCase):
             Question.answer == testQuestion['answer']).one_or_none()
         self.assertIsNone(question)
         self.assertTrue(res.status_code, 422)
+    def test_400_adding_question_with_bad_category_or_difficulty(self):
+        total = Question.query.count()
+        for changes in [{'category': "abc"}, {'category': 99}, {'category': [1]},
+                        {'difficulty': "hard"}, {'difficulty': 6}]:
+            testQuestion = dict({
+                'question': 'Refused question?',
+                'answer': 'Yes',
+                'difficulty': 1,
+                'category': 1
+            }, **changes)
+
+            res = self.client().post('/questions', json=testQuestion)
+            data = json.loads(res.data)
+
+            self.assertEqual(res.status_code, 400, changes)
+            self.assertEqual(data['success'], False)
+        self.assertEqual(Question.query.count(), total)
+        res = self.client().get('/stats')
+        self.assertEqual(json.loads(res.data)['totalQuestions'], total)
+
+    # ====================================================================================
+    # bulk import
+    # Tests for /questions/bulk method = ['POST']
+    # ====================================================================================
+    def test_bulk_import_reports_every_row(self):
+        rows = [
+            {'question': 'Bulk test question one?', 'answer': 'One',
+             'difficulty': 1, 'category': 1},
+            {'question': 'Bulk test question two?', 'answer': 'Two',
+             'difficulty': 2, 'category': 2},
+            {'question': 'Bulk test question one?', 'answer': 'Again',
+             'difficulty': 1, 'category': 1},
+            {'question': 'Bulk test question three?', 'answer': 'Three',
+             'difficulty': 9, 'category': 1},
+        ]
+        body = "\n".join(json.dumps(row) for row in rows)
+        res = self.client().post('/questions/bulk', data=body,
+                                 content_type='application/x-ndjson')
+        data = json.loads(res.data)
+
+        inserted = Question.query.filter(
+            Question.question.like('Bulk test question%')).all()
+        for question in inserted:
+            question.delete()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['duplicates'], 1)
+        self.assertEqual(data['failed'], 1)
+        self.assertEqual([error['row'] for error in data['errors']], [3, 4])
+        self.assertEqual(len(inserted), 2)
+
+    def test_bulk_import_csv_skips_existing_questions(self):
+        existing = Question.query.first()
+        body = "question,answer,difficulty,category\n\"{}\",x,1,1\n".format(
+            existing.question)
+        res = self.client().post('/questions/bulk', data=body,
+                                 content_type='text/csv')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['inserted'], 0)
+        self.assertEqual(data['duplicates'], 1)
+
+    def test_400_bulk_import_unknown_format(self):
+        res = self.client().post('/questions/bulk', data='<xml/>',
+                                 content_type='application/xml')
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertEqual(data['success'], False)
+
+    # ====================================================================================
+    # batch changes
+    # Tests for /questions method = ['PATCH', 'DELETE']
+    # ====================================================================================
+    def test_batch_update_and_delete(self):
+        self.client().post('/questions/bulk', json=[
+            {'question': 'Batch test question {}?'.format(number), 'answer': 'Batch',
+             'difficulty': 1, 'category': 1} for number in range(3)])
+        ids = [question.id for question in Question.query.filter(
+            Question.question.like('Batch test question%'))]
+        before = json.loads(self.client().get("/stats").data)
+
+        res = self.client().patch('/questions', json={
+            'ids': ids + [ids[-1] + 1000], 'set': {'category': 3, 'difficulty': 4}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['updated'], 3)
+        self.assertEqual(Question.query.filter(
+            Question.id.in_(ids), Question.category == 3, Question.difficulty == 4).count(), 3)
+        stats = json.loads(self.client().get("/stats").data)
+        self.assertEqual(stats['categories']['3'], before['categories']['3'] + 3)
+        self.assertEqual(stats['categories']['1'], before['categories']['1'] - 3)
+
+        res = self.client().delete('/questions', json={
+            'ids': ids, 'filter': {'difficulty': 4}})
+        data = json.loads(res.data)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['deleted'], 3)
+        self.assertEqual(Question.query.filter(Question.id.in_(ids)).count(), 0)
+        stats = json.loads(self.client().get("/stats").data)
+        self.assertEqual(stats['totalQuestions'], before['totalQuestions'] - 3)
+
+    def test_batch_update_keeps_question_once_in_suggestions(self):
+        self.client().post('/questions', json={
+            'question': 'Which quokkafish was patched?', 'answer': 'This one',
+            'difficulty': 1, 'category': 1})
+        question = Question.query.filter(Question.question.like('%quokkafish%')).one()
+        self.addCleanup(self.client().delete, '/questions/{}'.format(question.id))
+        self.client().get("/questions/suggest?q=quokkafish")
+
+        for category in (2, 3):
+            res = self.client().patch('/questions', json={
+                'ids': [question.id], 'set': {'category': category}})
+            self.assertEqual(res.status_code, 200)
+
+        # a question taken out and added back is in its postings once
+        index = self.app.extensions['suggest']
+        index.remove(question.id)
+        index.add(question.id, question.question)
+
+        data = json.loads(self.client().get("/questions/suggest?q=quokkafish").data)
+        self.assertEqual([suggestion['id'] for suggestion in data['suggestions']], [question.id])
+        res = self.client().post("/questions?category=3", json={"searchTerm": "quokkafish"})
+        self.assertEqual(res.status_code, 200)
+        res = self.client().post("/questions?category=1", json={"searchTerm": "quokkafish"})
+        self.assertEqual(res.status_code, 404)
+
+    def test_batch_changes_need_a_selection_and_valid_values(self):
+        total = Question.query.count()
+
+        res = self.client().delete('/questions', json={})
+        self.assertEqual(res.status_code, 400)
+        res = self.client().delete('/questions', json={'filter': {'answer': 'x'}})
+        self.assertEqual(res.status_code, 400)
+        res = self.client().patch('/questions', json={
+            'filter': {'category': 1}, 'set': {'category': 1000}})
+        self.assertEqual(res.status_code, 422)
+        res = self.client().patch('/questions', json={
+            'filter': {'category': 1}, 'set': {'difficulty': 6}})
+        self.assertEqual(res.status_code, 422)
+
+        self.assertEqual(Question.query.count(), total)
+
+    # ====================================================================================
+    # export
+    # Tests for /questions/export method = ['GET']
+    # ====================================================================================
+    def test_export_ndjson(self):
+        res = self.client().get('/questions/export')
+        rows = [json.loads(line) for line in res.data.decode().splitlines()]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(rows), Question.query.count())
+        self.assertEqual(rows[0], Question.query.order_by(Question.id).first().format())
+
+    def test_export_csv_filtered(self):
+        res = self.client().get('/questions/export?format=csv&category=2&difficulty=4')
+        lines = res.data.decode().splitlines()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(lines[0], 'id,question,answer,difficulty,category')
+        self.assertEqual(len(lines) - 1, Question.query.filter(
+            Question.category == 2, Question.difficulty == 4).count())
+
+    def test_400_export_unknown_format(self):
+        res = self.client().get('/questions/export?format=xml')
+
+        self.assertEqual(res.status_code, 400)
+
+    def test_400_export_filter_not_a_number(self):
+        for query in ['category=abc', 'difficulty=x', 'category=2&difficulty=']:
+            res = self.client().get('/questions/export?' + query)
+
+            self.assertEqual(res.status_code, 400, query)
+            self.assertEqual(json.loads(res.data)['success'], False)
+
     # ====================================================================================
     # Delete a question
     # Tests for /questions/{id} method = ['DELETE']
@@ -214,6 +678,84 @@ class TriviaTestCase(unittest.TestCase):
         self.assertTrue(data['questions'])
         self.assertTrue(data['currentCategory'])
 
+    def test_search_by_word_prefix(self):
+        res = self.client().post("/questions", json={"searchTerm": "Egypt"})
+        data = json.loads(res.data)
+
+        # "egypt" is a prefix of "Egyptians"
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['totalQuestions'], 1)
+        self.assertIn('Egyptians', data['questions'][0]['question'])
+
+    def test_search_filtered_by_category(self):
+        res = self.client().post("/questions?category=5",
+                                 json={"searchTerm": "title"})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        for question in data['questions']:
+            self.assertEqual(int(question['category']), 5)
+
+        res = self.client().post("/questions?category=1",
+                                 json={"searchTerm": "title"})
+        self.assertEqual(res.status_code, 404)
+
+    def test_empty_search_lists_every_question(self):
+        asgiApp = create_asgi_app()
+        for path in ["/questions", "/questions?category=2&page=1"]:
+            res = self.client().post(path, json={"searchTerm": ""})
+            data = json.loads(res.data)
+            category = 2 if "category" in path else None
+            query = Question.query if category is None else \
+                Question.query.filter(Question.category == category)
+
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data['totalQuestions'], query.count())
+            self.assertEqual([question['id'] for question in data['questions']],
+                             [question.id for question in query.order_by(Question.id).limit(10)])
+            self.assertEqual(self.asgi_request(asgiApp, "POST", path, {"searchTerm": ""}), (200, data))
+
+        for term in [123, ["title"], {"word": "title"}]:
+            res = self.client().post("/questions", json={"searchTerm": term})
+            self.assertEqual(res.status_code, 400, term)
+            status, data = self.asgi_request(asgiApp, "POST", "/questions", {"searchTerm": term})
+            self.assertEqual(status, 400, term)
+
+    def test_search_finds_new_question(self):
+        testQuestion = {
+            'question': 'Which zanzibarian search test question was just added?',
+            'answer': 'This one',
+            'difficulty': 1,
+            'category': 1
+        }
+        self.client().post('/questions', json=testQuestion)
+        res = self.client().post("/questions", json={"searchTerm": "zanzibarian"})
+        data = json.loads(res.data)
+
+        question = Question.query.filter(
+            Question.question == testQuestion['question']).one_or_none()
+        question.delete()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['questions'][0]['id'], question.id)
+
+    def test_suggest_while_typing(self):
+        res = self.client().get("/questions/suggest?q=world cu")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['suggestions'])
+        for suggestion in data['suggestions']:
+            self.assertIn('world cu', suggestion['question'].lower())
+
+    def test_suggest_needs_three_letters(self):
+        res = self.client().get("/questions/suggest?q=wh")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['suggestions'], [])
+
     # # unsuccessful operation
     def test_search_empty_results(self):
         res = self.client().post("/questions",
@@ -223,6 +765,33 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 404)
         self.assertEqual(data["success"], False)
 
+    def test_fragments_encode_like_jsonify(self):
+        class DictJSONEncoder(FragmentJSONEncoder):
+            # encodes the dicts of Question.format() like jsonify always did
+            def splices(self):
+                return False
+
+        res = self.client().post("/questions", json={
+            "question": 'Qu\u00e9 "fragment" \u2603 </script>?', "answer": "S\u00ed",
+            "category": 1, "difficulty": 2})
+        self.assertEqual(res.status_code, 200)
+
+        for pretty in (False, True):
+            config = {'JSONIFY_PRETTYPRINT_REGULAR': pretty, 'SUGGEST_PRELOAD': False}
+            app = create_app(config)
+            plainApp = create_app(config)
+            plainApp.json_encoder = DictJSONEncoder
+            for method, path, body in [
+                    ("POST", "/questions", {"searchTerm": "fragment"}),
+                    ("GET", "/questions?page=1", None),
+                    ("GET", "/categories/1/questions", None)]:
+                res = app.test_client().open(path, method=method, json=body)
+                expected = plainApp.test_client().open(path, method=method, json=body)
+                self.assertEqual(res.data, expected.data, path)
+
+        data = json.loads(self.client().post("/questions", json={"searchTerm": "fragment"}).data)
+        self.client().delete("/questions/{}".format(data["questions"][0]["id"]))
+
     # ====================================================================================
     # get questions to play
     # Tests for /quizzes method = ['POST']
@@ -245,6 +814,128 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(data["success"], True)
         self.assertTrue(data['question'])
 
+    def test_quizzes_never_repeat_previous_questions(self):
+        categoryIds = [question.id for question in Question.query.filter(
+            Question.category == 1).all()]
+        sendData = {
+            'previous_questions': categoryIds[1:],
+            'quiz_category': {
+                'type': 'Science',
+                'id': 1
+            }
+        }
+        res = self.client().post("/quizzes", json=sendData)
+        data = json.loads(res.data)
+
+        # only one question of the category is left unseen
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data['question']['id'], categoryIds[0])
+
+        sendData['previous_questions'] = categoryIds
+        res = self.client().post("/quizzes", json=sendData)
+        data = json.loads(res.data)
+
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'End of questions')
+
+    def test_quiz_session_sends_only_token(self):
+        res = self.client().post("/quizzes/sessions", json={
+            'quiz_category': {
+                'type': 'Science',
+                'id': 1
+            }
+        })
+        token = json.loads(res.data)['token']
+        categoryCount = Question.query.filter(Question.category == 1).count()
+
+        # play the whole category; the server remembers what was asked
+        playedIds = []
+        for _ in range(categoryCount):
+            res = self.client().post("/quizzes", json={'token': token})
+            data = json.loads(res.data)
+            self.assertEqual(data['success'], True)
+            playedIds.append(data['question']['id'])
+
+        res = self.client().post("/quizzes", json={'token': token})
+        data = json.loads(res.data)
+
+        self.assertEqual(len(set(playedIds)), categoryCount)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'End of questions')
+
+    def test_quiz_batch_of_unseen_questions(self):
+        categoryIds = [question.id for question in Question.query.filter(
+            Question.category == 1).all()]
+        res = self.client().post("/quizzes", json={
+            'previous_questions': categoryIds[:1],
+            'quiz_category': {'type': 'Science', 'id': 1},
+            'count': 100
+        })
+        data = json.loads(res.data)
+
+        # everything left in the category, once each
+        batchIds = [question['id'] for question in data['questions']]
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(sorted(batchIds), sorted(categoryIds[1:]))
+        self.assertEqual(data['previous_questions'], categoryIds[:1] + batchIds)
+
+        res = self.client().post("/quizzes", json={
+            'previous_questions': data['previous_questions'],
+            'quiz_category': {'type': 'Science', 'id': 1},
+            'count': 2
+        })
+        self.assertEqual(json.loads(res.data)['message'], 'End of questions')
+
+    def test_quiz_session_batches_are_remembered(self):
+        res = self.client().post("/quizzes/sessions", json={'quiz_category': {'id': 0}})
+        token = json.loads(res.data)['token']
+
+        first = json.loads(self.client().post("/quizzes", json={'token': token, 'count': 3}).data)
+        second = json.loads(self.client().post("/quizzes", json={'token': token, 'count': 3}).data)
+        self.assertEqual(len(first['questions']), 3)
+        self.assertEqual(second['previous_questions'][:3],
+                         [question['id'] for question in first['questions']])
+        self.assertEqual(len(set(second['previous_questions'])), 6)
+
+        res = self.client().post("/quizzes", json={'token': token, 'count': 0})
+        self.assertEqual(res.status_code, 400)
+
+    def test_database_quiz_session_keeps_concurrent_rounds(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app({'SQLALCHEMY_DATABASE_URI': "sqlite:///" + os.path.join(directory, "sessions.db"),
+                          'DB_MIGRATE_ON_STARTUP': True, 'QUIZ_SESSION_BACKEND': 'database'})
+        store = app.extensions['quiz_sessions']
+        with app.app_context():
+            token = store.create(0)
+        start = threading.Barrier(8)
+
+        def play(round):
+            with app.app_context():
+                start.wait()
+                store.add_seen_many(token, range(round * 10, round * 10 + 10))
+                db.session.remove()
+
+        rounds = [threading.Thread(target=play, args=(round,)) for round in range(8)]
+        for thread in rounds:
+            thread.start()
+        for thread in rounds:
+            thread.join()
+
+        # every round kept its questions
+        with app.app_context():
+            category, seen = store.load(token)
+            self.assertEqual(sorted(seen), list(range(80)))
+            store.discard(token)
+            self.assertIsNone(store.load(token))
+
+    def test_404_unknown_quiz_session(self):
+        res = self.client().post("/quizzes", json={'token': 'not-a-session'})
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 404)
+        self.assertEqual(data["success"], False)
+
     # successful test
     def test_400_missing_request_data_quizzes(self):
         sendData = {
@@ -260,6 +951,467 @@ class TriviaTestCase(unittest.TestCase):
         self.assertEqual(res.status_code, 400)
         self.assertEqual(data["success"], False)
 
+    # ====================================================================================
+    # Tests for read replica routing
+    # ====================================================================================
+    def create_replicated_app(self, replicas, **config):
+        # two SQLite files stand in for the primary and the replica
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "{}.db").format
+        config.update({
+            'SQLALCHEMY_DATABASE_URI': "sqlite:///" + path("primary"),
+            'SQLALCHEMY_REPLICA_URIS': ["sqlite:///" + path(name) for name in replicas],
+            'SUGGEST_PRELOAD': False
+        })
+        app = create_app(config)
+        with app.app_context():
+            engines = db.engines(app)
+            for name, engine in engines.items():
+                if not os.path.exists(os.path.dirname(engine.url.database)):
+                    continue
+                db.Model.metadata.create_all(engine)
+                engine.execute(Category.__table__.insert(), type="Science")
+                if name != 'primary':
+                    engine.execute(Question.__table__.insert(), question="On the replica?",
+                                   answer="Yes", category=1, difficulty=1)
+        return app
+
+    def test_reads_served_by_replica(self):
+        app = self.create_replicated_app(["replica"])
+
+        res = app.test_client().get("/categories/1/questions")
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["totalQuestions"], 1)
+        self.assertEqual(data["questions"][0]["question"], "On the replica?")
+        with app.app_context():
+            self.assertEqual(Question.query.count(), 0)
+
+    def test_client_reads_own_writes_from_primary(self):
+        app = self.create_replicated_app(["replica"], READ_YOUR_WRITES_WINDOW=60)
+        client = app.test_client()
+
+        res = client.post("/questions", json={
+            "question": "On the primary?", "answer": "Yes", "category": 1, "difficulty": 1})
+        self.assertEqual(res.status_code, 200)
+
+        data = json.loads(client.get("/categories/1/questions").data)
+        self.assertEqual(data["questions"][0]["question"], "On the primary?")
+        data = json.loads(app.test_client().get("/categories/1/questions").data)
+        self.assertEqual(data["questions"][0]["question"], "On the replica?")
+
+        # a cookie the client wrote itself is ignored
+        forger = app.test_client()
+        forger.set_cookie("localhost", "read_primary_until", str(time.time() + 3600))
+        data = json.loads(forger.get("/categories/1/questions").data)
+        self.assertEqual(data["questions"][0]["question"], "On the replica?")
+
+    def test_unreachable_replica_is_skipped(self):
+        app = self.create_replicated_app([os.path.join("missing", "replica"), "replica"])
+
+        for path in ["/categories/1/questions", "/categories/1/questions?page=1"]:
+            res = app.test_client().get(path)
+            data = json.loads(res.data)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(data["questions"][0]["question"], "On the replica?")
+
+        stats = json.loads(app.test_client().get("/metrics").data)["metrics"]["replicas"]
+        self.assertEqual(stats["replicas"]["replica_1"]["up"], False)
+        self.assertEqual(stats["replicas"]["replica_2"]["reads"], 2)
+        self.assertEqual(stats["failovers"], 1)
+
+
+    # ====================================================================================
+    # Tests for schema migrations
+    # ====================================================================================
+    def create_legacy_database(self, questions):
+        # the schema db.create_all() made before migrations.py
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "legacy.db")
+        connection = sqlite3.connect(path)
+        connection.execute("CREATE TABLE categories (id INTEGER NOT NULL, type VARCHAR, PRIMARY KEY (id))")
+        connection.execute("CREATE TABLE questions (id INTEGER NOT NULL, question VARCHAR, answer VARCHAR, "
+                           "category VARCHAR, difficulty INTEGER, PRIMARY KEY (id))")
+        connection.execute("INSERT INTO categories VALUES (1, 'Science'), (2, 'Art')")
+        connection.executemany("INSERT INTO questions (question, answer, category, difficulty) "
+                               "VALUES (?, ?, ?, 1)", questions)
+        connection.commit()
+        connection.close()
+        return path
+
+    def test_legacy_schema_is_migrated(self):
+        path = self.create_legacy_database([("Old?", "Yes", "2"), ("Lost?", "Yes", "9")])
+        # a quiz session of the packed seen ids, in play during the upgrade
+        connection = sqlite3.connect(path)
+        self.addCleanup(connection.close)
+        connection.execute("CREATE TABLE quiz_sessions (token VARCHAR(64) NOT NULL PRIMARY KEY, "
+                           "category INTEGER, seen BLOB, expires_at FLOAT)")
+        connection.execute("INSERT INTO quiz_sessions VALUES ('playing', 0, ?, ?)",
+                           (array('q', [2, 1]).tobytes(), time.time() + 60))
+        connection.commit()
+        app = create_app({'SQLALCHEMY_DATABASE_URI': "sqlite:///" + path,
+                          'DB_MIGRATE_ON_STARTUP': True, 'QUIZ_SESSION_BACKEND': 'database'})
+
+        self.assertEqual(connection.execute("SELECT MAX(version) FROM schema_version").fetchone()[0], 5)
+        with app.app_context():
+            self.assertEqual(app.extensions['quiz_sessions'].load('playing'), (0, array('q', [2, 1])))
+        self.assertEqual(connection.execute(
+            "SELECT category, typeof(category) FROM questions ORDER BY id").fetchall(),
+            [(2, "integer"), (None, "null")])
+        indexes = {row[1] for row in connection.execute("PRAGMA index_list(questions)")}
+        self.assertTrue({"ix_questions_category_id", "ix_questions_difficulty",
+                         "ux_questions_question"} <= indexes)
+
+        res = app.test_client().get("/categories/2/questions")
+        self.assertEqual(json.loads(res.data)["questions"][0]["category"], 2)
+        # the question left without a category is listed first
+        res = app.test_client().get("/questions")
+        status, asgiData = self.asgi_request(AsgiApp(app), "GET", "/questions")
+        data = json.loads(res.data)
+        self.assertEqual((res.status_code, status), (200, 200))
+        self.assertEqual([question["category"] for question in data["questions"]], [None, 2])
+        self.assertEqual(data["currentCategory"], data["categories"]["2"])
+        self.assertEqual(asgiData, data)
+        # Postgres puts NULLs last unless told otherwise
+        self.assertIn("NULLS FIRST", str(select_questions().order_by(*QUESTION_ORDER).compile(
+            dialect=postgresql.dialect())))
+
+    def test_migration_refuses_duplicate_questions(self):
+        path = self.create_legacy_database([("Twice?", "Yes", "1"), ("Twice?", "Yes", "1")])
+        engine = create_engine("sqlite:///" + path)
+        self.addCleanup(engine.dispose)
+
+        with self.assertRaises(MigrationError):
+            migrate(engine, db.metadata)
+        # the whole upgrade was rolled back, the next run starts over
+        self.assertEqual(engine.execute("SELECT COUNT(*) FROM schema_version").scalar(), 0)
+        self.assertEqual(engine.execute("SELECT typeof(category) FROM questions").scalar(), "text")
+
+    def test_lazy_startup_and_init_db(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, "lazy.db")
+        app = create_app({'SQLALCHEMY_DATABASE_URI': "sqlite:///" + path})
+        # the default: SQLite creates the file on the first connection
+        self.assertFalse(os.path.exists(path))
+
+        result = app.test_cli_runner().invoke(args=["init-db"])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("schema version 5", result.output)
+
+        with app.app_context():
+            db.session.add(Category("Science"))
+            db.session.commit()
+        preload_shared_state(app)
+        self.assertTrue(app.extensions['quiz_index'].fresh())
+        self.assertTrue(app.extensions['question_stats'].fresh())
+        self.assertEqual(app.extensions['categories_cache'].peek(), {1: "Science"})
+
+    # ====================================================================================
+    # Tests for the question snapshot
+    # ====================================================================================
+    def snapshot_app(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return create_app({'QUESTION_SNAPSHOT_PATH': os.path.join(directory, "questions.snapshot"),
+                           'SUGGEST_PRELOAD': False})
+
+    def wait_for_snapshot(self, app):
+        deadline = time.monotonic() + 5
+        with app.app_context():
+            while current_snapshot() is None:
+                self.assertLess(time.monotonic(), deadline)
+                time.sleep(0.01)
+
+    def test_snapshot_answers_like_the_database(self):
+        app = self.snapshot_app()
+        client = app.test_client()
+        firstPage = json.loads(self.client().get("/questions").data)
+
+        for path in ["/questions", "/questions?page=2", "/questions?page=100",
+                     "/questions?after=" + firstPage["nextCursor"],
+                     "/categories/1/questions", "/categories/4/questions?after=4,0"]:
+            self.assertEqual(client.get(path).data, self.client().get(path).data, path)
+        search = {'searchTerm': 'title'}
+        self.assertEqual(client.post("/questions", json=search).data,
+                         self.client().post("/questions", json=search).data)
+
+        categoryIds = [question.id for question in Question.query.filter(Question.category == 1)]
+        quiz = {'previous_questions': categoryIds[1:], 'quiz_category': {'id': 1}}
+        data = json.loads(client.post("/quizzes", json=quiz).data)
+        self.assertEqual(data['question']['id'], categoryIds[0])
+        data = json.loads(client.post("/quizzes", json=dict(quiz, previous_questions=[], count=50)).data)
+        self.assertEqual(sorted(question['id'] for question in data['questions']), sorted(categoryIds))
+
+        stats = app.extensions['question_snapshot'].stats()
+        self.assertEqual(stats['builds'], 1)
+        self.assertEqual(stats['fallbacks'], 0)
+        self.assertEqual(stats['questions'], Question.query.count())
+
+    def test_snapshot_is_rebuilt_after_writes(self):
+        app = self.snapshot_app()
+        client = app.test_client()
+        client.get("/questions")
+        store = app.extensions['question_snapshot']
+        version = store.stats()['version']
+
+        client.post('/questions', json={
+            'question': 'Test question of the snapshot?', 'answer': 'Snapshot',
+            'difficulty': 1, 'category': 1})
+        question_id = Question.query.filter(
+            Question.question == 'Test question of the snapshot?').one().id
+        # read from the database until the rebuild is in
+        data = json.loads(client.get("/questions").data)
+        self.assertEqual(data['totalQuestions'], Question.query.count())
+
+        self.wait_for_snapshot(app)
+        self.assertGreater(store.stats()['version'], version)
+        data = json.loads(client.get("/categories/1/questions?page=1").data)
+        self.assertEqual(data['totalQuestions'],
+                         Question.query.filter(Question.category == 1).count())
+
+        client.delete('/questions', json={'ids': [question_id]})
+        self.wait_for_snapshot(app)
+        with app.app_context():
+            self.assertIsNone(current_snapshot().position(question_id))
+
+    # ====================================================================================
+    # Tests for the ASGI entry point
+    # ====================================================================================
+    def asgi_request(self, app, method, path, body=None):
+        path, _, query = path.partition("?")
+        data = json.dumps(body).encode() if body is not None else b""
+        scope = {"type": "http", "method": method, "path": path, "http_version": "1.1",
+                 "query_string": query.encode(), "scheme": "http", "root_path": "",
+                 "headers": [(b"content-type", b"application/json")] if body is not None else []}
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": data, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        asyncio.run(app(scope, receive, send))
+        content = b"".join(message.get("body", b"") for message in messages[1:])
+        return messages[0]["status"], json.loads(content)
+
+    def test_asgi_responses_match_flask(self):
+        asgiApp = create_asgi_app()
+        requests = [
+            ("GET", "/categories", None),
+            ("GET", "/questions?page=2", None),
+            ("GET", "/questions?page=1000", None),
+            ("GET", "/categories/2/questions", None),
+            ("GET", "/categories/1000/questions", None),
+            ("POST", "/questions", {"searchTerm": "title"}),
+            ("POST", "/questions", {"searchTerm": "zzzzzz"}),
+            ("POST", "/quizzes", {"previous_questions": [], "quiz_category": None}),
+            # every question of category 1, so the batch is the same in both
+            ("POST", "/quizzes", {"previous_questions": [], "quiz_category": {"id": 1},
+                                  "count": 1000}),
+        ]
+        def drawn_in_order(data):
+            # a batch is drawn in a random order
+            if "questions" in data and "previous_questions" in data:
+                data["questions"].sort(key=lambda question: question["id"])
+                data["previous_questions"].sort()
+            return data
+
+        for method, path, body in requests:
+            res = self.client().open(path, method=method, json=body)
+            status, data = self.asgi_request(asgiApp, method, path, body)
+
+            self.assertEqual(status, res.status_code, path)
+            self.assertEqual(drawn_in_order(data), drawn_in_order(json.loads(res.data)), path)
+
+    def test_asgi_quiz_question(self):
+        status, data = self.asgi_request(create_asgi_app(), "POST", "/quizzes", {
+            "previous_questions": [], "quiz_category": {"type": "Science", "id": 1}})
+
+        self.assertEqual(status, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual(data["question"]["category"], 1)
+
+    def test_asgi_hands_writes_to_flask(self):
+        asgiApp = create_asgi_app()
+        status, data = self.asgi_request(asgiApp, "POST", "/questions", {
+            "question": "Served by ASGI?", "answer": "Yes", "category": 1, "difficulty": 1})
+        self.assertEqual(status, 200)
+        self.assertEqual(data["success"], True)
+
+        status, data = self.asgi_request(asgiApp, "POST", "/questions", {"searchTerm": "Served by ASGI"})
+        self.assertEqual(data["totalQuestions"], 1)
+
+        status, data = self.asgi_request(
+            asgiApp, "DELETE", "/questions/{}".format(data["questions"][0]["id"]))
+        self.assertEqual(status, 200)
+        self.assertEqual(data["success"], True)
+
+    def test_asgi_reads_share_the_flask_read_path(self):
+        asgiApp = create_asgi_app({'SUGGEST_PRELOAD': False})
+        self.asgi_request(asgiApp, "GET", "/questions")
+        statements = []
+        with asgiApp.app.app_context():
+            engine = db.get_engine(asgiApp.app)
+        listener = lambda *args: statements.append(args[2])
+        event.listen(engine, "before_cursor_execute", listener)
+        try:
+            status, data = self.asgi_request(asgiApp, "GET", "/categories/1/questions")
+        finally:
+            event.remove(engine, "before_cursor_execute", listener)
+        # the totals come from the question counts
+        self.assertEqual(status, 200)
+        self.assertFalse([statement for statement in statements if "count(" in statement.lower()])
+
+        snapshotApp = AsgiApp(self.snapshot_app())
+        self.wait_for_snapshot(snapshotApp.app)
+        self.assertTrue(snapshotApp.flask_reads)
+        for path in ["/questions?page=2", "/categories/1/questions"]:
+            status, data = self.asgi_request(snapshotApp, "GET", path)
+            self.assertEqual(status, 200)
+            self.assertEqual(data, json.loads(self.client().get(path).data), path)
+
+
+    # ====================================================================================
+    # Tests for the instrumentation
+    # ====================================================================================
+    def test_server_timing_and_route_metrics(self):
+        app = create_app({'INSTRUMENTATION': True, 'SUGGEST_PRELOAD': False})
+        res = app.test_client().get("/questions?page=1")
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn("queries", res.headers["Server-Timing"])
+        self.assertIn("total;dur=", res.headers["Server-Timing"])
+
+        routes = json.loads(app.test_client().get("/metrics").data)["metrics"]["routes"]
+        self.assertEqual(routes["GET /questions"]["requests"], 1)
+        self.assertGreater(routes["GET /questions"]["queries_per_request"], 0)
+
+    def test_slow_requests_are_profiled(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        app = create_app({'INSTRUMENTATION': True, 'INSTRUMENTATION_SLOW_MS': 0,
+                          'INSTRUMENTATION_PROFILE_RATE': 1.0,
+                          'INSTRUMENTATION_PROFILE_DIR': directory,
+                          'SUGGEST_PRELOAD': False})
+        app.test_client().get("/categories")
+
+        self.assertEqual(len(os.listdir(directory)), 1)
+        self.assertTrue(os.listdir(directory)[0].endswith(".prof"))
+
+
+    # ====================================================================================
+    # Tests for admission control
+    # ====================================================================================
+    def test_rate_limited_client_gets_429_with_retry_after(self):
+        app = create_app({'ADMISSION_RATE': 0.5, 'ADMISSION_BURST': 2,
+                          'ADMISSION_CLIENT_HEADER': "X-Forwarded-For", 'SUGGEST_PRELOAD': False})
+        client = app.test_client()
+        # the proxy appended 10.0.0.2, the client made up 10.0.0.1
+        first = {"X-Forwarded-For": "10.0.0.1, 10.0.0.2"}
+
+        # a search costs more than the whole burst
+        res = client.post("/questions", json={"searchTerm": "title"}, headers=first)
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(client.get("/categories", headers=first).status_code, 200)
+        self.assertEqual(client.get("/categories", headers=first).status_code, 200)
+        res = client.get("/categories", headers=first)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 429)
+        self.assertEqual(data["message"], "too many requests")
+        self.assertEqual(res.headers["Retry-After"], "2")
+        # a made up address does not give the client a new bucket
+        res = client.get("/categories", headers={"X-Forwarded-For": "10.0.0.9, 10.0.0.2"})
+        self.assertEqual(res.status_code, 429)
+        res = client.get("/categories", headers={"X-Forwarded-For": "10.0.0.1, 10.0.0.3"})
+        self.assertEqual(res.status_code, 200)
+
+        stats = json.loads(client.get("/metrics", headers=first).data)
+        self.assertEqual(stats["metrics"]["admission"]["rate_limited"], 3)
+
+    def test_searches_over_their_cap_are_shed_before_cheap_reads(self):
+        config = {'ADMISSION_ROUTE_LIMITS': "search=1", 'ADMISSION_QUEUE_TIMEOUT': 0.05,
+                  'SUGGEST_PRELOAD': False}
+        app = create_app(config)
+        asgiApp = create_asgi_app(config)
+        admission = app.extensions['admission']
+        for limits in (admission.limits, asgiApp.app.extensions['admission'].limits):
+            # a search in flight
+            self.assertTrue(limits.acquire("search", True))
+
+        res = app.test_client().post("/questions", json={"searchTerm": "title"})
+        self.assertEqual(res.status_code, 503)
+        self.assertEqual(res.headers["Retry-After"], "1")
+        self.assertEqual(app.test_client().get("/categories").status_code, 200)
+        status, data = self.asgi_request(asgiApp, "POST", "/questions", {"searchTerm": "title"})
+        self.assertEqual(status, 503)
+        self.assertEqual(data["message"], "service unavailable")
+        self.assertEqual(self.asgi_request(asgiApp, "GET", "/categories")[0], 200)
+
+        admission.release("search", True)
+        res = app.test_client().post("/questions", json={"searchTerm": "title"})
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(admission.stats()["shed"], 1)
+        self.assertEqual(admission.stats()["active"], 0)
+
+    # ====================================================================================
+    # Tests for logging
+    # ====================================================================================
+    def test_request_id_is_sent_back(self):
+        res = self.client().get("/categories", headers={"X-Request-ID": "abc123"})
+        self.assertEqual(res.headers["X-Request-ID"], "abc123")
+
+        res = self.client().get("/categories")
+        self.assertEqual(len(res.headers["X-Request-ID"]), 32)
+
+    def test_payloads_logged_at_debug_only(self):
+        self.addCleanup(logging.getLogger("flaskr").setLevel, logging.NOTSET)
+        app = create_app({'LOG_LEVELS': "flaskr=DEBUG", 'LOG_PAYLOAD_SAMPLE': 1.0,
+                          'SUGGEST_PRELOAD': False})
+        with self.assertLogs("flaskr", "DEBUG") as logs:
+            app.test_client().post("/questions", json={"searchTerm": "title"})
+        payloads = [record.payload for record in logs.records if hasattr(record, "payload")]
+        self.assertEqual(payloads[0], {"searchTerm": "title"})
+        self.assertTrue(all(isinstance(id, int) for id in payloads[1]))
+
+        # assertLogs sets the level of the logger, INFO here
+        with self.assertLogs("flaskr", "INFO") as logs:
+            logging.getLogger("flaskr").info("marker")
+            app.test_client().post("/questions", json={"searchTerm": "title"})
+        self.assertEqual([record.getMessage() for record in logs.records], ["marker"])
+
+    def test_payloads_sampled_per_request(self):
+        self.addCleanup(logging.getLogger("flaskr").setLevel, logging.NOTSET)
+        app = create_app({'LOG_LEVELS': "flaskr=DEBUG", 'LOG_PAYLOAD_SAMPLE': 0.5,
+                          'SUGGEST_PRELOAD': False})
+        for _ in range(20):
+            with self.assertLogs("flaskr", "DEBUG") as records:
+                logging.getLogger("flaskr").debug("marker")
+                app.test_client().post("/questions", json={"searchTerm": "title"})
+            # the body and the result of a search, or neither
+            self.assertIn(sum(hasattr(record, "payload") for record in records.records), (0, 2))
+
+    def test_forked_worker_gets_its_own_log_queue(self):
+        app = create_app({'SUGGEST_PRELOAD': False})
+        handler, listener = logs._handler, logs._listener
+        # the listener thread of the parent does not exist in the child
+        listener.stop()
+        logs._restart_after_fork()
+
+        root = logging.getLogger()
+        self.assertIsNot(logs._handler, handler)
+        self.assertIsNot(logs._handler.queue, handler.queue)
+        self.assertNotIn(handler, root.handlers)
+        self.assertIn(logs._handler, root.handlers)
+        logging.getLogger("flaskr").warning("after fork")
+        stats = json.loads(app.test_client().get("/metrics").data)["metrics"]["logging"]
+        self.assertGreaterEqual(stats["queued"], 1)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,7 @@
+"""
+WSGI entry point for gunicorn, see gunicorn.conf.py, and other WSGI servers.
+"""
+
+from flaskr import create_app
+
+app = create_app()